@@ -6,9 +6,69 @@ DB_NAME = getenv('DB_NAME', 'test')
 DB_HOST = getenv('DB_HOST', '127.0.0.1')
 DB_PORT = getenv('DB_PORT', 27017)
 DB_PATH = getenv('DB_PATH', '/data/db')
+# 'mongoengine' for blocking StateManager, 'motor' for AsyncStateManager or 'memory' for MemoryStateManager
+STATE_MANAGER = getenv('STATE_MANAGER', 'mongoengine')
+
+# limits of the 'memory' state manager: dialogs idle for idle_ttl_sec seconds and least recently used dialogs
+# above max_dialogs are evicted, a dialog keeps max_dialog_utterances last utterances (None for all)
+MEMORY_STATE_MANAGER = {
+    'max_dialogs': 100000,
+    'idle_ttl_sec': 3600,
+    'max_dialog_utterances': None
+}
 
 MAX_WORKERS = 4
 
+# number of last dialog utterances loaded from the DB for each turn, None for the whole dialog history.
+# A service can request a longer history with "history_window" key, it is loaded only when the service is called
+DIALOG_HISTORY_WINDOW = 20
+
+# turn deadline in seconds: services which did not respond in time are cancelled and the agent answers with the
+# best of ready skill hypotheses. None waits for all services. Timeout of a single service is set with "timeout" key
+TURN_TIMEOUT = 30
+
+# quorum policy of response selectors: a response selector is called before all skills respond when
+# min_services skills responded, any hypothesis has confidence_threshold or soft_deadline_sec seconds passed since
+# skills were called (and at least one skill responded), remaining skills are cancelled. None waits for all skills
+SKILLS_QUORUM = None
+
+# default limits of the agent HTTP connection pool, can be overridden for a service with "connection_pool" key
+HTTP_CONNECTION_POOL = {
+    'limit': 100,
+    'limit_per_host': 0,
+    'keepalive_timeout': 15,
+    'ttl_dns_cache': 10
+}
+
+# write-behind saving of dialogs: turns are queued and saved by a background persister in batches at most
+# max_lag_sec seconds later, pending saves are flushed on the agent shutdown
+WRITE_BEHIND = {
+    'enabled': False,
+    'max_lag_sec': 1.0,
+    'max_pending': 1000,
+    'flush_batch_size': 100
+}
+
+# in-memory LRU/TTL cache of active users and their dialogs, repeat turns of cached users are served without
+# DB reads. Dialogs of a user should be handled by a single agent process when the cache is enabled
+DIALOG_CACHE = {
+    'enabled': False,
+    'max_size': 10000,
+    'ttl_sec': 600
+}
+
+# per-turn traces: spans of service calls, state manager calls and workflow formatters. Traces are exported
+# to a JSON lines file at path ('file' exporter) or to an OpenTelemetry collector endpoint ('otlp' exporter,
+# OTLP/HTTP JSON). sample_rate is a fraction of traced turns
+TRACING = {
+    'enabled': False,
+    'exporter': 'file',
+    'path': 'traces.jsonl',
+    'endpoint': 'http://127.0.0.1:4318/v1/traces',
+    'sample_rate': 1.0,
+    'flush_interval_sec': 1.0
+}
+
 AGENT_ENV_FILE = "agent.env"
 
 SKILLS = [
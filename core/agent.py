@@ -1,33 +1,87 @@
 import asyncio
 
 from collections import defaultdict
-from time import time
-from typing import Any, Optional, Callable, Hashable
+from inspect import isawaitable
+from logging import getLogger
+from time import time, perf_counter
+from typing import Any, Optional, Callable, Hashable, Dict, List
+from uuid import uuid4
 
+from core.metrics import SERVICE_LATENCY, SERVICE_RESPONSE_TIME, TURN_LATENCY, DB_CALL_LATENCY
 from core.pipeline import Pipeline
 from core.state_manager import StateManager
 from core.state_schema import Dialog
-from models.hardcode_utterances import TG_START_UTT
+from core.tracing import Tracer, TurnTrace
+from models.hardcode_utterances import TG_START_UTT, NOANSWER_UTT
+
+logger = getLogger(__name__)
+
+RESERVED_FIELDS = {'dialog_object', 'pending_counts', 'live_counts', 'pruned_services', 'history_complete',
+                   'deadline_handle', 'deadline_passed', 'quorum_handles', 'quorum_deadlines_passed', 'trace',
+                   'dialog_version', 'turn_id'}
+
+
+async def await_if_needed(result):
+    # state managers may be both blocking and asynchronous
+    if isawaitable(result):
+        return await result
+    return result
+
+
+async def call_state_manager(operation: str, method: Callable, *args, trace: Optional[TurnTrace] = None, **kwargs):
+    start_time, span_start_time = perf_counter(), time()
+    result = await await_if_needed(method(*args, **kwargs))
+    DB_CALL_LATENCY.observe(perf_counter() - start_time, operation)
+    if trace is not None:
+        trace.add_span(operation, 'db', span_start_time, time())
+    return result
 
 
 class Agent:
     def __init__(self, pipeline: Pipeline, state_manager: StateManager,
                  process_logger_callable: Optional[Callable] = None,
-                 response_logger_callable: Optional[Callable] = None):
+                 response_logger_callable: Optional[Callable] = None,
+                 history_window: Optional[int] = None, turn_timeout: Optional[float] = None,
+                 tracer: Optional[Tracer] = None, cancel_requests_callable: Optional[Callable] = None):
         self.workflow = dict()
+        self.history_window = history_window
+        self.turn_timeout = turn_timeout
+        self.tracer = tracer
+        self.timeout_stats = defaultdict(lambda: defaultdict(int))
+        self.selection_stats = defaultdict(lambda: defaultdict(int))
+        self.pruned_stats = defaultdict(int)
+        self.detached_tasks = set()
         self.pipeline = pipeline
         self.state_manager = state_manager
         self.process_logger_callable = process_logger_callable
         self.response_logger_callable = response_logger_callable
+        # cancels requests of finished and skipped services in transport, so they are not retried
+        self.cancel_requests_callable = cancel_requests_callable
 
-    def add_workflow_record(self, dialog: Dialog, deadline_timestamp: Optional[float] = None, **kwargs):
+    def add_workflow_record(self, dialog: Dialog, deadline_timestamp: Optional[float] = None,
+                            trace: Optional[TurnTrace] = None, **kwargs):
         if str(dialog.id) in self.workflow.keys():
             raise ValueError(f'dialog with id {dialog.id} is already in workflow')
-        workflow_record = {'dialog_object': dialog, 'dialog': dialog.to_dict(), 'services': defaultdict(dict)}
+        dialog_dict = dialog.to_dict()
+        history_complete = self.history_window is None or len(dialog_dict['utterances']) < self.history_window
+        workflow_record = {'dialog_object': dialog, 'dialog': dialog_dict, 'services': dict(),
+                           'pending_counts': self.pipeline.init_pending_counts(),
+                           'live_counts': self.pipeline.init_pending_counts(), 'pruned_services': set(),
+                           'history_complete': history_complete, 'quorum_handles': {}, 'quorum_deadlines_passed': set(),
+                           'trace': trace,
+                           # connectors pass the turn id back with responses, so responses to requests of
+                           # previous turns of the dialog are told from responses to the current turn
+                           'turn_id': uuid4().hex,
+                           # counts dialog changes of the turn, services called with the same dialog version
+                           # may share the dialog snapshot in transport
+                           'dialog_version': 0}
+        reserved_fields = RESERVED_FIELDS.intersection(kwargs.keys())
+        if reserved_fields:
+            raise ValueError(f'{reserved_fields} are system reserved workflow record fields')
         if deadline_timestamp:
             workflow_record['deadline_timestamp'] = deadline_timestamp
-        if 'dialog_object' in kwargs:
-            raise ValueError("'dialog_object' is system reserved workflow record field")
+            workflow_record['deadline_handle'] = asyncio.get_event_loop().call_later(
+                max(deadline_timestamp - time(), 0), self.on_turn_deadline, str(dialog.id), workflow_record)
         workflow_record.update(kwargs)
         self.workflow[str(dialog.id)] = workflow_record
 
@@ -42,13 +96,201 @@ class Agent:
             raise ValueError(f'dialog with id {dialog_id} is not exist in workflow')
         if self.response_logger_callable:
             self.response_logger_callable(self.workflow[dialog_id])
-        return self.workflow.pop(dialog_id)
+        workflow_record = self.workflow.pop(dialog_id)
+        self.cancel_timers(workflow_record)
+        self.cancel_requests([service_data for service_data in workflow_record['services'].values()
+                              if not service_data.get('done')])
+        input_send_time = workflow_record['services'].get('input', {}).get('agent_send_time')
+        if input_send_time:
+            TURN_LATENCY.observe(time() - input_send_time)
+        self.export_trace(workflow_record)
+        return workflow_record
+
+    def drop_record(self, dialog_id: str, workflow_record: Dict) -> None:
+        if self.workflow.get(dialog_id) is workflow_record:
+            del self.workflow[dialog_id]
+        self.cancel_timers(workflow_record)
+        self.cancel_services(workflow_record)
+        self.export_trace(workflow_record, error=True)
+
+    def export_trace(self, workflow_record: Dict, error: bool = False) -> None:
+        trace = workflow_record['trace']
+        if trace is not None and self.tracer is not None:
+            trace.finish(workflow_record, error=error)
+            self.tracer.export(trace)
+
+    @staticmethod
+    def cancel_timers(workflow_record: Dict) -> None:
+        if 'deadline_handle' in workflow_record:
+            workflow_record['deadline_handle'].cancel()
+        for handle in workflow_record['quorum_handles'].values():
+            handle.cancel()
+        for service_data in workflow_record['services'].values():
+            if 'timeout_handle' in service_data:
+                service_data['timeout_handle'].cancel()
+
+    def cancel_services(self, workflow_record: Dict) -> None:
+        # late cancel of services which results do not matter anymore, their late responses are dropped
+        cancelled = []
+        for service_name, service_data in workflow_record['services'].items():
+            if service_data.get('done'):
+                continue
+            service_data['done'] = True
+            service_data['cancelled'] = True
+            if 'timeout_handle' in service_data:
+                service_data['timeout_handle'].cancel()
+            task = service_data.get('task')
+            if task is not None and not task.done():
+                task.cancel()
+            self.timeout_stats[service_name]['cancelled'] += 1
+            cancelled.append(service_data)
+        self.cancel_requests(cancelled)
+
+    def cancel_requests(self, services_data: List[Dict]) -> None:
+        task_uuids = [service_data['task_uuid'] for service_data in services_data if 'task_uuid' in service_data]
+        if self.cancel_requests_callable is not None and task_uuids:
+            self.cancel_requests_callable(task_uuids)
+
+    def check_quorum(self, workflow_record: Dict, service) -> bool:
+        """Checks if the quorum policy of the service allows to call it before all previous services are done."""
+        quorum = service.quorum
+        services_data = workflow_record['services']
+        responded = [s.name for s in service.previous_services if services_data.get(s.name, {}).get('responded')]
+        if not responded:
+            return False
+        if service.name in workflow_record['quorum_deadlines_passed']:
+            return True
+        if quorum.get('min_services') and len(responded) >= quorum['min_services']:
+            return True
+        if quorum.get('confidence_threshold') is not None:
+            hypotheses = workflow_record['dialog']['utterances'][-1].get('hypotheses', [])
+            if any(h['confidence'] >= quorum['confidence_threshold'] for h in hypotheses):
+                return True
+        return False
+
+    def release_quorum(self, workflow_record: Dict, service) -> List:
+        """Cancels stragglers among previous services of the service, returns services which became ready."""
+        ready, cancelled = [], []
+        self.timeout_stats[service.name]['quorum_exits'] += 1
+        for previous_service in service.previous_services:
+            if previous_service.name in workflow_record['pruned_services']:
+                continue
+            if previous_service.name not in workflow_record['services']:
+                workflow_record['services'][previous_service.name] = {'send': False, 'done': False,
+                                                                      'agent_send_time': None,
+                                                                      'agent_done_time': None}
+            service_data = workflow_record['services'][previous_service.name]
+            if service_data.get('done'):
+                continue
+            service_data['done'] = True
+            service_data['cancelled'] = True
+            if 'timeout_handle' in service_data:
+                service_data['timeout_handle'].cancel()
+            task = service_data.get('task')
+            if task is not None and not task.done():
+                task.cancel()
+            self.timeout_stats[previous_service.name]['cancelled'] += 1
+            cancelled.append(service_data)
+            ready.extend(self.pipeline.mark_done(workflow_record['pending_counts'], previous_service.name))
+        self.cancel_requests(cancelled)
+        return ready
+
+    def on_quorum_deadline(self, dialog_id: str, workflow_record: Dict, service) -> None:
+        if self.workflow.get(dialog_id) is not workflow_record or service.name in workflow_record['services'] \
+                or workflow_record.get('deadline_passed'):
+            return
+        # without any response the service is called on the first response of previous services
+        workflow_record['quorum_deadlines_passed'].add(service.name)
+        if any(workflow_record['services'].get(s.name, {}).get('responded') for s in service.previous_services):
+            self.timeout_stats[service.name]['quorum_deadlines'] += 1
+            self.run_detached(self.dispatch(dialog_id, workflow_record, self.release_quorum(workflow_record,
+                                                                                            service)))
+
+    def run_detached(self, coro) -> None:
+        task = asyncio.ensure_future(coro)
+        self.detached_tasks.add(task)
+        task.add_done_callback(self.on_detached_done)
+
+    def on_detached_done(self, task: asyncio.Task) -> None:
+        self.detached_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('agent background task failed', exc_info=task.exception())
+
+    def on_service_timeout(self, dialog_id: str, workflow_record: Dict, service_name: str) -> None:
+        service_data = workflow_record['services'][service_name]
+        if self.workflow.get(dialog_id) is not workflow_record or service_data.get('done'):
+            return
+        self.timeout_stats[service_name]['timed_out'] += 1
+        task = service_data.get('task')
+        if task is not None and not task.done():
+            task.cancel()
+        self.cancel_requests([service_data])
+        # the service is skipped, its successors are processed without its response
+        self.run_detached(self.process(dialog_id, service_name, response=None, timed_out=True,
+                                       turn_id=workflow_record['turn_id']))
+
+    def on_turn_deadline(self, dialog_id: str, workflow_record: Dict) -> None:
+        if self.workflow.get(dialog_id) is not workflow_record:
+            return
+        workflow_record['deadline_passed'] = True
+        self.timeout_stats['turn']['deadlines'] += 1
+        self.run_detached(self.respond_on_deadline(dialog_id, workflow_record))
+
+    async def respond_on_deadline(self, dialog_id: str, workflow_record: Dict) -> None:
+        """Fallback responder: answers with the best of ready hypotheses when the turn deadline passes."""
+        responders = [s for s in self.pipeline.services.values() if s.is_responder()]
+        if any(responder.name in workflow_record['services'] for responder in responders):
+            return
+        self.cancel_services(workflow_record)
+        self.ensure_bot_utterance(workflow_record)
+        for responder in responders:
+            self.register_service_request(dialog_id, responder.name)
+            await responder.connector_func(payload=responder.apply_workflow_formatter(workflow_record),
+                                           callback=self.process,
+                                           **self.get_connector_kwargs(workflow_record, responder.name))
+
+    @staticmethod
+    def ensure_bot_utterance(workflow_record: Dict) -> None:
+        # bot utterance is missing if the response selector was skipped or timed out
+        dialog = workflow_record['dialog']
+        last_utterance = dialog['utterances'][-1]
+        if last_utterance['user']['user_type'] != 'human':
+            return
+        hypotheses = last_utterance['hypotheses']
+        if hypotheses:
+            best_hypothesis = max(hypotheses, key=lambda x: x['confidence'])
+        else:
+            best_hypothesis = {'skill_name': 'fallback', 'text': NOANSWER_UTT, 'confidence': 0.0}
+        StateManager.add_bot_utterance_simple_dict(dialog, workflow_record['dialog_object'],
+                                                   {'fallback': best_hypothesis})
+        workflow_record['dialog_version'] += 1
+
+    def get_selection_stats(self) -> Dict:
+        return {'selectors': {name: dict(stats) for name, stats in self.selection_stats.items()},
+                'pruned_services': dict(self.pruned_stats)}
+
+    def get_timeout_stats(self) -> Dict:
+        return {service_name: dict(stats) for service_name, stats in self.timeout_stats.items()}
+
+    async def ensure_history(self, workflow_record, history_window: Optional[int]):
+        # lazy loading of older utterances for services requesting longer history than the agent loads by default
+        dialog = workflow_record['dialog']
+        if history_window is None or workflow_record['history_complete'] \
+                or len(dialog['utterances']) >= history_window:
+            return
+        saved_count = sum(1 for utt in dialog['utterances'] if utt['id'])
+        limit = history_window - (len(dialog['utterances']) - saved_count)
+        saved_utterances = await call_state_manager('get_last_utterances', self.state_manager.get_last_utterances,
+                                                    dialog['id'], limit, trace=workflow_record['trace'])
+        dialog['utterances'][:saved_count] = saved_utterances
+        workflow_record['history_complete'] = len(saved_utterances) < limit
+        workflow_record['dialog_version'] += 1
 
     def register_service_request(self, dialog_id: str, service_name):
         if dialog_id not in self.workflow.keys():
             raise ValueError(f'dialog with id {dialog_id} is not exist in workflow')
         self.workflow[dialog_id]['services'][service_name] = {'send': True, 'done': False, 'agent_send_time': time(),
-                                                              'agent_done_time': None}
+                                                              'agent_done_time': None, 'task_uuid': uuid4().hex}
 
     def get_services_status(self, dialog_id: str):
         if dialog_id not in self.workflow.keys():
@@ -62,21 +304,47 @@ class Agent:
 
         return done, waiting
 
-    def process_service_response(self, dialog_id: str, service_name: str = None, response: Any = None,
-                                 **kwargs):
+    async def process_service_response(self, dialog_id: str, service_name: str = None, response: Any = None,
+                                       **kwargs):
         workflow_record = self.get_workflow_record(dialog_id)
 
         # Updating workflow with service response
         service = self.pipeline.get_service_by_name(service_name)
+        next_services = []
         if service:
-            service_data = self.workflow[dialog_id]['services'][service_name]
+            service_data = workflow_record['services'].get(service_name)
+            turn_id, task_uuid = kwargs.pop('turn_id', None), kwargs.pop('task_uuid', None)
+            if service_data is None or (turn_id is not None and turn_id != workflow_record['turn_id']) \
+                    or (task_uuid is not None and task_uuid != service_data.get('task_uuid')):
+                # response to a request of a previous turn of the dialog
+                self.timeout_stats[service_name]['late_responses'] += 1
+                return []
+            if service_data.get('done'):
+                # late response of a timed out or cancelled service
+                self.timeout_stats[service_name]['late_responses'] += 1
+                return []
+            if 'timeout_handle' in service_data:
+                service_data['timeout_handle'].cancel()
+            next_services = self.pipeline.mark_done(workflow_record['pending_counts'], service_name)
             service_data['done'] = True
+            service_data['responded'] = response is not None
             service_data['agent_done_time'] = time()
+            if service_data.get('agent_send_time'):
+                SERVICE_LATENCY.observe(service_data['agent_done_time'] - service_data['agent_send_time'], service_name)
+            if 'service_send_time' in kwargs and 'service_response_time' in kwargs:
+                SERVICE_RESPONSE_TIME.observe(kwargs['service_response_time'] - kwargs['service_send_time'],
+                                              service_name)
             if response and service.state_processor_method:
-                service.state_processor_method(dialog=workflow_record['dialog'],
-                                               dialog_object=workflow_record['dialog_object'],
-                                               payload=response,
-                                               message_attrs=kwargs.pop('message_attrs', {}))
+                # state processor of the responder saves the dialog
+                await call_state_manager(service.state_processor_method.__name__ if service.is_responder()
+                                         else 'state_processor',
+                                         service.state_processor_method,
+                                         dialog=workflow_record['dialog'],
+                                         dialog_object=workflow_record['dialog_object'],
+                                         payload=response,
+                                         message_attrs=kwargs.pop('message_attrs', {}),
+                                         trace=workflow_record['trace'])
+                workflow_record['dialog_version'] += 1
 
             # passing kwargs to services record
             if not set(service_data.keys()).intersection(set(kwargs.keys())):
@@ -88,22 +356,20 @@ class Agent:
                 self.flush_record(dialog_id)
             return []
 
-        # Calculating next steps
-        done, waiting = self.get_services_status(dialog_id)
-        next_services = self.pipeline.get_next_services(done, waiting)
-
-        # Processing the case, when service is a skill selector
-        if service and service.is_sselector():
+        # Processing the case, when service is a skill selector, all skills are run if it is timed out
+        # unselected services and services depending only on them are removed from the turn
+        if service and service.is_sselector() and response is not None:
             selected_services = list(response.values())[0]
-            result = []
-            for service in next_services:
-                if service.name not in selected_services:
-                    self.workflow[dialog_id]['services'][service.name] = {'done': True, 'send': False,
-                                                                          'agent_send_time': None,
-                                                                          'agent_done_time': None}
-                else:
-                    result.append(service)
-            next_services = result
+            unselected = [s.name for s in next_services if s.name not in selected_services]
+            ready, pruned = self.pipeline.prune(workflow_record['pending_counts'], workflow_record['live_counts'],
+                                                unselected)
+            workflow_record['pruned_services'].update(pruned)
+            next_services = [s for s in next_services if s.name in selected_services] + ready
+            selection_stats = self.selection_stats[service.name]
+            selection_stats['turns'] += 1
+            selection_stats['saved_calls'] += len(pruned)
+            for pruned_service in pruned:
+                self.pruned_stats[pruned_service] += 1
         # send dialog workflow record to further logging operations:
         if self.process_logger_callable:
             self.process_logger_callable(self.workflow['dialog_id'])
@@ -114,9 +380,15 @@ class Agent:
                            user_device_type: Any, location: Any,
                            channel_type: str, deadline_timestamp=None,
                            require_response=False, **kwargs):
-        user = self.state_manager.get_or_create_user(user_telegram_id, user_device_type)
+        if deadline_timestamp is None and self.turn_timeout is not None:
+            deadline_timestamp = time() + self.turn_timeout
+        trace = self.tracer.start_trace() if self.tracer else None
+        user = await call_state_manager('get_or_create_user', self.state_manager.get_or_create_user,
+                                        user_telegram_id, user_device_type, trace=trace)
         should_reset = True if utterance == TG_START_UTT else False
-        dialog = self.state_manager.get_or_create_dialog(user, location, channel_type, should_reset=should_reset)
+        dialog = await call_state_manager('get_or_create_dialog', self.state_manager.get_or_create_dialog,
+                                          user, location, channel_type, should_reset=should_reset,
+                                          history_window=self.history_window, trace=trace)
         dialog_id = str(dialog.id)
         service_name = 'input'
         message_attrs = kwargs.pop('message_attrs', {})
@@ -124,26 +396,93 @@ class Agent:
         if require_response:
             event = asyncio.Event()
             kwargs['event'] = event
-            self.add_workflow_record(dialog=dialog, deadline_timestamp=deadline_timestamp, hold_flush=True, **kwargs)
+            self.add_workflow_record(dialog=dialog, deadline_timestamp=deadline_timestamp, trace=trace, hold_flush=True,
+                                     **kwargs)
+            workflow_record = self.workflow[dialog_id]
             self.register_service_request(dialog_id, service_name)
-            await self.process(dialog_id, service_name, response=utterance, message_attrs=message_attrs)
-            await event.wait()
+            try:
+                await self.process(dialog_id, service_name, response=utterance, message_attrs=message_attrs,
+                                   turn_id=workflow_record['turn_id'])
+                await event.wait()
+            except BaseException:
+                self.drop_record(dialog_id, workflow_record)
+                raise
             return self.flush_record(dialog_id)
 
-        self.add_workflow_record(dialog=dialog, deadline_timestamp=deadline_timestamp, **kwargs)
+        self.add_workflow_record(dialog=dialog, deadline_timestamp=deadline_timestamp, trace=trace, **kwargs)
+        workflow_record = self.workflow[dialog_id]
         self.register_service_request(dialog_id, service_name)
-        await self.process(dialog_id, service_name, response=utterance, message_attrs=message_attrs)
+        try:
+            await self.process(dialog_id, service_name, response=utterance, message_attrs=message_attrs,
+                               turn_id=workflow_record['turn_id'])
+        except BaseException:
+            self.drop_record(dialog_id, workflow_record)
+            raise
 
     async def process(self, dialog_id, service_name=None, response: Any = None, **kwargs):
-        workflow_record = self.get_workflow_record(dialog_id)
-        next_services = self.process_service_response(dialog_id, service_name, response, **kwargs)
+        workflow_record = self.workflow.get(dialog_id)
+        if workflow_record is None:
+            # late response to an already answered turn
+            self.timeout_stats[service_name]['late_responses'] += 1
+            return
+        next_services = await self.process_service_response(dialog_id, service_name, response, **kwargs)
+        if workflow_record.get('deadline_passed'):
+            # fallback responder answers, results of further services do not matter
+            return
+
+        # early call of a service with quorum policy, remaining previous services are cancelled
+        service = self.pipeline.get_service_by_name(service_name)
+        for next_service in service.next_services if service else []:
+            if next_service.quorum and next_service.name not in workflow_record['services'] \
+                    and next_service not in next_services and self.check_quorum(workflow_record, next_service):
+                next_services.extend(self.release_quorum(workflow_record, next_service))
+
+        await self.dispatch(dialog_id, workflow_record, next_services)
+
+    @staticmethod
+    def get_connector_kwargs(workflow_record: Dict, service_name: str) -> Dict:
+        # trace id is passed only to traced turns, turn id and task uuid are passed back by connectors with responses
+        trace = workflow_record['trace']
+        connector_kwargs = {'turn_id': workflow_record['turn_id'],
+                            'task_uuid': workflow_record['services'][service_name]['task_uuid']}
+        if trace is not None:
+            connector_kwargs['trace_id'] = trace.trace_id
+        return connector_kwargs
 
+    async def dispatch(self, dialog_id: str, workflow_record: Dict, next_services: List) -> None:
+        loop = asyncio.get_event_loop()
+        trace = workflow_record['trace']
         service_requests = []
         for service in next_services:
+            if service.name in workflow_record['services']:
+                # already called or skipped
+                continue
+            if service.is_responder():
+                self.ensure_bot_utterance(workflow_record)
             self.register_service_request(dialog_id, service.name)
+            await self.ensure_history(workflow_record, service.history_window)
+            formatter_start_time = time()
             payload = service.apply_workflow_formatter(workflow_record)
-            service_requests.append(
-                service.connector_func(payload=payload, callback=self.process)
-            )
+            if trace is not None and service.workflow_formatter:
+                trace.add_span(f'{service.name}.formatter', 'formatter', formatter_start_time, time())
+            service_data = workflow_record['services'][service.name]
+            connector_kwargs = self.get_connector_kwargs(workflow_record, service.name)
+            request = service.connector_func(payload=payload, callback=self.process, **connector_kwargs)
+            service_data['task'] = asyncio.ensure_future(request)
+            if service.timeout:
+                service_data['timeout_handle'] = loop.call_later(service.timeout, self.on_service_timeout,
+                                                                 dialog_id, workflow_record, service.name)
+            for next_service in service.next_services:
+                quorum = next_service.quorum
+                if quorum and quorum.get('soft_deadline_sec') is not None \
+                        and next_service.name not in workflow_record['quorum_handles']:
+                    workflow_record['quorum_handles'][next_service.name] = loop.call_later(
+                        quorum['soft_deadline_sec'], self.on_quorum_deadline, dialog_id, workflow_record,
+                        next_service)
+            service_requests.append(service_data['task'])
 
-        await asyncio.gather(*service_requests)
+        # requests of timed out services are cancelled, it does not fail the turn
+        results = await asyncio.gather(*service_requests, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                raise result
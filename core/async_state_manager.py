@@ -0,0 +1,227 @@
+from copy import deepcopy
+from datetime import datetime
+from itertools import chain
+from typing import Hashable, Any, Optional, Dict, List, Tuple
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, UpdateOne
+
+from core.state_manager import StateManager
+from core.state_schema import HUMAN_SCHEMA, STATE_DOCUMENTS
+from core.transform_config import DB_HOST, DB_PORT, DB_NAME
+from core import STATE_API_VERSION
+
+# collections and class markers used by mongoengine documents from core.state_schema,
+# so both state managers can work with the same database
+USER_COLLECTION = 'user'
+UTTERANCE_COLLECTION = 'utterance'
+DIALOG_COLLECTION = 'dialog'
+
+HUMAN_CLS = 'User.Human'
+BOT_CLS = 'User.Bot'
+HUMAN_UTTERANCE_CLS = 'Utterance.HumanUtterance'
+BOT_UTTERANCE_CLS = 'Utterance.BotUtterance'
+
+
+def _parse_date_time(date_time):
+    if isinstance(date_time, str):
+        return datetime.fromisoformat(date_time)
+    return date_time
+
+
+# human and bot dicts are copies of the documents, so changed fields can be found on save
+def human_to_dict(human: Dict) -> Dict:
+    return {'id': str(human['_id']),
+            'user_telegram_id': str(human['user_telegram_id']),
+            'user_type': 'human',
+            'device_type': deepcopy(human.get('device_type')),
+            'persona': deepcopy(human.get('persona', [])),
+            'profile': deepcopy(human.get('profile', {})),
+            'attributes': deepcopy(human.get('attributes', {}))}
+
+
+def bot_to_dict(bot: Dict) -> Dict:
+    return {'id': str(bot['_id']),
+            'user_type': 'bot',
+            'persona': deepcopy(bot.get('persona', [])),
+            'attributes': deepcopy(bot.get('attributes', {}))}
+
+
+def utterance_to_dict(utterance: Dict) -> Dict:
+    result = {'id': str(utterance['_id']),
+              'text': utterance.get('text'),
+              'user': utterance.get('user', {}),
+              'annotations': utterance.get('annotations', {}),
+              'date_time': str(utterance.get('date_time'))}
+    if utterance.get('_cls') == BOT_UTTERANCE_CLS:
+        result.update({'active_skill': utterance.get('active_skill'),
+                       'confidence': utterance.get('confidence'),
+                       'orig_text': utterance.get('orig_text')})
+    else:
+        result.update({'hypotheses': utterance.get('hypotheses', []),
+                       'attributes': utterance.get('attributes', {})})
+    return result
+
+
+def utterance_from_dict(payload: Dict) -> Dict:
+    utterance = {'text': payload['text'],
+                 'user': payload['user'],
+                 'annotations': payload['annotations'],
+                 'date_time': _parse_date_time(payload['date_time'])}
+    if payload['user']['user_type'] == 'human':
+        utterance.update({'_cls': HUMAN_UTTERANCE_CLS,
+                          'hypotheses': payload['hypotheses'],
+                          'attributes': payload['attributes']})
+    elif payload['user']['user_type'] == 'bot':
+        utterance.update({'_cls': BOT_UTTERANCE_CLS,
+                          'orig_text': payload['orig_text'],
+                          'active_skill': payload['active_skill'],
+                          'confidence': payload['confidence']})
+    else:
+        raise ValueError('unknown user type in the utterance')
+    if payload.get('id'):
+        utterance['_id'] = ObjectId(payload['id'])
+    return utterance
+
+
+class DialogRecord:
+    """Raw dialog documents loaded by AsyncStateManager, a counterpart of core.state_schema.Dialog for the agent."""
+
+    def __init__(self, dialog: Dict, human: Dict, bot: Dict, utterances: List[Dict]):
+        self.dialog = dialog
+        self.human = human
+        self.bot = bot
+        self.utterances = utterances
+
+    @property
+    def id(self):
+        return self.dialog['_id']
+
+    def to_dict(self) -> Dict:
+        return {
+            'id': str(self.id),
+            'location': self.dialog.get('location'),
+            'utterances': [utterance_to_dict(utt) for utt in self.utterances],
+            'channel_type': self.dialog.get('channel_type'),
+            'human': human_to_dict(self.human),
+            'bot': bot_to_dict(self.bot)
+        }
+
+
+class AsyncStateManager(StateManager):
+    """Non-blocking state manager backed by motor.
+
+    Implements the agent facing part of StateManager (getting users and dialogs, saving dialog state) with
+    coroutines, dict state processors are inherited as they don't touch the database.
+    """
+
+    def __init__(self, host=DB_HOST, port=DB_PORT, db_name=DB_NAME):
+        self.client = AsyncIOMotorClient(host=host, port=int(port))
+        self.db = self.client[db_name]
+
+    async def ensure_indexes(self) -> None:
+        # index specs are built by mongoengine from the documents meta
+        for document_cls in STATE_DOCUMENTS:
+            collection = self.db[document_cls._get_collection_name()]
+            for index_spec in document_cls._meta['index_specs']:
+                index_opts = dict(index_spec)
+                await collection.create_index(index_opts.pop('fields'), background=True, **index_opts)
+
+    async def get_or_create_user(self, user_telegram_id=Hashable, user_device_type=Any) -> Dict:
+        user = await self.db[USER_COLLECTION].find_one({'_cls': HUMAN_CLS, 'user_telegram_id': user_telegram_id})
+        if user is None:
+            user = {'_cls': HUMAN_CLS,
+                    'user_telegram_id': user_telegram_id,
+                    'device_type': user_device_type,
+                    'persona': [],
+                    'profile': dict(HUMAN_SCHEMA['profile']),
+                    'attributes': {}}
+            result = await self.db[USER_COLLECTION].insert_one(user)
+            user['_id'] = result.inserted_id
+        return user
+
+    async def create_bot(self) -> Dict:
+        bot = {'_cls': BOT_CLS, 'persona': [], 'attributes': {}}
+        result = await self.db[USER_COLLECTION].insert_one(bot)
+        bot['_id'] = result.inserted_id
+        return bot
+
+    async def create_dialog(self, user: Dict, location, channel_type) -> DialogRecord:
+        bot = await self.create_bot()
+        dialog = {'location': location,
+                  'utterances': [],
+                  'channel_type': channel_type,
+                  'version': STATE_API_VERSION,
+                  'human': user['_id'],
+                  'bot': bot['_id']}
+        result = await self.db[DIALOG_COLLECTION].insert_one(dialog)
+        dialog['_id'] = result.inserted_id
+        return DialogRecord(dialog, user, bot, [])
+
+    async def get_utterances(self, utterance_ids: List[ObjectId]) -> List[Dict]:
+        if not utterance_ids:
+            return []
+        cursor = self.db[UTTERANCE_COLLECTION].find({'_id': {'$in': utterance_ids}})
+        utterances = {utt['_id']: utt async for utt in cursor}
+        return [utterances[utt_id] for utt_id in utterance_ids if utt_id in utterances]
+
+    async def get_or_create_dialog(self, user: Dict, location, channel_type, should_reset=False,
+                                   history_window: Optional[int] = None) -> DialogRecord:
+        if should_reset:
+            return await self.create_dialog(user, location, channel_type)
+
+        projection = None
+        if history_window is not None:
+            projection = {'utterances': {'$slice': -history_window}}
+        dialog = await self.db[DIALOG_COLLECTION].find_one({'human': user['_id']}, projection, sort=[('_id', -1)])
+        if dialog is None:
+            return await self.create_dialog(user, location, channel_type)
+
+        bot = await self.db[USER_COLLECTION].find_one({'_id': dialog['bot']})
+        utterances = await self.get_utterances(dialog['utterances'])
+        return DialogRecord(dialog, user, bot, utterances)
+
+    async def get_last_utterances(self, dialog_id: str, limit: Optional[int] = None) -> List[Dict]:
+        projection = {'utterances': 1} if limit is None else {'utterances': {'$slice': -limit}}
+        dialog = await self.db[DIALOG_COLLECTION].find_one({'_id': ObjectId(dialog_id)}, projection)
+        return [utterance_to_dict(utt) for utt in await self.get_utterances(dialog['utterances'])]
+
+    async def save_dialog_dicts(self, dialogs: List[Tuple[Dict, DialogRecord]],
+                                new_utterances: Optional[List[List[Dict]]] = None) -> None:
+        if new_utterances is None:
+            new_utterances = [self.get_new_utterances(dialog) for dialog, _ in dialogs]
+        utterance_docs = [utterance_from_dict(utt) for utt in chain(*new_utterances)]
+
+        if utterance_docs:
+            # utterances are upserted by id and added to dialogs only if missing, so a failed save may be retried
+            for doc in utterance_docs:
+                doc.setdefault('_id', ObjectId())
+            await self.db[UTTERANCE_COLLECTION].bulk_write([ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+                                                            for doc in utterance_docs], ordered=False)
+            utt_ids = iter(doc['_id'] for doc in utterance_docs)
+            dialog_updates = []
+            for (_, dialog_object), utterances in zip(dialogs, new_utterances):
+                if not utterances:
+                    continue
+                dialog_utt_ids = [next(utt_ids) for _ in utterances]
+                for utt, utt_id in zip(utterances, dialog_utt_ids):
+                    utt['id'] = str(utt_id)
+                dialog_updates.append(UpdateOne({'_id': dialog_object.id},
+                                                {'$addToSet': {'utterances': {'$each': dialog_utt_ids}}}))
+            await self.db[DIALOG_COLLECTION].bulk_write(dialog_updates, ordered=False)
+
+        for dialog, dialog_object in dialogs:
+            await self.update_user(dialog_object.human, human_to_dict(dialog_object.human), dialog['human'],
+                                   ('device_type', 'persona', 'profile', 'attributes'))
+            await self.update_user(dialog_object.bot, bot_to_dict(dialog_object.bot), dialog['bot'],
+                                   ('persona', 'attributes'))
+
+    async def save_dialog_dict(self, dialog: Dict, dialog_object: DialogRecord, payload=None, **kwargs):
+        await self.save_dialog_dicts([(dialog, dialog_object)])
+
+    async def update_user(self, user: Dict, saved_dict: Dict, user_dict: Dict, fields) -> None:
+        changed = {field: user_dict[field] for field in fields if user_dict[field] != saved_dict[field]}
+        if changed:
+            await self.db[USER_COLLECTION].update_one({'_id': user['_id']}, {'$set': changed})
+            user.update(changed)
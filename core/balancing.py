@@ -0,0 +1,107 @@
+import asyncio
+from contextlib import contextmanager
+from time import time
+from typing import Dict, List
+
+BALANCING_STRATEGIES = ('least_outstanding', 'ewma')
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency_ewma = None
+        self.ejected_until = 0.0
+        self.ejections = 0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def to_dict(self) -> Dict:
+        return {'outstanding': self.outstanding,
+                'requests': self.requests,
+                'failures': self.failures,
+                'latency_ewma': round(self.latency_ewma, 5) if self.latency_ewma is not None else None,
+                'ejected': not self.is_healthy(time()),
+                'ejections': self.ejections}
+
+
+class ReplicaRouter:
+    """Chooses a replica url of an HTTP service for every request.
+
+    Strategies:
+        * ``least_outstanding`` - replica with the least number of requests waiting for response;
+        * ``ewma`` - replica with the least latency EWMA weighted by its outstanding requests, replicas without
+          latency estimation are tried first.
+
+    A replica that failed ``max_failures`` requests in a row is ejected from balancing for ``ejection_sec`` seconds.
+    If all replicas are ejected, the one whose ejection expires first is used.
+    """
+
+    def __init__(self, urls: List[str], strategy: str = 'least_outstanding', max_failures: int = 3,
+                 ejection_sec: float = 30.0, ewma_alpha: float = 0.3):
+        if strategy not in BALANCING_STRATEGIES:
+            raise ValueError(f'unknown balancing strategy {strategy}, should be one of {BALANCING_STRATEGIES}')
+        if not urls:
+            raise ValueError('at least one replica url is required')
+        self.replicas = [Replica(url) for url in urls]
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.ejection_sec = ejection_sec
+        self.ewma_alpha = ewma_alpha
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def _cost(self, replica: Replica):
+        if self.strategy == 'ewma':
+            return (replica.latency_ewma or 0.0) * (replica.outstanding + 1), replica.outstanding
+        return replica.outstanding, replica.requests
+
+    def choose(self) -> Replica:
+        if len(self.replicas) == 1:
+            return self.replicas[0]
+        now = time()
+        healthy = [r for r in self.replicas if r.is_healthy(now)]
+        if not healthy:
+            return min(self.replicas, key=lambda r: r.ejected_until)
+        return min(healthy, key=self._cost)
+
+    @contextmanager
+    def route(self):
+        replica = self.choose()
+        replica.outstanding += 1
+        replica.requests += 1
+        start_time = time()
+        try:
+            yield replica.url
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._register_failure(replica)
+            raise
+        else:
+            self._register_success(replica, time() - start_time)
+        finally:
+            replica.outstanding -= 1
+
+    def _register_success(self, replica: Replica, latency: float) -> None:
+        replica.consecutive_failures = 0
+        if replica.latency_ewma is None:
+            replica.latency_ewma = latency
+        else:
+            replica.latency_ewma = self.ewma_alpha * latency + (1 - self.ewma_alpha) * replica.latency_ewma
+
+    def _register_failure(self, replica: Replica) -> None:
+        replica.failures += 1
+        replica.consecutive_failures += 1
+        if replica.consecutive_failures >= self.max_failures:
+            replica.consecutive_failures = 0
+            replica.ejected_until = time() + self.ejection_sec
+            replica.ejections += 1
+
+    def get_stats(self) -> Dict:
+        return {replica.url: replica.to_dict() for replica in self.replicas}
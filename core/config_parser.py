@@ -1,16 +1,18 @@
 from itertools import chain
 from copy import deepcopy
+from functools import partial
 
-import aiohttp
 import asyncio
 
 from core.transform_config import SKILLS, ANNOTATORS_1, ANNOTATORS_2, ANNOTATORS_3, SKILL_SELECTORS, \
-    RESPONSE_SELECTORS, POSTPROCESSORS
+    RESPONSE_SELECTORS, POSTPROCESSORS, HTTP_CONNECTION_POOL, SKILLS_QUORUM
 from core.connectors import HTTPConnector, ConfidenceResponseSelectorConnector, AioQueueConnector, \
-    QueueListenerBatchifyer, AgentGatewayToServiceConnector
-from core.pipeline import simple_workflow_formatter
+    QueueListenerBatchifyer, AgentGatewayToServiceConnector, BatchingStats
+from core.http_pool import HTTPSessionPool
+from core.pipeline import simple_workflow_formatter, history_window_workflow_formatter
 from core.service import Service
 from core.state_manager import StateManager
+from core.transport.payload_store import dialog_reference_workflow_formatter
 from core.transport.settings import TRANSPORT_SETTINGS
 
 
@@ -27,14 +29,18 @@ def add_bot_to_name(name):
     return f'bot_{name}'
 
 
+def prepare_http_pool():
+    return HTTPSessionPool(**HTTP_CONNECTION_POOL)
+
+
 def parse_old_config():
     services = []
     worker_tasks = []
-    session = None
+    session = None  # HTTPSessionPool shared by all http services
     gateway = None
 
     def make_service_from_config_rec(conf_record, sess, state_processor_method, tags, names_previous_services,
-                                     gate, name_modifier=None):
+                                     gate, name_modifier=None, quorum=None):
         _worker_tasks = []
         if name_modifier:
             name = name_modifier(conf_record['name'])
@@ -47,30 +53,46 @@ def parse_old_config():
         connector_func = None
 
         if conf_record['protocol'] == 'http':
-            sess = sess or aiohttp.ClientSession()
-            if batch_size == 1 and isinstance(url, str):
-                connector_func = HTTPConnector(sess, url, formatter, name).send
+            sess = sess or prepare_http_pool()
+            service_session = sess.get_session(conf_record)
+            router = sess.get_router(conf_record)
+            if batch_size == 1:
+                connector_func = HTTPConnector(service_session, url, formatter, name, router).send
             else:
-                queue = asyncio.Queue()
+                max_in_flight = conf_record.get('max_in_flight', 1) * len(router)
+                # by default as many requests may wait as fit into a full set of in-flight batches
+                queue = asyncio.Queue(conf_record.get('max_queue_size', batch_size * max_in_flight))
                 connector_func = AioQueueConnector(queue).send  # worker task and queue connector
-                if isinstance(url, str):
-                    urls = [url]
-                else:
-                    urls = url
-                for u in urls:
-                    _worker_tasks.append(QueueListenerBatchifyer(sess, u, formatter,
-                                                                 name, queue, batch_size))
+                # single worker routes batches between all service replicas
+                _worker_tasks.append(QueueListenerBatchifyer(service_session, url, formatter,
+                                                             name, queue, batch_size,
+                                                             conf_record.get('max_batch_wait_ms', 10),
+                                                             conf_record.get('target_batch_latency_ms'),
+                                                             BatchingStats(), max_in_flight, router))
 
         elif conf_record['protocol'] == 'AMQP':
             gate = gate or prepare_agent_gateway()
             connector_func = AgentGatewayToServiceConnector(to_service_callback=gate.send_to_service,
-                                                            service_name=name).send
+                                                            service_name=name,
+                                                            delivery_mode=conf_record.get('delivery_mode'),
+                                                            task_timeout=conf_record.get('task_timeout'),
+                                                            task_retries=conf_record.get('task_retries')).send
 
         if connector_func is None:
             raise ValueError(f'No connector function is defined while making a service {name}.')
 
+        history_window = conf_record.get('history_window')
+        if conf_record['protocol'] == 'AMQP' and TRANSPORT_SETTINGS.get('payload_store', {}).get('enabled'):
+            workflow_formatter = partial(dialog_reference_workflow_formatter, history_window=history_window,
+                                         dialog_fields=conf_record.get('dialog_fields'))
+        elif history_window:
+            workflow_formatter = partial(history_window_workflow_formatter, history_window=history_window)
+        else:
+            workflow_formatter = simple_workflow_formatter
+
         _service = Service(name, connector_func, state_processor_method, batch_size,
-                           tags, names_previous_services, simple_workflow_formatter)
+                           tags, names_previous_services, workflow_formatter, history_window,
+                           conf_record.get('timeout'), quorum)
 
         return _service, _worker_tasks, sess, gate
 
@@ -131,7 +153,7 @@ def parse_old_config():
                 'confidence_response_selector',
                 ConfidenceResponseSelectorConnector('confidence_response_selector').send,
                 StateManager.add_bot_utterance_simple_dict,
-                1, ['RESPONSE_SELECTORS'], previous_services, simple_workflow_formatter
+                1, ['RESPONSE_SELECTORS'], previous_services, simple_workflow_formatter, quorum=SKILLS_QUORUM
             )
         )
     else:
@@ -140,7 +162,7 @@ def parse_old_config():
                 make_service_from_config_rec(r, session,
                                              StateManager.add_bot_utterance_simple_dict,
                                              ['RESPONSE_SELECTORS'], previous_services,
-                                             gateway)
+                                             gateway, quorum=SKILLS_QUORUM)
             services.append(service)
             worker_tasks.extend(workers)
 
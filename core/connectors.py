@@ -1,80 +1,212 @@
 import asyncio
 import aiohttp
 import time
-from typing import Dict, Callable, List, Any
+from logging import getLogger
+from typing import Dict, Callable, List, Any, Optional
 
+from core.balancing import ReplicaRouter
+from core.http_pool import HTTPSessionPool
+from core.metrics import BATCH_SIZE, SERVICE_ERRORS
+from core.tracing import new_span_id
 from core.transport.base import ServiceGatewayConnectorBase
 
+logger = getLogger(__name__)
+
+
+def make_router(url) -> ReplicaRouter:
+    return ReplicaRouter([url] if isinstance(url, str) else list(url))
+
 
 class HTTPConnector:
-    def __init__(self, session: aiohttp.ClientSession, url: str, formatter: Callable, service_name: str):
+    def __init__(self, session: aiohttp.ClientSession, url: str, formatter: Callable, service_name: str,
+                 router: Optional[ReplicaRouter] = None):
         self.session = session
         self.url = url
         self.formatter = formatter
         self.service_name = service_name
+        self.router = router or make_router(url)
 
-    async def send(self, payload: Dict, callback: Callable):
+    async def send(self, payload: Dict, callback: Callable, trace_id: Optional[str] = None,
+                   turn_id: Optional[str] = None, **kwargs):
         formatted_payload = self.formatter([payload])
+        # W3C trace context, so services can attach their own spans to the turn trace
+        headers = {'traceparent': f'00-{trace_id}-{new_span_id()}-01'} if trace_id else None
         service_send_time = time.time()
-        async with aiohttp.ClientSession() as session:
-            async with session.post(self.url, json=formatted_payload) as resp:
-                response = await resp.json()
-                service_response_time = time.time()
-                await callback(
-                    dialog_id=payload['id'], service_name=self.service_name,
-                    response={self.service_name: self.formatter(response[0], mode='out')},
-                    service_send_time=service_send_time,
-                    service_response_time=service_response_time
-                )
+        try:
+            with self.router.route() as url:
+                async with self.session.post(url, json=formatted_payload, headers=headers) as resp:
+                    response = await resp.json()
+        except Exception:
+            SERVICE_ERRORS.inc(self.service_name)
+            logger.exception(f'{self.service_name} request failed')
+            # the service is skipped, as if it timed out
+            await callback(dialog_id=payload['id'], service_name=self.service_name, response=None,
+                           turn_id=turn_id)
+            return
+        service_response_time = time.time()
+        await callback(
+            dialog_id=payload['id'], service_name=self.service_name,
+            response={self.service_name: self.formatter(response[0], mode='out')},
+            service_send_time=service_send_time,
+            service_response_time=service_response_time,
+            turn_id=turn_id
+        )
 
 
 class AioQueueConnector:
     def __init__(self, queue):
         self.queue = queue
 
-    async def send(self, payload: Dict, **kwargs):
-        await self.queue.put(payload)
+    async def send(self, payload: Dict, turn_id: Optional[str] = None, trace_id: Optional[str] = None, **kwargs):
+        await self.queue.put((time.time(), payload, turn_id, trace_id))
+
+
+class BatchingStats:
+    def __init__(self):
+        self.batches = 0
+        self.items = 0
+        self.capacity = 0
+        self.queue_delay = 0.0
+        self.max_queue_delay = 0.0
+
+    def register_batch(self, batch_size_limit: int, queue_delays: List[float]) -> None:
+        self.batches += 1
+        self.items += len(queue_delays)
+        self.capacity += batch_size_limit
+        self.queue_delay += sum(queue_delays)
+        self.max_queue_delay = max(self.max_queue_delay, *queue_delays)
+
+    def to_dict(self) -> Dict:
+        return {'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': round(self.items / self.batches, 5) if self.batches else None,
+                'fill_ratio': round(self.items / self.capacity, 5) if self.capacity else None,
+                'queue_delay_mean': round(self.queue_delay / self.items, 5) if self.items else None,
+                'queue_delay_max': round(self.max_queue_delay, 5)}
 
 
 class QueueListenerBatchifyer:
-    def __init__(self, session, url, formatter, service_name, queue, batch_size):
+    """Collects batches from the service queue and sends them to the service url.
+
+    The worker blocks until the first item arrives, then collects up to the current batch size limit, waiting no
+    longer than ``max_batch_wait_ms`` for the batch to fill. If ``target_batch_latency_ms`` is set, the batch size
+    limit adapts to the smoothed service latency: it is halved while the latency exceeds the target and grows by one
+    (up to ``batch_size``) otherwise.
+
+    Every batch is sent to one of the service replicas chosen by the replica router.
+    Up to ``max_in_flight`` batches may wait for the service response at once. When the limit is hit, the worker stops
+    taking requests from the queue until one of the batches is answered. Responses are passed to the agent in detached
+    tasks, so a slow downstream chain does not hold the worker.
+    """
+
+    def __init__(self, session, url, formatter, service_name, queue, batch_size, max_batch_wait_ms=10,
+                 target_batch_latency_ms=None, stats=None, max_in_flight=1, router=None):
         self.session = session
         self.url = url
+        self.router = router or make_router(url)
         self.formatter = formatter
         self.service_name = service_name
         self.queue = queue
         self.batch_size = batch_size
+        self.max_batch_wait = max_batch_wait_ms / 1000
+        self.target_batch_latency = target_batch_latency_ms / 1000 if target_batch_latency_ms else None
+        self.current_batch_size = batch_size
+        self.latency_ewma = None
+        self.stats = stats or BatchingStats()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.detached_tasks = set()
+
+    async def collect_batch(self):
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_batch_wait
+        while len(batch) < self.current_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            # asyncio.wait does not cancel the getter on timeout, so a cancelled get never loses a queue item
+            getter = asyncio.ensure_future(self.queue.get())
+            await asyncio.wait({getter}, timeout=timeout)
+            if not getter.done():
+                getter.cancel()
+                break
+            batch.append(getter.result())
+        return batch
+
+    def adapt_batch_size(self, latency: float) -> None:
+        if self.target_batch_latency is None:
+            return
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        if self.latency_ewma > self.target_batch_latency:
+            self.current_batch_size = max(1, self.current_batch_size // 2)
+        elif self.current_batch_size < self.batch_size:
+            self.current_batch_size += 1
 
     async def call_service(self, process_callable):
         while True:
-            batch = []
-            rest = self.queue.qsize()
-            for i in range(min(self.batch_size, rest)):
-                item = await self.queue.get()
-                batch.append(item)
-            if batch:
-                tasks = []
-                formatted_payload = self.formatter(batch)
-                service_send_time = time.time()
-                async with self.session.post(self.url, json=formatted_payload) as resp:
+            await self.in_flight.acquire()
+            queued_batch = await self.collect_batch()
+            self._run_detached(self.process_batch(queued_batch, process_callable))
+
+    async def process_batch(self, queued_batch, process_callable):
+        try:
+            batch_size_limit = self.current_batch_size
+            service_send_time = time.time()
+            enqueue_times, batch, turn_ids, trace_ids = zip(*queued_batch)
+            self.stats.register_batch(batch_size_limit, [service_send_time - t for t in enqueue_times])
+            BATCH_SIZE.observe(len(batch), self.service_name)
+            formatted_payload = self.formatter(list(batch))
+            with self.router.route() as url:
+                async with self.session.post(url, json=formatted_payload) as resp:
                     response = await resp.json()
-                    service_response_time = time.time()
-                for dialog, response_text in zip(batch, response):
-                    tasks.append(
-                        process_callable(
-                            dialog_id=dialog['id'], service_name=self.service_name,
-                            response={self.service_name: self.formatter(response_text, mode='out')},
-                            service_send_time=service_send_time,
-                            service_response_time=service_response_time))
-                await asyncio.gather(*tasks)
-            await asyncio.sleep(0.1)
+            service_response_time = time.time()
+        except Exception:
+            SERVICE_ERRORS.inc(self.service_name)
+            logger.exception(f'{self.service_name} batch request failed')
+            self.skip_batch(queued_batch, process_callable)
+            return
+        finally:
+            self.in_flight.release()
+
+        self.adapt_batch_size(service_response_time - service_send_time)
+        if len(response) != len(batch):
+            SERVICE_ERRORS.inc(self.service_name)
+            logger.error(f'{self.service_name} returned {len(response)} responses to a batch of {len(batch)}')
+        for dialog, turn_id, trace_id, response_text in zip(batch, turn_ids, trace_ids, response):
+            self._run_detached(
+                process_callable(
+                    dialog_id=dialog['id'], service_name=self.service_name,
+                    response={self.service_name: self.formatter(response_text, mode='out')},
+                    service_send_time=service_send_time,
+                    service_response_time=service_response_time,
+                    turn_id=turn_id, trace_id=trace_id))
+        self.skip_batch(queued_batch[len(response):], process_callable)
+
+    def skip_batch(self, queued_batch, process_callable):
+        # the service is skipped for dialogs of the batch without a response, as if it timed out
+        for _, dialog, turn_id, trace_id in queued_batch:
+            self._run_detached(process_callable(dialog_id=dialog['id'], service_name=self.service_name,
+                                                response=None, turn_id=turn_id, trace_id=trace_id))
+
+    def _run_detached(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.detached_tasks.add(task)
+        task.add_done_callback(self._on_detached_done)
+
+    def _on_detached_done(self, task):
+        self.detached_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f'{self.service_name} batch processing failed', exc_info=task.exception())
 
 
 class ConfidenceResponseSelectorConnector:
     def __init__(self, service_name: str):
         self.service_name = service_name
 
-    async def send(self, payload: Dict, callback: Callable):
+    async def send(self, payload: Dict, callback: Callable, turn_id: Optional[str] = None, **kwargs):
         service_send_time = time.time()
         response = payload['utterances'][-1]['hypotheses']
         best_skill = sorted(response, key=lambda x: x['confidence'], reverse=True)[0]
@@ -83,7 +215,8 @@ class ConfidenceResponseSelectorConnector:
             dialog_id=payload['id'], service_name=self.service_name,
             response={'confidence_response_selector': best_skill},
             service_send_time=service_send_time,
-            service_response_time=response_time)
+            service_response_time=response_time,
+            turn_id=turn_id)
 
 
 class HttpOutputConnector:
@@ -91,7 +224,7 @@ class HttpOutputConnector:
         self.intermediate_storage = intermediate_storage
         self.service_name = service_name
 
-    async def send(self, payload: Dict, callback: Callable):
+    async def send(self, payload: Dict, callback: Callable, turn_id: Optional[str] = None, **kwargs):
         message_uuid = payload['message_uuid']
         event = payload['event']
         response_text = payload
@@ -103,14 +236,15 @@ class HttpOutputConnector:
                        service_name=self.service_name,
                        response=response_text,
                        service_send_time=service_send_time,
-                       service_response_time=service_response_time)
+                       service_response_time=service_response_time,
+                       turn_id=turn_id)
 
 
 class EventSetOutputConnector:
     def __init__(self, service_name: str):
         self.service_name = service_name
 
-    async def send(self, payload: Dict, callback: Callable):
+    async def send(self, payload: Dict, callback: Callable, turn_id: Optional[str] = None, **kwargs):
         event = payload.get('event', None)
         service_send_time = time.time()
         if not event or not isinstance(event, asyncio.Event):
@@ -121,7 +255,8 @@ class EventSetOutputConnector:
                        service_name=self.service_name,
                        response=" ",
                        service_send_time=service_send_time,
-                       service_response_time=service_response_time)
+                       service_response_time=service_response_time,
+                       turn_id=turn_id)
 
 
 class AgentGatewayToChannelConnector:
@@ -131,13 +266,23 @@ class AgentGatewayToChannelConnector:
 class AgentGatewayToServiceConnector:
     _to_service_callback: Callable
     _service_name: str
+    _delivery_mode: Optional[str]
+    _task_timeout: Optional[float]
+    _task_retries: Optional[int]
 
-    def __init__(self, to_service_callback: Callable, service_name: str):
+    def __init__(self, to_service_callback: Callable, service_name: str, delivery_mode: Optional[str] = None,
+                 task_timeout: Optional[float] = None, task_retries: Optional[int] = None):
         self._to_service_callback = to_service_callback
         self._service_name = service_name
+        self._delivery_mode = delivery_mode
+        self._task_timeout = task_timeout
+        self._task_retries = task_retries
 
-    async def send(self, payload: Dict, **_kwargs):
-        await self._to_service_callback(dialog=payload, service_name=self._service_name)
+    async def send(self, payload: Dict, trace_id: Optional[str] = None, turn_id: Optional[str] = None,
+                   task_uuid: Optional[str] = None, **_kwargs):
+        await self._to_service_callback(dialog=payload, service_name=self._service_name, trace_id=trace_id,
+                                        turn_id=turn_id, task_uuid=task_uuid, delivery_mode=self._delivery_mode,
+                                        task_timeout=self._task_timeout, task_retries=self._task_retries)
 
 
 class ServiceGatewayHTTPConnector(ServiceGatewayConnectorBase):
@@ -145,9 +290,10 @@ class ServiceGatewayHTTPConnector(ServiceGatewayConnectorBase):
     _url: str
     _service_name: str
 
-    def __init__(self, service_config: dict, formatter: Callable) -> None:
+    def __init__(self, service_config: dict, formatter: Callable,
+                 session: Optional[aiohttp.ClientSession] = None) -> None:
         super().__init__(service_config, formatter)
-        self._session = aiohttp.ClientSession()
+        self._session = session or HTTPSessionPool().get_session(service_config)
         self._service_name = service_config['name']
         self._url = service_config['url']
 
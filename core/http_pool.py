@@ -0,0 +1,125 @@
+from collections import defaultdict
+from time import monotonic
+from typing import Dict, Optional
+
+import aiohttp
+
+from core.balancing import ReplicaRouter
+
+POOL_SETTINGS_KEY = 'connection_pool'
+
+
+class PoolStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.queued = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def to_dict(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / requests, 5) if requests else None,
+                'queued': self.queued,
+                'wait_time_total': round(self.wait_time, 5),
+                'wait_time_mean': round(self.wait_time / self.queued, 5) if self.queued else 0.0,
+                'wait_time_max': round(self.max_wait_time, 5)}
+
+
+class HTTPSessionPool:
+    """Agent-owned keep-alive HTTP sessions shared by all HTTP connectors.
+
+    Services without their own ``connection_pool`` settings share the default session. A service with
+    ``connection_pool`` settings in its config gets a dedicated session with these TCPConnector limits.
+    Connection reuse (hit), new connections (miss) and time spent waiting for a free connection are collected
+    per pool and remote host.
+
+    The pool also keeps replica routers of HTTP services, so services sharing the same replicas (e.g. annotators
+    and their bot annotator twins) share outstanding requests and health state.
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 0, keepalive_timeout: float = 15.0,
+                 ttl_dns_cache: Optional[int] = 10):
+        self._default_settings = {'limit': limit,
+                                  'limit_per_host': limit_per_host,
+                                  'keepalive_timeout': keepalive_timeout,
+                                  'ttl_dns_cache': ttl_dns_cache}
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._stats: Dict[str, Dict[str, PoolStats]] = defaultdict(lambda: defaultdict(PoolStats))
+        self._routers: Dict[str, ReplicaRouter] = {}
+
+    def get_session(self, service_config: Optional[Dict] = None) -> aiohttp.ClientSession:
+        pool_settings = (service_config or {}).get(POOL_SETTINGS_KEY)
+        pool_name = service_config['name'] if pool_settings else 'default'
+
+        session = self._sessions.get(pool_name)
+        if session is None or session.closed:
+            session = self._make_session(pool_name, {**self._default_settings, **(pool_settings or {})})
+            self._sessions[pool_name] = session
+        return session
+
+    def get_router(self, service_config: Dict) -> ReplicaRouter:
+        service_name = service_config['name']
+        router = self._routers.get(service_name)
+        if router is None:
+            urls = service_config['url']
+            router = ReplicaRouter([urls] if isinstance(urls, str) else list(urls),
+                                   strategy=service_config.get('balancing_strategy', 'least_outstanding'),
+                                   max_failures=service_config.get('max_replica_failures', 3),
+                                   ejection_sec=service_config.get('replica_ejection_sec', 30.0))
+            self._routers[service_name] = router
+        return router
+
+    def _make_session(self, pool_name: str, settings: Dict) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(limit=settings['limit'],
+                                         limit_per_host=settings['limit_per_host'],
+                                         keepalive_timeout=settings['keepalive_timeout'],
+                                         ttl_dns_cache=settings['ttl_dns_cache'])
+        return aiohttp.ClientSession(connector=connector, trace_configs=[self._make_trace_config(pool_name)])
+
+    def _make_trace_config(self, pool_name: str) -> aiohttp.TraceConfig:
+        pool_stats = self._stats[pool_name]
+
+        async def on_request_start(session, ctx, params):
+            ctx.stats = pool_stats[f'{params.url.host}:{params.url.port}']
+
+        async def on_connection_queued_start(session, ctx, params):
+            ctx.queued_start = monotonic()
+
+        async def on_connection_queued_end(session, ctx, params):
+            wait_time = monotonic() - ctx.queued_start
+            ctx.stats.queued += 1
+            ctx.stats.wait_time += wait_time
+            ctx.stats.max_wait_time = max(ctx.stats.max_wait_time, wait_time)
+
+        async def on_connection_reuseconn(session, ctx, params):
+            ctx.stats.hits += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            ctx.stats.misses += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return trace_config
+
+    def get_stats(self) -> Dict:
+        return {pool_name: {host: stats.to_dict() for host, stats in hosts.items()}
+                for pool_name, hosts in self._stats.items()}
+
+    def get_replicas_stats(self) -> Dict:
+        return {service_name: router.get_stats() for service_name, router in self._routers.items()}
+
+    @property
+    def closed(self) -> bool:
+        return all(session.closed for session in self._sessions.values())
+
+    async def close(self) -> None:
+        for session in self._sessions.values():
+            if not session.closed:
+                await session.close()
@@ -0,0 +1,188 @@
+from collections import OrderedDict
+from copy import deepcopy
+from time import monotonic
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from bson import ObjectId
+
+from core.state_manager import StateManager
+from core.state_schema import HUMAN_SCHEMA
+
+HUMAN_FIELDS = ('device_type', 'persona', 'profile', 'attributes')
+BOT_FIELDS = ('persona', 'attributes')
+
+
+def human_to_dict(human: Dict) -> Dict:
+    return {'id': human['_id'],
+            'user_telegram_id': str(human['user_telegram_id']),
+            'user_type': 'human',
+            **{field: deepcopy(human[field]) for field in HUMAN_FIELDS}}
+
+
+def bot_to_dict(bot: Dict) -> Dict:
+    return {'id': bot['_id'],
+            'user_type': 'bot',
+            **{field: deepcopy(bot[field]) for field in BOT_FIELDS}}
+
+
+class MemoryDialogRecord:
+    """Dialog kept by MemoryStateManager, a counterpart of core.state_schema.Dialog for the agent."""
+
+    def __init__(self, dialog: Dict, human: Dict, bot: Dict, history_window: Optional[int] = None):
+        self.dialog = dialog
+        self.human = human
+        self.bot = bot
+        self.history_window = history_window
+        self.access_time = monotonic()
+
+    @property
+    def id(self):
+        return self.dialog['_id']
+
+    def to_dict(self) -> Dict:
+        utterances = self.dialog['utterances']
+        if self.history_window is not None:
+            utterances = utterances[-self.history_window:]
+        return {
+            'id': self.id,
+            'location': self.dialog['location'],
+            'utterances': deepcopy(utterances),
+            'channel_type': self.dialog['channel_type'],
+            'human': human_to_dict(self.human),
+            'bot': bot_to_dict(self.bot)
+        }
+
+
+class MemoryStateStats:
+    def __init__(self):
+        self.created_dialogs = 0
+        self.evicted_dialogs = 0
+        self.evicted_users = 0
+
+    def to_dict(self):
+        return {'created_dialogs': self.created_dialogs,
+                'evicted_dialogs': self.evicted_dialogs,
+                'evicted_users': self.evicted_users}
+
+
+class MemoryStateManager(StateManager):
+    """State manager keeping users and dialogs in the agent process memory, no database is used.
+
+    Dialogs not accessed for ``idle_ttl_sec`` seconds are evicted, when there are more than ``max_dialogs``
+    dialogs the least recently used ones are evicted. A user is evicted with the last of their dialogs, a dialog
+    keeps up to ``max_dialog_utterances`` last utterances. All state is lost when the agent process stops,
+    so it is meant for tests, benchmarks and deployments which do not need dialog history persistence.
+    """
+
+    def __init__(self, max_dialogs: Optional[int] = 100000, idle_ttl_sec: Optional[float] = 3600,
+                 max_dialog_utterances: Optional[int] = None):
+        self.max_dialogs = max_dialogs
+        self.idle_ttl_sec = idle_ttl_sec
+        self.max_dialog_utterances = max_dialog_utterances
+        self.stats = MemoryStateStats()
+        self._humans: Dict[str, Dict] = {}
+        self._dialogs: Dict[str, MemoryDialogRecord] = OrderedDict()
+        self._human_dialogs: Dict[str, List[str]] = {}
+
+    def ensure_indexes(self) -> None:
+        pass
+
+    def _touch(self, record: MemoryDialogRecord) -> None:
+        record.access_time = monotonic()
+        if record.id in self._dialogs:
+            self._dialogs.move_to_end(record.id)
+        else:
+            # evicted during the turn, saving restores it
+            self._add_dialog(record)
+
+    def _add_dialog(self, record: MemoryDialogRecord) -> None:
+        self._dialogs[record.id] = record
+        human = record.human
+        self._humans.setdefault(str(human['user_telegram_id']), human)
+        self._human_dialogs.setdefault(human['_id'], []).append(record.id)
+
+    def evict(self) -> None:
+        now = monotonic()
+        while self._dialogs:
+            record = next(iter(self._dialogs.values()))
+            expired = self.idle_ttl_sec is not None and now - record.access_time > self.idle_ttl_sec
+            if not expired and (self.max_dialogs is None or len(self._dialogs) <= self.max_dialogs):
+                break
+            self._remove_dialog(record)
+
+    def _remove_dialog(self, record: MemoryDialogRecord) -> None:
+        del self._dialogs[record.id]
+        self.stats.evicted_dialogs += 1
+        human_dialogs = self._human_dialogs[record.human['_id']]
+        human_dialogs.remove(record.id)
+        if not human_dialogs:
+            del self._human_dialogs[record.human['_id']]
+            self._humans.pop(str(record.human['user_telegram_id']), None)
+            self.stats.evicted_users += 1
+
+    def get_or_create_user(self, user_telegram_id=Hashable, user_device_type=Any) -> Dict:
+        user = self._humans.get(str(user_telegram_id))
+        if user is None:
+            user = {'_id': str(ObjectId()),
+                    'user_telegram_id': user_telegram_id,
+                    'device_type': user_device_type,
+                    'persona': [],
+                    'profile': deepcopy(HUMAN_SCHEMA['profile']),
+                    'attributes': {}}
+            self._humans[str(user_telegram_id)] = user
+        return user
+
+    def create_dialog(self, user: Dict, location, channel_type) -> MemoryDialogRecord:
+        bot = {'_id': str(ObjectId()), 'persona': [], 'attributes': {}}
+        dialog = {'_id': str(ObjectId()), 'location': location, 'channel_type': channel_type, 'utterances': []}
+        record = MemoryDialogRecord(dialog, user, bot)
+        self._add_dialog(record)
+        self.stats.created_dialogs += 1
+        return record
+
+    def get_or_create_dialog(self, user: Dict, location, channel_type, should_reset=False,
+                             history_window: Optional[int] = None) -> MemoryDialogRecord:
+        dialog_ids = self._human_dialogs.get(user['_id'])
+        if should_reset or not dialog_ids:
+            record = self.create_dialog(user, location, channel_type)
+        else:
+            record = self._dialogs[dialog_ids[-1]]
+            self._touch(record)
+        self.evict()
+        # records are shared by turns of the dialog, so the window of a turn is kept in a copy
+        record = MemoryDialogRecord(record.dialog, record.human, record.bot, history_window)
+        return record
+
+    def get_last_utterances(self, dialog_id: str, limit: Optional[int] = None) -> List[Dict]:
+        record = self._dialogs.get(dialog_id)
+        if record is None:
+            return []
+        utterances = record.dialog['utterances']
+        return deepcopy(utterances[-limit:] if limit is not None else utterances)
+
+    def save_dialog_dicts(self, dialogs: List[Tuple[Dict, MemoryDialogRecord]],
+                          new_utterances: Optional[List[List[Dict]]] = None) -> None:
+        if new_utterances is None:
+            new_utterances = [self.get_new_utterances(dialog) for dialog, _ in dialogs]
+        for (dialog, record), utterances in zip(dialogs, new_utterances):
+            for utt in utterances:
+                if not utt['id']:
+                    utt['id'] = str(ObjectId())
+            stored_utterances = record.dialog['utterances']
+            # utterances stored by a previous attempt of the save are skipped
+            stored_ids = {utt['id'] for utt in stored_utterances[-len(utterances):]} if utterances else set()
+            stored_utterances.extend(deepcopy([utt for utt in utterances if utt['id'] not in stored_ids]))
+            if self.max_dialog_utterances is not None and len(stored_utterances) > self.max_dialog_utterances:
+                del stored_utterances[:-self.max_dialog_utterances]
+            record.human.update({field: deepcopy(dialog['human'][field]) for field in HUMAN_FIELDS})
+            record.bot.update({field: deepcopy(dialog['bot'][field]) for field in BOT_FIELDS})
+            self._touch(self._dialogs.get(record.id, record))
+
+    def save_dialog_dict(self, dialog: Dict, dialog_object: MemoryDialogRecord, payload=None, **kwargs):
+        self.save_dialog_dicts([(dialog, dialog_object)])
+
+    def get_stats(self) -> Dict:
+        return {'dialogs': len(self._dialogs),
+                'users': len(self._humans),
+                'utterances': sum(len(record.dialog['utterances']) for record in self._dialogs.values()),
+                **self.stats.to_dict()}
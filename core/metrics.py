@@ -0,0 +1,143 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    labels = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f'{{{labels}}}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.metric_type}']
+        lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, value: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        return [(self.name, _format_labels(self.labelnames, labels), value)
+                for labels, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """Gauge which values are set directly or collected by a function on each scrape."""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._function: Optional[Callable[[], Dict[tuple, float]]] = None
+
+    def set(self, value: float, *labels) -> None:
+        self._values[labels] = value
+
+    def set_function(self, function: Callable[[], Dict[tuple, float]]) -> None:
+        self._function = function
+
+    def samples(self):
+        values = self._function() if self._function else self._values
+        return [(self.name, _format_labels(self.labelnames, labels), value) for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # per labels: non-cumulative bucket counts and sum, counts are accumulated on render
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        data = self._values.get(labels)
+        if data is None:
+            data = self._values[labels] = [[0] * len(self.buckets), 0.0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def samples(self):
+        result = []
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                result.append((f'{self.name}_bucket',
+                               _format_labels(self.labelnames + ('le',), labels + (_format_value(bound),)),
+                               cumulative))
+            label_str = _format_labels(self.labelnames, labels)
+            result.append((f'{self.name}_sum', label_str, total))
+            result.append((f'{self.name}_count', label_str, cumulative))
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+SERVICE_LATENCY = REGISTRY.register(Histogram(
+    'dp_agent_service_latency_seconds', 'Time from sending a task to a service to processing its response by agent',
+    ('service',)))
+SERVICE_RESPONSE_TIME = REGISTRY.register(Histogram(
+    'dp_agent_service_response_seconds', 'Time from the service request to the service response', ('service',)))
+SERVICE_ERRORS = REGISTRY.register(Counter(
+    'dp_agent_service_errors_total', 'Failed service calls', ('service',)))
+TURN_LATENCY = REGISTRY.register(Histogram(
+    'dp_agent_turn_seconds', 'Time from registering a user utterance to the agent response'))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    'dp_agent_batch_size', 'Sizes of batches sent to services', ('service',), BATCH_SIZE_BUCKETS))
+DB_CALL_LATENCY = REGISTRY.register(Histogram(
+    'dp_agent_db_call_seconds', 'State manager calls latency', ('operation',)))
+IN_FLIGHT_DIALOGS = REGISTRY.register(Gauge(
+    'dp_agent_in_flight_dialogs', 'Dialogs with a turn in progress'))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'dp_agent_queue_depth', 'Tasks waiting in agent queues', ('queue',)))
+SERVICE_IN_FLIGHT_TASKS = REGISTRY.register(Gauge(
+    'dp_agent_service_in_flight_tasks', 'Tasks sent to services over the transport and not answered yet',
+    ('service',)))
@@ -0,0 +1,248 @@
+import asyncio
+from collections import OrderedDict
+from copy import deepcopy
+from logging import getLogger
+from time import monotonic
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+
+from core.agent import await_if_needed
+from core.state_manager import StateManager
+
+logger = getLogger(__name__)
+
+
+def get_user_id(user) -> str:
+    return str(user['_id'] if isinstance(user, dict) else user.id)
+
+
+class PendingSave:
+    def __init__(self, dialog: Dict, dialog_object, enqueue_time: float):
+        self.dialog = dialog
+        self.dialog_object = dialog_object
+        self.new_utterances: List[Dict] = []
+        self.enqueue_time = enqueue_time
+
+
+class PendingDialog:
+    """Dialog which state is not persisted yet, returned instead of reading a stale dialog from the DB."""
+
+    def __init__(self, pending: PendingSave, history_window: Optional[int] = None):
+        self.pending = pending
+        self.history_window = history_window
+
+    @property
+    def id(self):
+        return self.pending.dialog_object.id
+
+    def to_dict(self) -> Dict:
+        dialog = deepcopy(self.pending.dialog)
+        if self.history_window is not None:
+            dialog['utterances'] = dialog['utterances'][-self.history_window:]
+        return dialog
+
+
+class WriteBehindStats:
+    def __init__(self):
+        self.enqueued = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed_dialogs = 0
+        self.failed_flushes = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.last_flush_time = 0.0
+        self.max_lag = 0.0
+
+    def register_flush(self, dialogs_count: int, flush_time: float, lag: float):
+        self.flushes += 1
+        self.flushed_dialogs += dialogs_count
+        self.flush_time += flush_time
+        self.max_flush_time = max(self.max_flush_time, flush_time)
+        self.last_flush_time = flush_time
+        self.max_lag = max(self.max_lag, lag)
+
+    def to_dict(self):
+        return {'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'flushes': self.flushes,
+                'flushed_dialogs': self.flushed_dialogs,
+                'failed_flushes': self.failed_flushes,
+                'mean_flush_batch': round(self.flushed_dialogs / self.flushes, 3) if self.flushes else None,
+                'flush_time_mean': round(self.flush_time / self.flushes, 5) if self.flushes else 0.0,
+                'flush_time_max': round(self.max_flush_time, 5),
+                'flush_time_last': round(self.last_flush_time, 5),
+                'lag_max': round(self.max_lag, 5)}
+
+
+class WriteBehindStateManager:
+    """Write-behind wrapper of a state manager.
+
+    ``save_dialog_dict`` only puts the dialog state to the queue of pending saves and returns, a background
+    persister saves queued dialogs with ``save_dialog_dicts`` of the wrapped state manager in batches. Several
+    turns of the same dialog waiting in the queue are coalesced into one save. A dialog with a pending save is
+    served from the queue, so the next turn never reads a stale state from the DB.
+
+    Durability: a saved turn reaches the DB at most ``max_lag_sec`` seconds later (plus flush time), pending saves
+    are flushed on ``close``. A failed batch is queued again and retried with a backoff growing up to
+    ``max_lag_sec``, saves of the wrapped state manager upsert utterances by id, so a retry does not duplicate
+    them. Turns queued when the agent process is killed, or still failing to save when it is closed, are lost.
+    When ``max_pending`` dialogs are queued, ``save_dialog_dict`` waits for the next flush.
+
+    Utterances get their ids when they are queued, all other methods are delegated to the wrapped state manager.
+    """
+
+    def __init__(self, state_manager: StateManager, max_lag_sec: float = 1.0, max_pending: int = 1000,
+                 flush_batch_size: int = 100):
+        self.state_manager = state_manager
+        self.max_lag_sec = max_lag_sec
+        self.max_pending = max_pending
+        self.flush_batch_size = flush_batch_size
+        self.stats = WriteBehindStats()
+        self._retry_delay = 0.0
+        self._retry_time = 0.0
+        self._pending: Dict[str, PendingSave] = OrderedDict()
+        self._flushing: Dict[str, PendingSave] = {}
+        self._user_dialogs: Dict[str, str] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flushed: Optional[asyncio.Event] = None
+        self._persister: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def __getattr__(self, item):
+        return getattr(self.state_manager, item)
+
+    def _ensure_persister(self):
+        if self._persister is None or self._persister.done():
+            self._wakeup = asyncio.Event()
+            self._flushed = asyncio.Event()
+            self._persister = asyncio.ensure_future(self._run_persister())
+
+    def _get_pending(self, dialog_id: str) -> Optional[PendingSave]:
+        return self._pending.get(dialog_id) or self._flushing.get(dialog_id)
+
+    async def get_or_create_dialog(self, user, location, channel_type, should_reset=False,
+                                   history_window: Optional[int] = None):
+        if not should_reset:
+            dialog_id = self._user_dialogs.get(get_user_id(user))
+            pending = dialog_id and self._get_pending(dialog_id)
+            if pending:
+                return PendingDialog(pending, history_window)
+        return await await_if_needed(self.state_manager.get_or_create_dialog(
+            user, location, channel_type, should_reset=should_reset, history_window=history_window))
+
+    async def get_last_utterances(self, dialog_id: str, limit: Optional[int] = None) -> List[Dict]:
+        utterances = await await_if_needed(self.state_manager.get_last_utterances(dialog_id, limit))
+        pending = self._get_pending(dialog_id)
+        if pending:
+            pending_ids = {utt['id'] for utt in pending.new_utterances}
+            utterances = [utt for utt in utterances if utt['id'] not in pending_ids] + pending.new_utterances
+            if limit is not None:
+                utterances = utterances[-limit:]
+        return utterances
+
+    async def save_dialog_dict(self, dialog: Dict, dialog_object, payload=None, **kwargs):
+        if self._closed:
+            raise RuntimeError('write-behind state manager is closed')
+        self._ensure_persister()
+        while len(self._pending) >= self.max_pending and dialog['id'] not in self._pending:
+            self._wakeup.set()
+            await self._flushed.wait()
+
+        new_utterances = self.get_new_utterances(dialog)
+        for utt in new_utterances:
+            utt['id'] = str(ObjectId())
+
+        if isinstance(dialog_object, PendingDialog):
+            dialog_object = dialog_object.pending.dialog_object
+        pending = self._pending.get(dialog['id'])
+        if pending is None:
+            pending = PendingSave(dialog, dialog_object, monotonic())
+            self._pending[dialog['id']] = pending
+            if len(self._pending) == 1:
+                # persister sleeps without timeout on the empty queue
+                self._wakeup.set()
+        else:
+            pending.dialog = dialog
+            self.stats.coalesced += 1
+        pending.new_utterances.extend(new_utterances)
+        self._user_dialogs[dialog['human']['id']] = dialog['id']
+        self.stats.enqueued += 1
+
+        if len(self._pending) >= self.flush_batch_size:
+            self._wakeup.set()
+
+    async def _run_persister(self):
+        while not self._closed or self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._time_to_flush())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if monotonic() < self._retry_time:
+                continue
+            batch_ready = self._closed or len(self._pending) >= min(self.flush_batch_size, self.max_pending)
+            if self._pending and (batch_ready or self._time_to_flush() <= 0):
+                await self.flush_batch()
+
+    def _time_to_flush(self) -> Optional[float]:
+        if not self._pending:
+            return None
+        oldest = next(iter(self._pending.values()))
+        return max(oldest.enqueue_time + self.max_lag_sec - monotonic(), self._retry_time - monotonic(), 0)
+
+    async def flush_batch(self) -> None:
+        batch = []
+        while self._pending and len(batch) < self.flush_batch_size:
+            batch.append(self._pending.popitem(last=False))
+        self._flushing.update(batch)
+        start_time = monotonic()
+        try:
+            await await_if_needed(self.state_manager.save_dialog_dicts(
+                [(pending.dialog, pending.dialog_object) for _, pending in batch],
+                [pending.new_utterances for _, pending in batch]))
+        except Exception:
+            self.stats.failed_flushes += 1
+            if self._closed:
+                logger.exception(f'failed to save {len(batch)} dialogs on close, their last turns are lost')
+            else:
+                self._retry_delay = min(max(self._retry_delay * 2, 0.05), self.max_lag_sec)
+                self._retry_time = monotonic() + self._retry_delay
+                logger.exception(f'failed to save {len(batch)} dialogs, retrying in {self._retry_delay:.2f} s')
+                self.requeue(batch)
+        else:
+            self._retry_delay = 0.0
+            flush_time = monotonic() - start_time
+            self.stats.register_flush(len(batch), flush_time, monotonic() - batch[0][1].enqueue_time)
+        finally:
+            for dialog_id, pending in batch:
+                del self._flushing[dialog_id]
+                user_id = pending.dialog['human']['id']
+                if self._user_dialogs.get(user_id) == dialog_id and not self._get_pending(dialog_id):
+                    del self._user_dialogs[user_id]
+            self._flushed.set()
+            self._flushed.clear()
+
+    def requeue(self, batch: List) -> None:
+        # saves queued while the batch was flushing are newer, the failed ones are merged before them
+        for dialog_id, pending in reversed(batch):
+            newer = self._pending.get(dialog_id)
+            if newer is not None:
+                newer.new_utterances[:0] = pending.new_utterances
+                newer.enqueue_time = pending.enqueue_time
+            else:
+                self._pending[dialog_id] = pending
+            self._pending.move_to_end(dialog_id, last=False)
+
+    async def close(self) -> None:
+        """Stops accepting saves and waits until all pending saves are flushed."""
+        self._closed = True
+        if self._persister is not None and not self._persister.done():
+            self._wakeup.set()
+            await self._persister
+
+    def get_stats(self) -> Dict:
+        return {'pending': len(self._pending),
+                'flushing': len(self._flushing),
+                **self.stats.to_dict()}
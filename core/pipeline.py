@@ -1,4 +1,5 @@
 from collections import defaultdict, Counter
+from typing import List, Tuple
 
 
 class Pipeline:
@@ -11,6 +12,51 @@ class Pipeline:
         wrong_links = self.process_service_names()
         if wrong_links:
             print('wrong links in config were detected: ', dict(wrong_links))
+        self.compile()
+
+    def compile(self):
+        # services graph as integer indexed DAG: successor lists and initial in-degree of every service
+        self._services_list = list(self.services.values())
+        self._service_ids = {service.name: i for i, service in enumerate(self._services_list)}
+        self._successors = [tuple(self._service_ids[s.name] for s in service.next_services
+                                  if s.name in self._service_ids)
+                            for service in self._services_list]
+        self._in_degree = [0] * len(self._services_list)
+        for successors in self._successors:
+            for i in successors:
+                self._in_degree[i] += 1
+
+    def init_pending_counts(self) -> List[int]:
+        return list(self._in_degree)
+
+    def mark_done(self, pending_counts: List[int], service_name: str) -> List:
+        """Decrements unfinished dependencies counters of service successors, returns services which became ready."""
+        ready = []
+        for i in self._successors[self._service_ids[service_name]]:
+            pending_counts[i] -= 1
+            if pending_counts[i] == 0:
+                ready.append(self._services_list[i])
+        return ready
+
+    def prune(self, pending_counts: List[int], live_counts: List[int], service_names) -> Tuple[List, List]:
+        """Removes services from the turn together with services depending only on them.
+
+        ``live_counts`` are counters of not removed dependencies, initialized with ``init_pending_counts``.
+        Returns services which became ready and names of removed services. Responder is never removed.
+        """
+        ready, pruned = [], []
+        stack = [self._service_ids[name] for name in service_names]
+        while stack:
+            i = stack.pop()
+            pruned.append(self._services_list[i].name)
+            for j in self._successors[i]:
+                pending_counts[j] -= 1
+                live_counts[j] -= 1
+                if live_counts[j] == 0 and not self._services_list[j].is_responder():
+                    stack.append(j)
+                elif pending_counts[j] == 0:
+                    ready.append(self._services_list[j])
+        return ready, pruned
 
     def get_service_by_name(self, service_name):
         if not service_name:
@@ -57,6 +103,7 @@ class Pipeline:
 
         for s in endpoints:
             self.services[s.name].next_services.add(service)
+        self.compile()
 
     def add_input_service(self, service):
         if not service.is_input():
@@ -67,7 +114,15 @@ class Pipeline:
 
         for s in starting_services:
             self.services[s.name].previous_services.add(service)
+        self.compile()
 
 
 def simple_workflow_formatter(workflow_record):
     return workflow_record['dialog']
+
+
+def history_window_workflow_formatter(workflow_record, history_window):
+    dialog = workflow_record['dialog']
+    if len(dialog['utterances']) <= history_window:
+        return dialog
+    return {**dialog, 'utterances': dialog['utterances'][-history_window:]}
@@ -4,19 +4,27 @@ import uuid
 from datetime import datetime
 from string import hexdigits
 from os import getenv
+from typing import Optional
 
 import asyncio
-from aiohttp import web, ClientSession
+from aiohttp import web
 from aiogram import Bot
 from aiogram.utils import executor
 from aiogram.dispatcher import Dispatcher
 
-from core.agent import Agent
+from core.agent import Agent, await_if_needed
 from core.pipeline import Pipeline
 from core.service import Service
 from core.connectors import EventSetOutputConnector, HttpOutputConnector
-from core.config_parser import parse_old_config, get_service_gateway_config
-from core.state_manager import StateManager
+from core.config_parser import parse_old_config, get_service_gateway_config, prepare_http_pool
+from core.metrics import REGISTRY, IN_FLIGHT_DIALOGS, QUEUE_DEPTH, SERVICE_IN_FLIGHT_TASKS
+from core.persistence import WriteBehindStateManager
+from core.state_cache import CachedStateManager
+from core.memory_state_manager import MemoryStateManager
+from core.state_manager import StateManager, connect_state_storage
+from core.tracing import make_tracer
+from core.transform_config import DIALOG_HISTORY_WINDOW, STATE_MANAGER, WRITE_BEHIND, DIALOG_CACHE, TURN_TIMEOUT, \
+    TRACING, MEMORY_STATE_MANAGER
 from state_formatters.output_formatters import http_api_output_formatter, http_debug_output_formatter
 
 
@@ -46,7 +54,53 @@ def response_logger(workflow_record):
         service_logger.info(f'{service_name}\t{round(done - send, 5)}\tseconds')
 
 
-def prepare_agent(services, endpoint: Service, input_serv: Service, use_response_logger: bool):
+def get_state_manager():
+    if STATE_MANAGER == 'motor':
+        from core.async_state_manager import AsyncStateManager
+        state_manager = AsyncStateManager()
+        # dialogs routes of the HTTP API read the database with mongoengine
+        connect_state_storage()
+    elif STATE_MANAGER == 'mongoengine':
+        state_manager = StateManager()
+    elif STATE_MANAGER == 'memory':
+        state_manager = MemoryStateManager(**MEMORY_STATE_MANAGER)
+    else:
+        raise ValueError(f'unknown state manager {STATE_MANAGER}')
+
+    if WRITE_BEHIND['enabled']:
+        state_manager = WriteBehindStateManager(state_manager, max_lag_sec=WRITE_BEHIND['max_lag_sec'],
+                                                max_pending=WRITE_BEHIND['max_pending'],
+                                                flush_batch_size=WRITE_BEHIND['flush_batch_size'])
+    if DIALOG_CACHE['enabled']:
+        state_manager = CachedStateManager(state_manager, max_size=DIALOG_CACHE['max_size'],
+                                           ttl_sec=DIALOG_CACHE['ttl_sec'])
+    return state_manager
+
+
+def find_state_manager(state_manager, cls):
+    # unwraps state manager wrappers down to the one of the given class
+    while not isinstance(state_manager, cls):
+        state_manager = getattr(state_manager, 'state_manager', None)
+        if state_manager is None:
+            return None
+    return state_manager
+
+
+async def close_state_manager(state_manager):
+    # flushes pending saves of the write-behind state manager
+    write_behind = find_state_manager(state_manager, WriteBehindStateManager)
+    if write_behind:
+        await write_behind.close()
+
+
+async def close_tracer(agent):
+    # exports buffered traces
+    if agent.tracer:
+        await agent.tracer.close()
+
+
+def prepare_agent(services, endpoint: Service, input_serv: Service, use_response_logger: bool,
+                  state_manager: Optional[StateManager] = None):
     pipeline = Pipeline(services)
     pipeline.add_responder_service(endpoint)
     pipeline.add_input_service(input_serv)
@@ -54,8 +108,9 @@ def prepare_agent(services, endpoint: Service, input_serv: Service, use_response
         response_logger_callable = response_logger
     else:
         response_logger_callable = None
-    agent = Agent(pipeline, StateManager(), response_logger_callable=response_logger_callable)
-    return agent.register_msg, agent.process
+    agent = Agent(pipeline, state_manager or StateManager(), response_logger_callable=response_logger_callable,
+                  history_window=DIALOG_HISTORY_WINDOW, turn_timeout=TURN_TIMEOUT, tracer=make_tracer(TRACING))
+    return agent
 
 
 async def run(register_msg):
@@ -85,7 +140,9 @@ class TelegramMessageProcessor:
 
 
 async def on_shutdown(app):
-    await app['client_session'].close()
+    await app['http_pool'].close()
+    await close_state_manager(app['state_manager'])
+    await close_tracer(app['agent'])
 
 
 async def init_app(register_msg, intermediate_storage,
@@ -97,23 +154,55 @@ async def init_app(register_msg, intermediate_storage,
     app.router.add_post('/', handle_func)
     app.router.add_get('/dialogs', users_dialogs)
     app.router.add_get('/dialogs/{dialog_id}', dialog)
+    app.router.add_get('/stats/http_pool', http_pool_stats)
+    app.router.add_get('/stats/batching', batching_stats)
+    app.router.add_get('/stats/replicas', replicas_stats)
+    app.router.add_get('/stats/persistence', persistence_stats)
+    app.router.add_get('/stats/dialog_cache', dialog_cache_stats)
+    app.router.add_get('/stats/memory_state', memory_state_stats)
+    app.router.add_get('/stats/timeouts', timeouts_stats)
+    app.router.add_get('/stats/selection', selection_stats)
+    app.router.add_get('/stats/transport', transport_stats)
+    app.router.add_get('/metrics', metrics)
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown_func)
     return app
 
 
-def prepare_startup(consumers, process_callable, session):
+def prepare_startup(consumers, process_callable, http_pool, state_manager, agent, gateway=None):
     result = []
     for i in consumers:
         result.append(asyncio.ensure_future(i.call_service(process_callable)))
 
     async def startup_background_tasks(app):
+        app['workers'] = consumers
         app['consumers'] = result
-        app['client_session'] = session
+        app['http_pool'] = http_pool
+        app['state_manager'] = state_manager
+        app['agent'] = agent
+        app['gateway'] = gateway
+        register_gauges(agent, consumers, state_manager, gateway)
 
     return startup_background_tasks
 
 
+def register_gauges(agent, consumers, state_manager, gateway=None):
+    # gauges are collected on scrape, so the hot path is not touched
+    write_behind = find_state_manager(state_manager, WriteBehindStateManager)
+
+    def get_queue_depths():
+        depths = {(worker.service_name,): worker.queue.qsize() for worker in consumers}
+        if write_behind:
+            depths[('write_behind',)] = write_behind.get_stats()['pending']
+        return depths
+
+    IN_FLIGHT_DIALOGS.set_function(lambda: {(): len(agent.workflow)})
+    QUEUE_DEPTH.set_function(get_queue_depths)
+    if gateway:
+        SERVICE_IN_FLIGHT_TASKS.set_function(
+            lambda: {(service_name,): count for service_name, count in gateway.get_in_flight_counts().items()})
+
+
 async def api_message_processor(register_msg, intermediate_storage, debug=False):
     async def api_handle(request):
         response = None
@@ -176,19 +265,78 @@ async def dialog(request):
     raise web.HTTPBadRequest(reason='dialog id should be 24-character hex string')
 
 
+async def http_pool_stats(request):
+    return web.json_response(request.app['http_pool'].get_stats())
+
+
+async def replicas_stats(request):
+    return web.json_response(request.app['http_pool'].get_replicas_stats())
+
+
+async def batching_stats(request):
+    return web.json_response({worker.service_name: worker.stats.to_dict() for worker in request.app['workers']})
+
+
+async def persistence_stats(request):
+    state_manager = find_state_manager(request.app['state_manager'], WriteBehindStateManager)
+    if not state_manager:
+        raise web.HTTPNotFound(reason='write-behind saving is disabled')
+    return web.json_response(state_manager.get_stats())
+
+
+async def timeouts_stats(request):
+    return web.json_response(request.app['agent'].get_timeout_stats())
+
+
+async def metrics(request):
+    return web.Response(text=REGISTRY.render(), content_type='text/plain')
+
+
+async def selection_stats(request):
+    return web.json_response(request.app['agent'].get_selection_stats())
+
+
+async def transport_stats(request):
+    gateway = request.app['gateway']
+    if not gateway:
+        raise web.HTTPNotFound(reason='agent gateway is not used')
+    return web.json_response({'tasks': gateway.get_in_flight_stats(),
+                              'publisher': gateway.get_publisher_stats(),
+                              'payload_store': gateway.get_payload_store_stats()})
+
+
+async def dialog_cache_stats(request):
+    state_manager = find_state_manager(request.app['state_manager'], CachedStateManager)
+    if not state_manager:
+        raise web.HTTPNotFound(reason='dialog cache is disabled')
+    return web.json_response(state_manager.get_stats())
+
+
+async def memory_state_stats(request):
+    state_manager = find_state_manager(request.app['state_manager'], MemoryStateManager)
+    if not state_manager:
+        raise web.HTTPNotFound(reason='memory state manager is not used')
+    return web.json_response(state_manager.get_stats())
+
+
 def run_default():
     services, workers, session, gateway = parse_old_config()
+    state_manager = get_state_manager()
+    asyncio.get_event_loop().run_until_complete(await_if_needed(state_manager.ensure_indexes()))
 
     if CHANNEL == 'cmd_client':
         endpoint = Service('cmd_responder', EventSetOutputConnector('cmd_responder').send,
-                           StateManager.save_dialog_dict, 1, ['responder'])
+                           state_manager.save_dialog_dict, 1, ['responder'])
         input_srv = Service('input', None, StateManager.add_human_utterance_simple_dict, 1, ['input'])
         loop = asyncio.get_event_loop()
         loop.set_debug(args.debug)
-        register_msg, process = prepare_agent(services, endpoint, input_srv, use_response_logger=args.response_logger)
+        agent = prepare_agent(services, endpoint, input_srv, use_response_logger=args.response_logger,
+                              state_manager=state_manager)
+        register_msg, process = agent.register_msg, agent.process
         if gateway:
             gateway.on_channel_callback = register_msg
             gateway.on_service_callback = process
+            agent.cancel_requests_callable = gateway.cancel_tasks
         future = asyncio.ensure_future(run(register_msg))
         for i in workers:
             loop.create_task(i.call_service(process))
@@ -200,6 +348,8 @@ def run_default():
             raise e
         finally:
             future.cancel()
+            loop.run_until_complete(close_state_manager(state_manager))
+            loop.run_until_complete(close_tracer(agent))
             if session:
                 loop.run_until_complete(session.close())
             if gateway:
@@ -209,16 +359,19 @@ def run_default():
             logging.shutdown()
     elif CHANNEL == 'http_client':
         if not session:
-            session = ClientSession()
+            session = prepare_http_pool()
         intermediate_storage = {}
         endpoint = Service('http_responder', HttpOutputConnector(intermediate_storage, 'http_responder').send,
-                           StateManager.save_dialog_dict, 1, ['responder'])
+                           state_manager.save_dialog_dict, 1, ['responder'])
         input_srv = Service('input', None, StateManager.add_human_utterance_simple_dict, 1, ['input'])
-        register_msg, process_callable = prepare_agent(services, endpoint, input_srv, args.response_logger)
+        agent = prepare_agent(services, endpoint, input_srv, args.response_logger, state_manager)
+        register_msg, process_callable = agent.register_msg, agent.process
         if gateway:
             gateway.on_channel_callback = register_msg
             gateway.on_service_callback = process_callable
-        app = init_app(register_msg, intermediate_storage, prepare_startup(workers, process_callable, session),
+            agent.cancel_requests_callable = gateway.cancel_tasks
+        app = init_app(register_msg, intermediate_storage,
+                       prepare_startup(workers, process_callable, session, state_manager, agent, gateway),
                        on_shutdown, args.debug)
         web.run_app(app, port=args.port)
 
@@ -231,20 +384,26 @@ def run_default():
         bot = Bot(token=token, loop=loop, proxy=proxy)
         dp = Dispatcher(bot)
         endpoint = Service('telegram_responder', EventSetOutputConnector('telegram_responder').send,
-                           StateManager.save_dialog_dict, 1, ['responder'])
+                           state_manager.save_dialog_dict, 1, ['responder'])
         input_srv = Service('input', None, StateManager.add_human_utterance_simple_dict, 1, ['input'])
-        register_msg, process = prepare_agent(
-            services, endpoint, input_srv, use_response_logger=args.response_logger)
+        agent = prepare_agent(
+            services, endpoint, input_srv, use_response_logger=args.response_logger, state_manager=state_manager)
+        register_msg, process = agent.register_msg, agent.process
         if gateway:
             gateway.on_channel_callback = register_msg
             gateway.on_service_callback = process
+            agent.cancel_requests_callable = gateway.cancel_tasks
         for i in workers:
             loop.create_task(i.call_service(process))
         tg_msg_processor = TelegramMessageProcessor(register_msg)
 
         dp.message_handler()(tg_msg_processor.handle_message)
 
-        executor.start_polling(dp, skip_updates=True)
+        async def on_telegram_shutdown(dispatcher):
+            await close_state_manager(state_manager)
+            await close_tracer(agent)
+
+        executor.start_polling(dp, skip_updates=True, on_shutdown=on_telegram_shutdown)
 
 
 def run_agent():
@@ -261,7 +420,9 @@ def run_service():
     formatter = service_config['formatter']
     connector_type = service_config['protocol']
     connector_cls = CONNECTORS_MAP[connector_type]
-    connector = connector_cls(service_config=service_config, formatter=formatter)
+    http_pool = prepare_http_pool()
+    connector = connector_cls(service_config=service_config, formatter=formatter,
+                              session=http_pool.get_session(service_config))
 
     transport_type = gateway_config['transport']['type']
     gateway_cls = GATEWAYS_MAP[transport_type]['service']
@@ -277,6 +438,7 @@ def run_service():
         raise e
     finally:
         gateway.disconnect()
+        loop.run_until_complete(http_pool.close())
         loop.stop()
         loop.close()
         logging.shutdown()
@@ -1,13 +1,16 @@
 class Service:
     def __init__(self, name, connector_func, state_processor_method=None,
                  batch_size=1, tags=None, names_previous_services=None,
-                 workflow_formatter=None):
+                 workflow_formatter=None, history_window=None, timeout=None, quorum=None):
         self.name = name
         self.batch_size = batch_size
         self.state_processor_method = state_processor_method
         self.names_previous_services = names_previous_services or set()
         self.tags = tags or []
         self.workflow_formatter = workflow_formatter
+        self.history_window = history_window
+        self.timeout = timeout
+        self.quorum = quorum
         self.connector_func = connector_func
         self.previous_services = set()
         self.next_services = set()
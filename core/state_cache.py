@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from copy import deepcopy
+from time import monotonic
+from typing import Any, Dict, Hashable, Optional
+
+from core.agent import await_if_needed
+from core.state_manager import StateManager
+
+
+def get_user_telegram_id(user) -> str:
+    return str(user['user_telegram_id'] if isinstance(user, dict) else user.user_telegram_id)
+
+
+class CacheEntry:
+    def __init__(self, user):
+        self.user = user
+        self.dialog_object = None
+        self.dialog: Optional[Dict] = None
+        self.history_window: Optional[int] = None
+        self.access_time = monotonic()
+
+
+class CachedDialog:
+    """Dialog served from the cache: last saved dialog state and the state manager dialog object to save it with."""
+
+    def __init__(self, dialog_object, dialog: Dict, history_window: Optional[int] = None):
+        self.dialog_object = dialog_object
+        self.dialog = dialog
+        self.history_window = history_window
+
+    @property
+    def id(self):
+        return self.dialog_object.id
+
+    def to_dict(self) -> Dict:
+        dialog = deepcopy(self.dialog)
+        if self.history_window is not None:
+            dialog['utterances'] = dialog['utterances'][-self.history_window:]
+        return dialog
+
+
+class CacheStats:
+    def __init__(self):
+        self.user_hits = 0
+        self.user_misses = 0
+        self.dialog_hits = 0
+        self.dialog_misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def to_dict(self):
+        user_requests = self.user_hits + self.user_misses
+        dialog_requests = self.dialog_hits + self.dialog_misses
+        return {'user_hits': self.user_hits,
+                'user_misses': self.user_misses,
+                'user_hit_ratio': round(self.user_hits / user_requests, 5) if user_requests else None,
+                'dialog_hits': self.dialog_hits,
+                'dialog_misses': self.dialog_misses,
+                'dialog_hit_ratio': round(self.dialog_hits / dialog_requests, 5) if dialog_requests else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations}
+
+
+class CachedStateManager:
+    """In-memory LRU/TTL cache of active users wrapping a state manager.
+
+    Human, Bot and Dialog state of last ``max_size`` users is kept in the agent process keyed by
+    user_telegram_id, users inactive for ``ttl_sec`` seconds are dropped. A repeat turn of a cached user is
+    served without database reads: the user object and the dialog state saved on the previous turn are returned
+    from the cache. Dialog reset (``/start``) replaces the cached dialog with the new one.
+
+    The cache assumes that dialogs of a user are handled by a single agent process, changes made to the database
+    by other processes are not seen until the user is evicted. All other methods are delegated to the wrapped
+    state manager.
+    """
+
+    def __init__(self, state_manager: StateManager, max_size: int = 10000, ttl_sec: Optional[float] = 600):
+        self.state_manager = state_manager
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.stats = CacheStats()
+        self._entries: Dict[str, CacheEntry] = OrderedDict()
+
+    def __getattr__(self, item):
+        return getattr(self.state_manager, item)
+
+    def _get_entry(self, user_telegram_id: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(user_telegram_id)
+        if entry is None:
+            return None
+        if self.ttl_sec is not None and monotonic() - entry.access_time > self.ttl_sec:
+            del self._entries[user_telegram_id]
+            self.stats.expirations += 1
+            return None
+        entry.access_time = monotonic()
+        self._entries.move_to_end(user_telegram_id)
+        return entry
+
+    def _put_entry(self, user_telegram_id: str, entry: CacheEntry) -> None:
+        self._entries[user_telegram_id] = entry
+        self._entries.move_to_end(user_telegram_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    async def get_or_create_user(self, user_telegram_id=Hashable, user_device_type=Any):
+        entry = self._get_entry(str(user_telegram_id))
+        if entry is not None:
+            self.stats.user_hits += 1
+            return entry.user
+        self.stats.user_misses += 1
+        user = await await_if_needed(self.state_manager.get_or_create_user(user_telegram_id, user_device_type))
+        self._put_entry(str(user_telegram_id), CacheEntry(user))
+        return user
+
+    async def get_or_create_dialog(self, user, location, channel_type, should_reset=False,
+                                   history_window: Optional[int] = None):
+        user_telegram_id = get_user_telegram_id(user)
+        entry = self._get_entry(user_telegram_id)
+        if entry is None:
+            entry = CacheEntry(user)
+            self._put_entry(user_telegram_id, entry)
+
+        if should_reset:
+            if entry.dialog_object is not None:
+                self.stats.invalidations += 1
+        elif entry.dialog is not None:
+            self.stats.dialog_hits += 1
+            return CachedDialog(entry.dialog_object, entry.dialog, history_window)
+        else:
+            self.stats.dialog_misses += 1
+
+        # dialog state is cached when the turn is saved
+        entry.dialog = None
+        entry.history_window = history_window
+        entry.dialog_object = await await_if_needed(self.state_manager.get_or_create_dialog(
+            user, location, channel_type, should_reset=should_reset, history_window=history_window))
+        return entry.dialog_object
+
+    async def save_dialog_dict(self, dialog: Dict, dialog_object, payload=None, **kwargs):
+        if isinstance(dialog_object, CachedDialog):
+            dialog_object = dialog_object.dialog_object
+        entry = self._entries.get(dialog['human']['user_telegram_id'])
+        if entry is None or entry.dialog_object is not dialog_object:
+            entry = None
+        try:
+            await await_if_needed(self.state_manager.save_dialog_dict(dialog, dialog_object, payload, **kwargs))
+        except Exception:
+            if entry is not None:
+                entry.dialog = None
+            raise
+
+        if entry is not None:
+            if entry.history_window is not None:
+                dialog = {**dialog, 'utterances': dialog['utterances'][-entry.history_window:]}
+            entry.dialog = dialog
+
+    def get_stats(self) -> Dict:
+        return {'size': len(self._entries), **self.stats.to_dict()}
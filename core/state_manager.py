@@ -1,20 +1,41 @@
 from datetime import datetime
-from typing import Hashable, Any, Optional, Dict, TypeVar, List
+from itertools import chain
+from typing import Hashable, Any, Optional, Dict, TypeVar, List, Tuple
 from copy import deepcopy
 
+from bson import ObjectId
 from mongoengine import connect
+from pymongo import ReplaceOne, UpdateOne
 
-from core.state_schema import User, Human, Bot, HumanUtterance, BotUtterance, Dialog, HUMAN_UTTERANCE_SCHEMA,\
-    BOT_UTTERANCE_SCHEMA
+from core.state_schema import User, Human, Bot, Utterance, HumanUtterance, BotUtterance, Dialog, \
+    HUMAN_UTTERANCE_SCHEMA, BOT_UTTERANCE_SCHEMA, STATE_DOCUMENTS
 from core.transform_config import DB_HOST, DB_PORT, DB_NAME
 
 
 userT = TypeVar('userT', bound=User)
 
 
+def connect_state_storage(host=DB_HOST, port=DB_PORT, db_name=DB_NAME):
+    """Registers the default mongoengine connection, the database is connected on the first query."""
+    return connect(host=host, port=int(port), db=db_name, connect=False)
+
+
 class StateManager:
+    """State manager backed by MongoDB through mongoengine documents from core.state_schema.
+
+    Storage backends (AsyncStateManager, MemoryStateManager) inherit dict state processors and override the storage
+    methods used by the agent: ``ensure_indexes``, ``get_or_create_user``, ``get_or_create_dialog``,
+    ``get_last_utterances``, ``save_dialog_dicts`` and ``save_dialog_dict``. They may be both blocking and
+    coroutines. The database connection is registered when the state manager is created.
+    """
+
+    def __init__(self, host=DB_HOST, port=DB_PORT, db_name=DB_NAME):
+        self.state_storage = connect_state_storage(host, port, db_name)
 
-    state_storage = connect(host=DB_HOST, port=DB_PORT, db=DB_NAME)
+    @staticmethod
+    def ensure_indexes():
+        for document_cls in STATE_DOCUMENTS:
+            document_cls.ensure_indexes()
 
     @staticmethod
     def create_new_dialog(human, bot, location=None, channel_type=None):
@@ -75,22 +96,31 @@ class StateManager:
         return user
 
     @classmethod
-    def get_or_create_dialog(cls, user, location, channel_type, should_reset=False):
+    def get_or_create_dialog(cls, user, location, channel_type, should_reset=False,
+                             history_window: Optional[int] = None):
         if should_reset:
             bot = cls.create_new_bot()
             dialog = cls.create_new_dialog(human=user, bot=bot, location=location,
                                            channel_type=channel_type)
         else:
-            exist_dialogs = Dialog.objects(human__exact=user)
-            if not exist_dialogs:
+            exist_dialogs = Dialog.objects(human__exact=user).order_by('-id')
+            if history_window is not None:
+                exist_dialogs = exist_dialogs.fields(slice__utterances=-history_window)
+            dialog = exist_dialogs.first()
+            if dialog is None:
                 bot = cls.create_new_bot()
                 dialog = cls.create_new_dialog(human=user, bot=bot, location=location,
                                                channel_type=channel_type)
-            else:
-                dialog = exist_dialogs[0]
 
         return dialog
 
+    @staticmethod
+    def get_last_utterances(dialog_id: str, limit: Optional[int] = None) -> List[Dict]:
+        dialog_query = Dialog.objects(id__exact=dialog_id)
+        if limit is not None:
+            dialog_query = dialog_query.fields(slice__utterances=-limit)
+        return [utt.to_dict() for utt in dialog_query.first().utterances]
+
     @classmethod
     def add_human_utterance(cls, dialog: Dialog, user: Human, text: str, date_time: datetime,
                             annotation: Optional[dict] = None,
@@ -239,25 +269,60 @@ class StateManager:
         dialog['utterances'][-1]['text'] = payload
 
     @staticmethod
-    def save_dialog_dict(dialog: Dict, dialog_object: Dialog, payload=None, **kwargs):
-        utt_objects = []
+    def get_new_utterances(dialog: Dict) -> List[Dict]:
+        new_utterances = []
         for utt in dialog['utterances'][::-1]:
-            if not utt['id']:
-                if utt['user']['user_type'] == 'human':
-                    utt_objects.append(HumanUtterance.make_from_dict(utt))
-                elif utt['user']['user_type'] == 'bot':
-                    utt_objects.append(BotUtterance.make_from_dict(utt))
-                else:
-                    raise ValueError('unknown user type in the utterance')
-            else:
+            if utt['id']:
                 break
-        for utt in utt_objects[::-1]:
-            utt.save()
-            dialog_object.utterances.append(utt)
+            new_utterances.append(utt)
+        return new_utterances[::-1]
 
-        dialog_object.human.update_from_dict(dialog['human'])
-        dialog_object.bot.update_from_dict(dialog['bot'])
-        dialog_object.human.save()
-        dialog_object.bot.save()
+    @classmethod
+    def save_dialog_dicts(cls, dialogs: List[Tuple[Dict, Dialog]],
+                          new_utterances: Optional[List[List[Dict]]] = None) -> None:
+        """Saves new utterances of several dialogs with one bulk insert and one bulk update of dialogs.
+
+        New utterances of each dialog are the trailing ones without id unless given explicitly (utterances with
+        preassigned ids). Ids of saved utterances are written back to the utterance dicts. Utterances are upserted
+        by id and added to dialogs only if missing, so a failed save may be retried.
+        """
+        if new_utterances is None:
+            new_utterances = [cls.get_new_utterances(dialog) for dialog, _ in dialogs]
+        utt_objects = []
+        for utt in chain(*new_utterances):
+            if utt['user']['user_type'] == 'human':
+                utt_objects.append(HumanUtterance.make_from_dict(utt))
+            elif utt['user']['user_type'] == 'bot':
+                utt_objects.append(BotUtterance.make_from_dict(utt))
+            else:
+                raise ValueError('unknown user type in the utterance')
+
+        # dialog object may hold only the tail of utterances, so new ones are pushed instead of saving the whole list
+        if utt_objects:
+            for utt in utt_objects:
+                utt.id = utt.id or ObjectId()
+                utt.validate()
+            utt_docs = [utt.to_mongo() for utt in utt_objects]
+            Utterance._get_collection().bulk_write([ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+                                                    for doc in utt_docs], ordered=False)
+            utt_ids = iter(doc['_id'] for doc in utt_docs)
+            dialog_updates = []
+            for (_, dialog_object), utterances in zip(dialogs, new_utterances):
+                if not utterances:
+                    continue
+                dialog_utt_ids = [next(utt_ids) for _ in utterances]
+                for utt, utt_id in zip(utterances, dialog_utt_ids):
+                    utt['id'] = str(utt_id)
+                dialog_updates.append(UpdateOne({'_id': dialog_object.id},
+                                                {'$addToSet': {'utterances': {'$each': dialog_utt_ids}}}))
+            Dialog._get_collection().bulk_write(dialog_updates, ordered=False)
+
+        for dialog, dialog_object in dialogs:
+            for user, user_dict in ((dialog_object.human, dialog['human']), (dialog_object.bot, dialog['bot'])):
+                user.update_from_dict(user_dict)
+                if user._get_changed_fields():
+                    user.save()
 
-        dialog_object.save()
+    @classmethod
+    def save_dialog_dict(cls, dialog: Dict, dialog_object: Dialog, payload=None, **kwargs):
+        cls.save_dialog_dicts([(dialog, dialog_object)])
@@ -123,7 +123,9 @@ class Utterance(DynamicDocument):
     user = DictField(default={})
     date_time = DateTimeField(required=True)
 
-    meta = {'allow_inheritance': True}
+    # utterances are read by ids from the dialog, date index serves dialog logs export by time
+    meta = {'allow_inheritance': True,
+            'indexes': ['date_time']}
 
     def to_dict(self):
         raise NotImplementedError
@@ -157,7 +159,6 @@ class HumanUtterance(Utterance):
         utterance.hypotheses = payload['hypotheses']
         utterance.attributes = payload['attributes']
         utterance.user = payload['user']
-        utterance.save()
         return utterance
 
 
@@ -189,7 +190,6 @@ class BotUtterance(Utterance):
         utterance.active_skill = payload['active_skill']
         utterance.confidence = payload['confidence']
         utterance.user = payload['user']
-        utterance.save()
         return utterance
 
 
@@ -201,6 +201,9 @@ class Dialog(DynamicDocument):
     human = ReferenceField(Human, required=True)
     bot = ReferenceField(Bot, required=True)
 
+    # last dialog of a user, ids are increasing in time
+    meta = {'indexes': [{'fields': ['human', '-id']}]}
+
     def to_dict(self):
         return {
             'id': str(self.id),
@@ -217,3 +220,7 @@ class Dialog(DynamicDocument):
         dialog.location = payload['location']
         dialog.channel_type = payload['channel_type']
         return dialog
+
+
+# documents which indexes are ensured on the agent startup
+STATE_DOCUMENTS = [User, Human, Bot, Utterance, HumanUtterance, BotUtterance, Dialog]
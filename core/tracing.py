@@ -0,0 +1,231 @@
+import asyncio
+import json
+import os
+import random
+from logging import getLogger
+from time import time
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import aiohttp
+
+logger = getLogger(__name__)
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+
+
+def new_trace_id() -> str:
+    return uuid4().hex
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+class Span:
+    def __init__(self, trace_id: str, name: str, kind: str, start_time: float, end_time: Optional[float] = None,
+                 parent_id: Optional[str] = None, attributes: Optional[Dict] = None):
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_time = start_time
+        self.end_time = end_time
+        self.attributes = attributes or {}
+
+    def to_dict(self) -> Dict:
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'kind': self.kind,
+                'start_time': self.start_time,
+                'end_time': self.end_time,
+                'attributes': self.attributes}
+
+
+class TurnTrace:
+    """Spans of a single turn: the root turn span, DB and formatter calls recorded as they happen and service hops
+    built from the workflow record services timings when the turn ends.
+
+    Service hop spans cover the time from sending a task to processing its response by the agent, a nested
+    ``<service>.request`` span covers the service request itself if the connector reported its timings.
+    """
+
+    def __init__(self, trace_id: Optional[str] = None, start_time: Optional[float] = None):
+        self.trace_id = trace_id or new_trace_id()
+        self.root = Span(self.trace_id, 'turn', 'turn', start_time or time())
+        self.spans: List[Span] = [self.root]
+
+    def add_span(self, name: str, kind: str, start_time: float, end_time: float, parent: Optional[Span] = None,
+                 **attributes) -> Span:
+        span = Span(self.trace_id, name, kind, start_time, end_time, (parent or self.root).span_id, attributes)
+        self.spans.append(span)
+        return span
+
+    def finish(self, workflow_record: Dict, end_time: Optional[float] = None, error: bool = False) -> None:
+        for service_name, service_data in workflow_record['services'].items():
+            send_time = service_data.get('agent_send_time')
+            if not send_time:
+                continue
+            attributes = {attr: True for attr in ('timed_out', 'cancelled') if service_data.get(attr)}
+            if 'responded' in service_data:
+                attributes['responded'] = service_data['responded']
+            service_span = self.add_span(service_name, 'service', send_time, service_data.get('agent_done_time'),
+                                         **attributes)
+            request_start = service_data.get('service_send_time')
+            request_end = service_data.get('service_response_time')
+            if request_start and request_end:
+                self.add_span(f'{service_name}.request', 'service_request', request_start, request_end,
+                              parent=service_span)
+        self.root.end_time = end_time or time()
+        self.root.attributes['dialog_id'] = workflow_record['dialog']['id']
+        if error:
+            self.root.attributes['error'] = True
+
+    def to_dict(self) -> Dict:
+        return {'trace_id': self.trace_id,
+                'dialog_id': self.root.attributes.get('dialog_id'),
+                'spans': [span.to_dict() for span in self.spans]}
+
+
+class FileSpanExporter:
+    """Appends finished turns to a file, one JSON line with all spans of a turn."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def export(self, traces: List[TurnTrace]) -> None:
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for trace in traces:
+                f.write(json.dumps(trace.to_dict()) + '\n')
+
+    async def close(self) -> None:
+        pass
+
+
+def _otlp_attributes(attributes: Dict) -> List[Dict]:
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            result.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            result.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            result.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            result.append({'key': key, 'value': {'stringValue': str(value)}})
+    return result
+
+
+def _otlp_span(span: Span) -> Dict:
+    result = {'traceId': span.trace_id,
+              'spanId': span.span_id,
+              'name': span.name,
+              'kind': SPAN_KIND_CLIENT if span.kind in ('service', 'service_request', 'db') else SPAN_KIND_INTERNAL,
+              'startTimeUnixNano': str(int(span.start_time * 1e9)),
+              'endTimeUnixNano': str(int((span.end_time or span.start_time) * 1e9)),
+              'attributes': _otlp_attributes({'dp_agent.span_kind': span.kind, **span.attributes})}
+    if span.parent_id:
+        result['parentSpanId'] = span.parent_id
+    if span.attributes.get('error') or span.attributes.get('timed_out'):
+        result['status'] = {'code': 2}
+    return result
+
+
+class OTLPSpanExporter:
+    """Sends spans to an OpenTelemetry collector with OTLP/HTTP JSON encoding."""
+
+    def __init__(self, endpoint: str, service_name: str = 'dp-agent', timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def to_otlp(self, traces: List[TurnTrace]) -> Dict:
+        return {'resourceSpans': [{
+            'resource': {'attributes': _otlp_attributes({'service.name': self.service_name})},
+            'scopeSpans': [{'scope': {'name': 'dp-agent'},
+                            'spans': [_otlp_span(span) for trace in traces for span in trace.spans]}]
+        }]}
+
+    async def export(self, traces: List[TurnTrace]) -> None:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self._session.post(self.endpoint, json=self.to_otlp(traces)) as resp:
+            resp.raise_for_status()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+class Tracer:
+    """Samples turns for tracing and exports finished turns in the background.
+
+    Finished turns are buffered and exported every ``flush_interval_sec`` seconds or when ``max_batch_size`` turns
+    are buffered, so exporting never delays the agent response. Failed exports are logged and dropped.
+    """
+
+    def __init__(self, exporter, sample_rate: float = 1.0, flush_interval_sec: float = 1.0,
+                 max_batch_size: int = 100):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.flush_interval_sec = flush_interval_sec
+        self.max_batch_size = max_batch_size
+        self._pending: List[TurnTrace] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._flush_tasks = set()
+
+    def start_trace(self) -> Optional[TurnTrace]:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        return TurnTrace()
+
+    def export(self, trace: TurnTrace) -> None:
+        self._pending.append(trace)
+        if len(self._pending) >= self.max_batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_interval_sec, self.flush)
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        traces, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._export(traces))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _export(self, traces: List[TurnTrace]) -> None:
+        try:
+            await self.exporter.export(traces)
+        except Exception:
+            logger.exception(f'failed to export {len(traces)} traces')
+
+    async def close(self) -> None:
+        """Exports buffered turns and closes the exporter."""
+        self.flush()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks)
+        await self.exporter.close()
+
+
+def make_tracer(config: Dict) -> Optional[Tracer]:
+    if not config.get('enabled'):
+        return None
+    exporter_type = config.get('exporter', 'file')
+    if exporter_type == 'file':
+        exporter = FileSpanExporter(config.get('path', 'traces.jsonl'))
+    elif exporter_type == 'otlp':
+        exporter = OTLPSpanExporter(config['endpoint'], config.get('service_name', 'dp-agent'))
+    else:
+        raise ValueError(f'unknown trace exporter {exporter_type}')
+    return Tracer(exporter, sample_rate=config.get('sample_rate', 1.0),
+                  flush_interval_sec=config.get('flush_interval_sec', 1.0))
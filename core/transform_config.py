@@ -51,10 +51,19 @@ if _run_config_path.is_file():
         config = config.get('agent_config', {})
 
         MAX_WORKERS = config.get('MAX_WORKERS', MAX_WORKERS)
+        HTTP_CONNECTION_POOL = config.get('HTTP_CONNECTION_POOL', HTTP_CONNECTION_POOL)
+        DIALOG_HISTORY_WINDOW = config.get('DIALOG_HISTORY_WINDOW', DIALOG_HISTORY_WINDOW)
+        TURN_TIMEOUT = config.get('TURN_TIMEOUT', TURN_TIMEOUT)
+        SKILLS_QUORUM = config.get('SKILLS_QUORUM', SKILLS_QUORUM)
 
         DB_NAME = config.get('DB_NAME', DB_NAME)
         DB_HOST = config.get('HOST', DB_HOST)
         DB_PORT = config.get('PORT', DB_PORT)
+        STATE_MANAGER = config.get('STATE_MANAGER', STATE_MANAGER)
+        MEMORY_STATE_MANAGER = config.get('MEMORY_STATE_MANAGER', MEMORY_STATE_MANAGER)
+        WRITE_BEHIND = config.get('WRITE_BEHIND', WRITE_BEHIND)
+        DIALOG_CACHE = config.get('DIALOG_CACHE', DIALOG_CACHE)
+        TRACING = config.get('TRACING', TRACING)
 
         for group in _component_groups:
             setattr(_module, group, list(map(_get_config_path, config.get(group, []))))
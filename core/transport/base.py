@@ -28,7 +28,13 @@ class AgentGatewayBase:
     def on_channel_callback(self, callback: Callable):
         self._on_channel_callback = callback
 
-    async def send_to_service(self, service: str, dialog: Dict) -> None:
+    async def send_to_service(self, service: str, dialog: Dict, trace_id: Optional[str] = None,
+                              turn_id: Optional[str] = None, task_uuid: Optional[str] = None,
+                              delivery_mode: Optional[str] = None, task_timeout: Optional[float] = None,
+                              task_retries: Optional[int] = None) -> None:
+        raise NotImplementedError
+
+    def cancel_tasks(self, task_uuids: List[str]) -> None:
         raise NotImplementedError
 
     async def send_to_channel(self, channel_id: str, user_id: str, response: str) -> None:
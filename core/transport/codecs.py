@@ -0,0 +1,112 @@
+import json
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
+# message header with content types the sender can decode, in order of preference
+ACCEPT_HEADER = 'x-accept-content-types'
+
+
+class Codec:
+    name: str
+    content_type: str
+
+    def encode(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, body: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = 'json'
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, body: bytes) -> Any:
+        return json.loads(body)
+
+
+class OrjsonCodec(Codec):
+    """JSON with orjson, compatible with JSONCodec peers."""
+
+    name = 'orjson'
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def decode(self, body: bytes) -> Any:
+        return orjson.loads(body)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def encode(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, body: bytes) -> Any:
+        return msgpack.unpackb(body, raw=False)
+
+
+CODECS: Dict[str, Codec] = {'json': JSONCodec()}
+if orjson is not None:
+    CODECS['orjson'] = OrjsonCodec()
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+
+# the fastest available decoder of each content type
+_DECODERS: Dict[str, Codec] = {JSON_CONTENT_TYPE: CODECS.get('orjson', CODECS['json'])}
+if msgpack is not None:
+    _DECODERS[MSGPACK_CONTENT_TYPE] = CODECS['msgpack']
+
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        raise ValueError(f'transport codec {name} is unknown or its package is not installed, '
+                         f'available codecs: {", ".join(CODECS)}')
+    return CODECS[name]
+
+
+def get_decoder(content_type: Optional[str]) -> Codec:
+    # messages of peers without codecs support have no content type and are JSON encoded
+    decoder = _DECODERS.get(content_type or JSON_CONTENT_TYPE)
+    if decoder is None:
+        raise ValueError(f'no decoder for content type {content_type}')
+    return decoder
+
+
+def accepted_content_types(codec: Codec) -> str:
+    """Value of the accept header: content type of the codec first, then other decodable content types."""
+    return ', '.join([codec.content_type] + [content_type for content_type in _DECODERS
+                                             if content_type != codec.content_type])
+
+
+def choose_codec(accept: Optional[Union[str, bytes]], codec: Codec) -> Codec:
+    """Codec for a reply to a message with the accept header: the first accepted content type that can be encoded."""
+    if not accept:
+        return codec if codec.content_type == JSON_CONTENT_TYPE else CODECS['json']
+    if isinstance(accept, bytes):
+        accept = accept.decode('utf-8')
+    accepted: List[str] = [content_type.strip() for content_type in accept.split(',')]
+    for content_type in accepted:
+        if content_type == codec.content_type:
+            return codec
+        if content_type in _DECODERS:
+            return _DECODERS[content_type]
+    return CODECS['json']
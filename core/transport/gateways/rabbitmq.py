@@ -1,16 +1,20 @@
 import asyncio
-import json
 import time
+from collections import OrderedDict, defaultdict
 from uuid import uuid4
-from typing import Dict, List, Optional, Callable
+from typing import Dict, List, Optional, Callable, Tuple
 from logging import getLogger
 
 import aio_pika
 from aio_pika import Connection, Channel, Exchange, Queue, IncomingMessage, Message
 
+from core.connectors import BatchingStats
 from core.transport.base import AgentGatewayBase, ServiceGatewayBase, ChannelGatewayBase
+from core.transport.codecs import ACCEPT_HEADER, Codec, get_codec, get_decoder, accepted_content_types, choose_codec
 from core.transport.messages import ServiceTaskMessage, ServiceResponseMessage, ToChannelMessage, FromChannelMessage
-from core.transport.messages import TMessageBase, get_transport_message
+from core.transport.messages import MessageBase, TMessageBase, get_transport_message
+from core.transport.payload_store import DialogReference, PayloadStore, make_payload_store, \
+    resolve_dialog_reference
 
 AGENT_IN_EXCHANGE_NAME_TEMPLATE = '{agent_namespace}_e_in'
 AGENT_OUT_EXCHANGE_NAME_TEMPLATE = '{agent_namespace}_e_out'
@@ -24,9 +28,147 @@ SERVICE_INSTANCE_ROUTING_KEY_TEMPLATE = 'service.{service_name}.instance.{instan
 CHANNEL_QUEUE_NAME_TEMPLATE = '{agent_namespace}_{agent_name}_q_channel_{channel_id}'
 CHANNEL_ROUTING_KEY_TEMPLATE = 'agent.{agent_name}.channel.{channel_id}.any'
 
+DELIVERY_MODES = {
+    'persistent': aio_pika.DeliveryMode.PERSISTENT,
+    'transient': aio_pika.DeliveryMode.NOT_PERSISTENT
+}
+
 logger = getLogger(__name__)
 
 
+class PublisherStats:
+    def __init__(self):
+        self.published = 0
+        self.flushes = 0
+        self.failed = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+
+    def register_flush(self, messages_count: int, failed_count: int, flush_time: float) -> None:
+        self.flushes += 1
+        self.published += messages_count - failed_count
+        self.failed += failed_count
+        self.flush_time += flush_time
+        self.max_flush_time = max(self.max_flush_time, flush_time)
+
+    def to_dict(self) -> Dict:
+        messages = self.published + self.failed
+        return {'published': self.published,
+                'failed': self.failed,
+                'flushes': self.flushes,
+                'mean_flush_size': round(messages / self.flushes, 3) if self.flushes else None,
+                'flush_time_mean': round(self.flush_time / self.flushes, 5) if self.flushes else 0.0,
+                'flush_time_max': round(self.max_flush_time, 5)}
+
+
+class RabbitMQPublisher:
+    """Publishes messages to an exchange through a pool of channels.
+
+    Messages published during one event loop iteration (e.g. tasks to all next services of a turn) are flushed
+    together on the next iteration and spread over the pool channels. With publisher confirms, messages of a flush
+    are not confirmed one by one: all of them are written and their confirmations are awaited together, so a flush
+    costs about one broker round trip instead of one per message.
+    """
+
+    def __init__(self, connection: Connection, exchange_name: str,
+                 exchange_type: aio_pika.ExchangeType = aio_pika.ExchangeType.TOPIC, pool_size: int = 1,
+                 publisher_confirms: bool = True, confirm_timeout: Optional[float] = None) -> None:
+        self._connection = connection
+        self._exchange_name = exchange_name
+        self._exchange_type = exchange_type
+        self._pool_size = pool_size
+        self._publisher_confirms = publisher_confirms
+        self._confirm_timeout = confirm_timeout
+        self._exchanges: List[Exchange] = []
+        self._next_exchange = 0
+        self._pending: List[Tuple[Message, str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._flush_tasks = set()
+        self.stats = PublisherStats()
+
+    async def open(self) -> None:
+        for _ in range(self._pool_size):
+            channel = await self._connection.channel(publisher_confirms=self._publisher_confirms)
+            exchange = await channel.declare_exchange(name=self._exchange_name, type=self._exchange_type)
+            self._exchanges.append(exchange)
+        logger.info(f'Opened {self._pool_size} publisher channels to exchange {self._exchange_name}, '
+                    f'publisher confirms: {self._publisher_confirms}')
+
+    def publish(self, message: Message, routing_key: str) -> asyncio.Future:
+        """Queues the message to the next flush, returns a future which is done when the message is published."""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((message, routing_key, future))
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_soon(self._flush)
+        return future
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._publish_batch(batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _publish_batch(self, batch: List[Tuple[Message, str, asyncio.Future]]) -> None:
+        start_time = time.perf_counter()
+        publishes = []
+        for message, routing_key, _ in batch:
+            exchange = self._exchanges[self._next_exchange]
+            self._next_exchange = (self._next_exchange + 1) % len(self._exchanges)
+            publishes.append(exchange.publish(message=message, routing_key=routing_key,
+                                              timeout=self._confirm_timeout))
+        results = await asyncio.gather(*publishes, return_exceptions=True)
+
+        failed_count = 0
+        for (_, routing_key, future), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                failed_count += 1
+                logger.error(f'Failed to publish message with routing key {routing_key}: {repr(result)}')
+            if future.done():
+                # the publishing coroutine was cancelled
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(None)
+        self.stats.register_flush(len(batch), failed_count, time.perf_counter() - start_time)
+
+    def get_stats(self) -> Dict:
+        return {'channels': len(self._exchanges), 'pending': len(self._pending), **self.stats.to_dict()}
+
+
+class InFlightTask:
+    def __init__(self, task: ServiceTaskMessage, dialog_id: str, turn_id: Optional[str],
+                 delivery_mode: aio_pika.DeliveryMode, timeout: float, retries: int) -> None:
+        self.task = task
+        self.dialog_id = dialog_id
+        self.turn_id = turn_id
+        self.delivery_mode = delivery_mode
+        self.timeout = timeout
+        self.retries = retries
+        self.attempts = 1
+        self.deadline_handle: Optional[asyncio.Handle] = None
+
+
+class InFlightStats:
+    def __init__(self):
+        self.sent = 0
+        self.retried = 0
+        self.expired = 0
+        self.cancelled = 0
+        self.duplicates = 0
+        self.late = 0
+
+    def to_dict(self) -> Dict:
+        return {'sent': self.sent,
+                'retried': self.retried,
+                'expired': self.expired,
+                'cancelled': self.cancelled,
+                'duplicates': self.duplicates,
+                'late': self.late}
+
+
 # TODO: add proper RabbitMQ SSL authentication
 # TODO: add load balancing for stateful skills or remove SERVICE_INSTANCE_ROUTING_KEY_TEMPLATE
 class RabbitMQTransportBase:
@@ -39,12 +181,28 @@ class RabbitMQTransportBase:
     _agent_out_channel: Channel
     _in_queue: Optional[Queue]
     _utterance_lifetime_sec: int
+    _codec: Codec
 
     def __init__(self, config: dict, *args, **kwargs):
         super(RabbitMQTransportBase, self).__init__(*args, **kwargs)
         self._config = config
         self._in_queue = None
         self._utterance_lifetime_sec = config['utterance_lifetime_sec']
+        self._codec = get_codec(config.get('codec', 'json'))
+        self._accept = accepted_content_types(self._codec)
+
+    def _encode_message(self, transport_message: MessageBase, codec: Optional[Codec] = None,
+                        delivery_mode: aio_pika.DeliveryMode = aio_pika.DeliveryMode.PERSISTENT) -> Message:
+        codec = codec or self._codec
+        return Message(body=codec.encode(transport_message.to_json()),
+                       content_type=codec.content_type,
+                       headers={ACCEPT_HEADER: self._accept},
+                       delivery_mode=delivery_mode,
+                       expiration=self._utterance_lifetime_sec)
+
+    @staticmethod
+    def _decode_message(message: IncomingMessage) -> TMessageBase:
+        return get_transport_message(get_decoder(message.content_type).decode(message.body))
 
     async def _connect(self) -> None:
         agent_namespace = self._config['agent_namespace']
@@ -77,8 +235,8 @@ class RabbitMQTransportBase:
 
         self._agent_out_channel = await self._connection.channel()
         agent_out_exchange_name = AGENT_OUT_EXCHANGE_NAME_TEMPLATE.format(agent_namespace=agent_namespace)
-        self._agent_out_exchange = await self._agent_in_channel.declare_exchange(name=agent_out_exchange_name,
-                                                                                 type=aio_pika.ExchangeType.TOPIC)
+        self._agent_out_exchange = await self._agent_out_channel.declare_exchange(name=agent_out_exchange_name,
+                                                                                  type=aio_pika.ExchangeType.TOPIC)
         logger.info(f'Declared agent out exchange: {agent_out_exchange_name}')
 
     def disconnect(self):
@@ -92,9 +250,23 @@ class RabbitMQTransportBase:
 
 
 class RabbitMQAgentGateway(RabbitMQTransportBase, AgentGatewayBase):
+    """Agent side of RabbitMQ transport.
+
+    Sent service tasks are tracked by task uuid until they are answered. A task not answered in its timeout is
+    published again up to ``retries`` times, to be taken by any free instance of the service, and then expires:
+    the service is skipped as if it responded nothing. Tasks of turns the agent has finished and of services it has
+    skipped are cancelled. Only the first response to a task is passed to the agent, responses to answered tasks
+    (duplicates) and to expired, cancelled or unknown tasks (late responses) are dropped.
+    """
+
     _agent_name: str
     _service_responded_events: Dict[str, asyncio.Event]
     _service_responses: Dict[str, dict]
+    _publisher: RabbitMQPublisher
+    _delivery_mode: aio_pika.DeliveryMode
+    _payload_store: Optional[PayloadStore]
+    _in_flight_tasks: Dict[str, InFlightTask]
+    _finished_tasks: Dict[str, str]
 
     def __init__(self, config: dict,
                  on_service_callback: Optional[Callable] = None,
@@ -106,12 +278,50 @@ class RabbitMQAgentGateway(RabbitMQTransportBase, AgentGatewayBase):
 
         self._loop = asyncio.get_event_loop()
         self._agent_name = self._config['agent_name']
+        self._payload_store = make_payload_store(self._config.get('payload_store', {}), self._utterance_lifetime_sec)
+        tasks_config = self._config.get('tasks', {})
+        self._task_timeout = tasks_config.get('timeout_sec') or self._utterance_lifetime_sec
+        self._task_retries = tasks_config.get('retries', 1)
+        self._finished_tasks_size = tasks_config.get('finished_tasks_size', 10000)
+        self._in_flight_tasks = {}
+        # outcome of recently finished tasks to tell duplicate responses from late ones
+        self._finished_tasks = OrderedDict()
+        self._in_flight_counts = defaultdict(int)
+        self._in_flight_stats = defaultdict(InFlightStats)
+        self._retry_tasks = set()
 
         self._loop.run_until_complete(self._connect())
         self._loop.run_until_complete(self._setup_queues())
+        self._loop.run_until_complete(self._setup_publisher())
+        if self._payload_store is not None:
+            self._loop.run_until_complete(self._payload_store.ensure_indexes())
         self._loop.run_until_complete(self._in_queue.consume(callback=self._on_message_callback))
         logger.info('Agent in queue started consuming')
 
+    async def _setup_publisher(self) -> None:
+        publisher_config = self._config.get('publisher', {})
+        agent_out_exchange_name = AGENT_OUT_EXCHANGE_NAME_TEMPLATE.format(
+            agent_namespace=self._config['agent_namespace'])
+        self._publisher = RabbitMQPublisher(self._connection, agent_out_exchange_name,
+                                            pool_size=publisher_config.get('channel_pool_size', 1),
+                                            publisher_confirms=publisher_config.get('publisher_confirms', True),
+                                            confirm_timeout=publisher_config.get('confirm_timeout'))
+        await self._publisher.open()
+        self._delivery_mode = DELIVERY_MODES[publisher_config.get('delivery_mode', 'persistent')]
+
+    def get_publisher_stats(self) -> Dict:
+        return self._publisher.get_stats()
+
+    def get_payload_store_stats(self) -> Dict:
+        return self._payload_store.get_stats() if self._payload_store is not None else {}
+
+    def get_in_flight_counts(self) -> Dict[str, int]:
+        return dict(self._in_flight_counts)
+
+    def get_in_flight_stats(self) -> Dict:
+        return {service_name: {'in_flight': self._in_flight_counts[service_name], **stats.to_dict()}
+                for service_name, stats in self._in_flight_stats.items()}
+
     async def _setup_queues(self) -> None:
         agent_namespace = self._config['agent_namespace']
         in_queue_name = AGENT_QUEUE_NAME_TEMPLATE.format(agent_namespace=agent_namespace, agent_name=self._agent_name)
@@ -123,16 +333,22 @@ class RabbitMQAgentGateway(RabbitMQTransportBase, AgentGatewayBase):
         logger.info(f'Queue: {in_queue_name} bound to routing key: {routing_key}')
 
     async def _on_message_callback(self, message: IncomingMessage) -> None:
-        message_in: TMessageBase = get_transport_message(json.loads(message.body, encoding='utf-8'))
+        message_in: TMessageBase = self._decode_message(message)
         await message.ack()
 
         if isinstance(message_in, ServiceResponseMessage):
             logger.debug(f'Received service response message {str(message_in.to_json())}')
+            in_flight_task = self._finish_task(message_in.task_uuid, message_in.service_name, 'answered')
+            if in_flight_task is None:
+                return
             response_time = time.time()
             await self._loop.create_task(self._on_service_callback(dialog_id=message_in.dialog_id,
                                                                    service_name=message_in.service_name,
                                                                    response=message_in.response,
-                                                                   response_time=response_time))
+                                                                   response_time=response_time,
+                                                                   trace_id=message_in.trace_id,
+                                                                   turn_id=in_flight_task.turn_id,
+                                                                   task_uuid=message_in.task_uuid))
 
         elif isinstance(message_in, FromChannelMessage):
             logger.debug(f'Received message from channel {str(message_in.to_json())}')
@@ -141,22 +357,118 @@ class RabbitMQAgentGateway(RabbitMQTransportBase, AgentGatewayBase):
                                                                    user_id=message_in.user_id,
                                                                    reset_dialog=message_in.reset_dialog))
 
-    async def send_to_service(self, service_name: str, dialog: dict) -> None:
-        task_uuid = str(uuid4())
+    async def send_to_service(self, service_name: str, dialog: dict, trace_id: Optional[str] = None,
+                              turn_id: Optional[str] = None, task_uuid: Optional[str] = None,
+                              delivery_mode: Optional[str] = None, task_timeout: Optional[float] = None,
+                              task_retries: Optional[int] = None) -> None:
+        task_uuid = task_uuid or str(uuid4())
+        dialog_id = dialog.dialog['id'] if isinstance(dialog, DialogReference) else dialog['id']
+        dialog_ref = None
+        if isinstance(dialog, DialogReference):
+            if self._payload_store is not None:
+                # the snapshot is stored once for all tasks of the dialog version
+                await self._payload_store.put(dialog.key, dialog.dialog)
+                dialog, dialog_ref = None, dialog.to_json()
+            else:
+                dialog = dialog.to_dialog()
+
         task = ServiceTaskMessage(agent_name=self._agent_name,
                                   service_name=service_name,
                                   task_uuid=task_uuid,
-                                  dialog=dialog)
-
-        logger.debug(f'Created task {task_uuid} to service {service_name} with dialog state: {str(dialog)}')
-
-        message = Message(body=json.dumps(task.to_json()).encode('utf-8'),
-                          delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                          expiration=self._utterance_lifetime_sec)
-
-        routing_key = SERVICE_ROUTING_KEY_TEMPLATE.format(service_name=service_name)
-        await self._agent_out_exchange.publish(message=message, routing_key=routing_key)
-        logger.debug(f'Published task {task_uuid} with routing key {routing_key}')
+                                  dialog=dialog,
+                                  trace_id=trace_id,
+                                  dialog_ref=dialog_ref)
+
+        logger.debug(f'Created task {task_uuid} (trace {trace_id}) to service {service_name} '
+                     f'with dialog state: {str(dialog_ref or dialog)}')
+
+        in_flight_task = InFlightTask(task, dialog_id, turn_id,
+                                      DELIVERY_MODES[delivery_mode] if delivery_mode else self._delivery_mode,
+                                      task_timeout or self._task_timeout,
+                                      self._task_retries if task_retries is None else task_retries)
+        self._in_flight_tasks[task_uuid] = in_flight_task
+        self._in_flight_counts[service_name] += 1
+        self._in_flight_stats[service_name].sent += 1
+        try:
+            await self._publish_task(in_flight_task)
+        except BaseException:
+            self._finish_task(task_uuid, service_name, 'failed')
+            raise
+
+    async def _publish_task(self, in_flight_task: InFlightTask) -> None:
+        task = in_flight_task.task
+        in_flight_task.deadline_handle = self._loop.call_later(in_flight_task.timeout, self._on_task_deadline,
+                                                               task.task_uuid)
+        message = self._encode_message(task, delivery_mode=in_flight_task.delivery_mode)
+        routing_key = SERVICE_ROUTING_KEY_TEMPLATE.format(service_name=task.service_name)
+        await self._publisher.publish(message=message, routing_key=routing_key)
+        logger.debug(f'Published task {task.task_uuid} (attempt {in_flight_task.attempts}) '
+                     f'with routing key {routing_key}')
+
+    def _finish_task(self, task_uuid: str, service_name: str, outcome: str) -> Optional[InFlightTask]:
+        """Removes the task from in-flight tasks, returns None if it was not in flight."""
+        in_flight_task = self._in_flight_tasks.pop(task_uuid, None)
+        if in_flight_task is None:
+            stats = self._in_flight_stats[service_name]
+            if self._finished_tasks.get(task_uuid) == 'answered':
+                stats.duplicates += 1
+                logger.debug(f'Dropped duplicate response to task {task_uuid} of service {service_name}')
+            else:
+                stats.late += 1
+                logger.debug(f'Dropped late response to task {task_uuid} of service {service_name}')
+            return None
+        if in_flight_task.deadline_handle is not None:
+            in_flight_task.deadline_handle.cancel()
+        self._in_flight_counts[in_flight_task.task.service_name] -= 1
+        self._finished_tasks[task_uuid] = outcome
+        while len(self._finished_tasks) > self._finished_tasks_size:
+            self._finished_tasks.popitem(last=False)
+        return in_flight_task
+
+    def _on_task_deadline(self, task_uuid: str) -> None:
+        in_flight_task = self._in_flight_tasks.get(task_uuid)
+        if in_flight_task is None:
+            return
+        task = in_flight_task.task
+        stats = self._in_flight_stats[task.service_name]
+        if in_flight_task.attempts <= in_flight_task.retries:
+            # the task is left in the queue of the service, so any free instance may take it
+            in_flight_task.attempts += 1
+            stats.retried += 1
+            logger.warning(f'Task {task_uuid} of service {task.service_name} timed out, retrying')
+            retry = asyncio.ensure_future(self._publish_task(in_flight_task))
+            self._retry_tasks.add(retry)
+            retry.add_done_callback(self._on_retry_done)
+            return
+
+        self._finish_task(task_uuid, task.service_name, 'expired')
+        stats.expired += 1
+        logger.warning(f'Task {task_uuid} of service {task.service_name} expired after {in_flight_task.attempts} '
+                       f'attempts')
+        if self._on_service_callback is not None:
+            self._loop.create_task(self._on_service_callback(dialog_id=in_flight_task.dialog_id,
+                                                             service_name=task.service_name,
+                                                             response=None,
+                                                             trace_id=task.trace_id,
+                                                             turn_id=in_flight_task.turn_id,
+                                                             task_uuid=task_uuid,
+                                                             timed_out=True))
+
+    def cancel_tasks(self, task_uuids: List[str]) -> None:
+        """Stops tracking tasks the agent does not wait for anymore, so they are neither retried nor expired."""
+        for task_uuid in task_uuids:
+            in_flight_task = self._in_flight_tasks.get(task_uuid)
+            if in_flight_task is None:
+                continue
+            service_name = in_flight_task.task.service_name
+            self._finish_task(task_uuid, service_name, 'cancelled')
+            self._in_flight_stats[service_name].cancelled += 1
+            logger.debug(f'Cancelled task {task_uuid} of service {service_name}')
+
+    def _on_retry_done(self, retry: asyncio.Task) -> None:
+        self._retry_tasks.discard(retry)
+        if not retry.cancelled() and retry.exception() is not None:
+            logger.error(f'Failed to retry a task: {repr(retry.exception())}')
 
     async def send_to_channel(self, channel_id: str, user_id: str, response: str) -> None:
         channel_message = ToChannelMessage(agent_name=self._agent_name,
@@ -164,35 +476,48 @@ class RabbitMQAgentGateway(RabbitMQTransportBase, AgentGatewayBase):
                                            user_id=user_id,
                                            response=response)
 
-        channel_message_json = channel_message.to_json()
-        message = Message(body=json.dumps(channel_message_json).encode('utf-8'),
-                          delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                          expiration=self._utterance_lifetime_sec)
-
+        message = self._encode_message(channel_message)
         routing_key = CHANNEL_ROUTING_KEY_TEMPLATE.format(agent_name=self._agent_name, channel_id=channel_id)
-        await self._agent_out_exchange.publish(message=message, routing_key=routing_key)
-        logger.debug(f'Published channel message: {str(channel_message_json)}')
+        await self._publisher.publish(message=message, routing_key=routing_key)
+        logger.debug(f'Published channel message: {str(channel_message.to_json())}')
 
 
-# TODO: add separate service infer timeouts
 class RabbitMQServiceGateway(RabbitMQTransportBase, ServiceGatewayBase):
+    """Consumes service tasks in batches and passes them to the service connector.
+
+    Incoming tasks are collected into batches of up to ``batch_size`` tasks, a partial batch is sent after
+    ``max_batch_wait_ms`` from its first task. Up to ``max_in_flight`` batches are processed by the service at once,
+    while all of them are busy, tasks keep filling the next batch. Every task message is acknowledged when its
+    response is sent. Tasks of a failed or timed out batch are requeued once and then rejected.
+    """
+
     _service_name: str
     _instance_id: str
     _batch_size: int
-    _incoming_messages_buffer: List[IncomingMessage]
-    _add_to_buffer_lock: asyncio.Lock
-    _infer_lock: asyncio.Lock
+    _max_batch_wait: float
+    _max_in_flight: int
+    _infer_timeout: float
+    _pending_messages: List[Tuple[IncomingMessage, float]]
+    _batch_handle: Optional[asyncio.Handle]
+    _payload_store: Optional[PayloadStore]
 
     def __init__(self, config: dict, to_service_callback: Callable) -> None:
         super(RabbitMQServiceGateway, self).__init__(config=config, to_service_callback=to_service_callback)
         self._loop = asyncio.get_event_loop()
-        self._service_name = self._config['service']['name']
-        self._instance_id = self._config['service'].get('instance_id', None) or f'{self._service_name}{str(uuid4())}'
-        self._batch_size = self._config['service'].get('batch_size', 1)
-
-        self._incoming_messages_buffer = []
-        self._add_to_buffer_lock = asyncio.Lock()
-        self._infer_lock = asyncio.Lock()
+        service_config = self._config['service']
+        self._service_name = service_config['name']
+        self._instance_id = service_config.get('instance_id', None) or f'{self._service_name}{str(uuid4())}'
+        self._batch_size = service_config.get('batch_size', 1)
+        self._max_batch_wait = service_config.get('max_batch_wait_ms', 10) / 1000
+        self._max_in_flight = service_config.get('max_in_flight', 1)
+        self._infer_timeout = service_config.get('timeout') or self._utterance_lifetime_sec
+        self._payload_store = make_payload_store(self._config.get('payload_store', {}), self._utterance_lifetime_sec)
+
+        self._pending_messages = []
+        self._batch_handle = None
+        self._in_flight = 0
+        self._batch_tasks = set()
+        self.stats = BatchingStats()
 
         self._loop.run_until_complete(self._connect())
         self._loop.run_until_complete(self._setup_queues())
@@ -221,82 +546,125 @@ class RabbitMQServiceGateway(RabbitMQTransportBase, ServiceGatewayBase):
             await self._in_queue.bind(exchange=self._agent_out_exchange, routing_key=this_instance_routing_key)
             logger.info(f'Queue: {in_queue_name} bound to routing key: {this_instance_routing_key}')
 
-        await self._agent_out_channel.set_qos(prefetch_count=self._batch_size * 2)
+        # enough unacknowledged tasks for all batches in process and the next batch
+        await self._agent_out_channel.set_qos(prefetch_count=self._batch_size * (self._max_in_flight + 1))
 
     async def _on_message_callback(self, message: IncomingMessage) -> None:
-        await self._add_to_buffer_lock.acquire()
-        self._incoming_messages_buffer.append(message)
+        self._pending_messages.append((message, time.time()))
         logger.debug('Incoming message received')
-
-        if len(self._incoming_messages_buffer) < self._batch_size:
-            self._add_to_buffer_lock.release()
-
-        await self._infer_lock.acquire()
-        try:
-            messages_batch = self._incoming_messages_buffer
-
-            if messages_batch:
-                self._incoming_messages_buffer = []
-
-                if self._add_to_buffer_lock.locked():
-                    self._add_to_buffer_lock.release()
-
-                tasks_batch = [ServiceTaskMessage.from_json(json.loads(message.body, encoding='utf-8'))
-                               for message in messages_batch]
-
-                # TODO: Think about proper infer errors and aknowledge handling
-                processed_ok = await self._process_tasks(tasks_batch)
-
-                if processed_ok:
-                    for message in messages_batch:
-                        await message.ack()
-                else:
-                    for message in messages_batch:
-                        await message.reject()
-
-            elif self._add_to_buffer_lock.locked():
-                self._add_to_buffer_lock.release()
-        finally:
-            self._infer_lock.release()
-
-    async def _process_tasks(self, tasks_batch: List[ServiceTaskMessage]) -> bool:
-        task_uuids_batch, dialogs_batch = \
-            zip(*[(task.task_uuid, task.dialog) for task in tasks_batch])
-
+        if len(self._pending_messages) >= self._batch_size:
+            self._flush_batches()
+        elif self._batch_handle is None:
+            self._batch_handle = self._loop.call_later(self._max_batch_wait, self._flush_batches)
+
+    def _flush_batches(self) -> None:
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._batch_handle = None
+        # tasks wait for a free slot in the pending batch
+        while self._pending_messages and self._in_flight < self._max_in_flight:
+            batch = self._pending_messages[:self._batch_size]
+            del self._pending_messages[:self._batch_size]
+            now = time.time()
+            self.stats.register_batch(self._batch_size, [now - receive_time for _, receive_time in batch])
+            self._in_flight += 1
+            task = asyncio.ensure_future(self._process_batch([message for message, _ in batch]))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._on_batch_done)
+
+    def _on_batch_done(self, task: asyncio.Task) -> None:
+        self._batch_tasks.discard(task)
+        self._in_flight -= 1
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f'Batch processing failed: {repr(task.exception())}')
+        # the service is free, tasks collected meanwhile are sent without waiting for the batch to fill
+        if self._pending_messages:
+            self._flush_batches()
+
+    def get_batching_stats(self) -> Dict:
+        return {'in_flight': self._in_flight, 'pending': len(self._pending_messages), **self.stats.to_dict()}
+
+    async def _decode_tasks(self, messages: List[IncomingMessage]) \
+            -> List[Tuple[IncomingMessage, ServiceTaskMessage, Codec]]:
+        tasks_batch = []
+        for message in messages:
+            try:
+                task = self._decode_message(message)
+            except Exception:
+                logger.exception('Failed to decode task message, message is rejected')
+                await message.reject()
+                continue
+            # responses are encoded with a codec accepted by the agent
+            tasks_batch.append((message, task, choose_codec(message.headers.get(ACCEPT_HEADER), self._codec)))
+        return tasks_batch
+
+    async def _resolve_dialogs(self, tasks_batch: List[Tuple[IncomingMessage, ServiceTaskMessage, Codec]]) \
+            -> List[Tuple[IncomingMessage, ServiceTaskMessage, Codec]]:
+        resolved_tasks = []
+        for message, task, reply_codec in tasks_batch:
+            if task.dialog_ref is not None:
+                snapshot = None
+                if self._payload_store is not None:
+                    snapshot = await self._payload_store.get(task.dialog_ref['key'], task.dialog_ref['dialog_fields'])
+                if snapshot is None:
+                    # tasks with expired dialog snapshots can not be processed
+                    logger.warning(f'Dialog snapshot {task.dialog_ref["key"]} of task {task.task_uuid} was not found')
+                    await message.reject()
+                    continue
+                task.dialog = resolve_dialog_reference(snapshot, task.dialog_ref)
+            resolved_tasks.append((message, task, reply_codec))
+        return resolved_tasks
+
+    async def _process_batch(self, messages: List[IncomingMessage]) -> None:
+        tasks_batch = await self._resolve_dialogs(await self._decode_tasks(messages))
+        if not tasks_batch:
+            return
+
+        task_uuids_batch = [task.task_uuid for _, task, _ in tasks_batch]
         logger.debug(f'Prepared for infering tasks {str(task_uuids_batch)}')
 
         try:
-            responses_batch = await asyncio.wait_for(self._to_service_callback(dialogs_batch),
-                                                     self._utterance_lifetime_sec)
-
-            results_replies = []
-
-            for i, response in enumerate(responses_batch):
-                results_replies.append(
-                    self._send_results(tasks_batch[i], response)
-                )
-
-            await asyncio.gather(*results_replies)
-            logger.debug(f'Processed tasks {str(task_uuids_batch)}')
-            return True
-        except asyncio.TimeoutError:
-            return False
-
-    async def _send_results(self, task: ServiceTaskMessage, response: Dict) -> None:
+            responses_batch = await asyncio.wait_for(
+                self._to_service_callback([task.dialog for _, task, _ in tasks_batch]), self._infer_timeout)
+        except Exception as e:
+            logger.error(f'Failed to process tasks {str(task_uuids_batch)}: {repr(e)}')
+            for message, _, _ in tasks_batch:
+                await self._requeue_or_reject(message)
+            return
+
+        results = await asyncio.gather(*[self._send_results(task, reply_codec, response)
+                                         for (_, task, reply_codec), response in zip(tasks_batch, responses_batch)],
+                                       return_exceptions=True)
+        for (message, task, _), result in zip(tasks_batch, results):
+            if isinstance(result, BaseException):
+                logger.error(f'Failed to send response for task {task.task_uuid}: {repr(result)}')
+                await self._requeue_or_reject(message)
+            else:
+                await message.ack()
+        logger.debug(f'Processed tasks {str(task_uuids_batch)}')
+
+    @staticmethod
+    async def _requeue_or_reject(message: IncomingMessage) -> None:
+        # a task is retried once, possibly by another service instance
+        if message.redelivered:
+            await message.reject()
+        else:
+            await message.nack(requeue=True)
+
+    async def _send_results(self, task: ServiceTaskMessage, codec: Codec, response: Dict) -> None:
         result = ServiceResponseMessage(agent_name=task.agent_name,
                                         task_uuid=task.task_uuid,
                                         service_name=task.service_name,
                                         service_instance_id=self._instance_id,
                                         dialog_id=task.dialog['id'],
-                                        response=response)
-
-        message = Message(body=json.dumps(result.to_json()).encode('utf-8'),
-                          delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                          expiration=self._utterance_lifetime_sec)
+                                        response=response,
+                                        trace_id=task.trace_id)
 
+        message = self._encode_message(result, codec)
         routing_key = AGENT_ROUTING_KEY_TEMPLATE.format(agent_name=task.agent_name)
         await self._agent_in_exchange.publish(message=message, routing_key=routing_key)
-        logger.debug(f'Sent response for task {str(task.task_uuid)} with routing key {routing_key}')
+        logger.debug(f'Sent response for task {str(task.task_uuid)} (trace {task.trace_id}) '
+                     f'with routing key {routing_key}')
 
 
 class RabbitMQChannelGateway(RabbitMQTransportBase, ChannelGatewayBase):
@@ -329,11 +697,10 @@ class RabbitMQChannelGateway(RabbitMQTransportBase, ChannelGatewayBase):
         logger.info(f'Queue: {in_queue_name} bound to routing key: {routing_key}')
 
     async def _on_message_callback(self, message: IncomingMessage) -> None:
-        message_json = json.loads(message.body, encoding='utf-8')
-        message_to_channel: ToChannelMessage = ToChannelMessage.from_json(message_json)
+        message_to_channel: ToChannelMessage = self._decode_message(message)
         await self._loop.create_task(self._to_channel_callback(message_to_channel.user_id, message_to_channel.response))
         await message.ack()
-        logger.debug(f'Processed message to channel: {str(message_json)}')
+        logger.debug(f'Processed message to channel: {str(message_to_channel.to_json())}')
 
     async def send_to_agent(self, utterance: str, channel_id: str, user_id: str, reset_dialog: bool) -> None:
         message_from_channel = FromChannelMessage(agent_name=self._agent_name,
@@ -342,11 +709,7 @@ class RabbitMQChannelGateway(RabbitMQTransportBase, ChannelGatewayBase):
                                                   utterance=utterance,
                                                   reset_dialog=reset_dialog)
 
-        message_json = message_from_channel.to_json()
-        message = Message(body=json.dumps(message_json).encode('utf-8'),
-                          delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                          expiration=self._utterance_lifetime_sec)
-
+        message = self._encode_message(message_from_channel)
         routing_key = AGENT_ROUTING_KEY_TEMPLATE.format(agent_name=self._agent_name)
         await self._agent_in_exchange.publish(message=message, routing_key=routing_key)
-        logger.debug(f'Processed message to agent: {str(message_json)}')
+        logger.debug(f'Processed message to agent: {str(message_from_channel.to_json())}')
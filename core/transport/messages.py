@@ -1,55 +1,73 @@
-from typing import TypeVar, Any, Dict
+from typing import TypeVar, Any, Dict, Optional
 
 
 class MessageBase:
+    __slots__ = ('msg_type', 'agent_name')
+    _fields = __slots__
 
     def __init__(self, msg_type: str, agent_name: str):
         self.msg_type = msg_type
         self.agent_name = agent_name
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # fields of the message with fields of base classes
+        cls._fields = tuple(field for klass in reversed(cls.__mro__) for field in klass.__dict__.get('__slots__', ()))
+
     @classmethod
     def from_json(cls, message_json):
         return cls(**message_json)
 
     def to_json(self) -> dict:
-        return self.__dict__
+        return {field: getattr(self, field) for field in self._fields}
 
 
 TMessageBase = TypeVar('TMessageBase', bound=MessageBase)
 
 
 class ServiceTaskMessage(MessageBase):
+    __slots__ = ('service_name', 'task_uuid', 'dialog', 'trace_id', 'dialog_ref')
     agent_name: str
     service_name: str
     task_uuid: str
-    dialog: Dict
+    dialog: Optional[Dict]
+    trace_id: Optional[str]
+    dialog_ref: Optional[Dict]
 
-    def __init__(self, agent_name: str, service_name: str, task_uuid: str, dialog: Dict) -> None:
+    def __init__(self, agent_name: str, service_name: str, task_uuid: str, dialog: Optional[Dict],
+                 trace_id: Optional[str] = None, dialog_ref: Optional[Dict] = None) -> None:
         super().__init__('service_task', agent_name)
         self.service_name = service_name
         self.task_uuid = task_uuid
+        # with the payload store the dialog is passed by dialog_ref and resolved by the service gateway
         self.dialog = dialog
+        self.trace_id = trace_id
+        self.dialog_ref = dialog_ref
 
 
 class ServiceResponseMessage(MessageBase):
+    __slots__ = ('task_uuid', 'service_name', 'service_instance_id', 'dialog_id', 'response', 'trace_id')
     agent_name: str
     task_uuid: str
     service_name: str
     service_instance_id: str
     dialog_id: str
     response: Any
+    trace_id: Optional[str]
 
     def __init__(self, agent_name: str, task_uuid: str, service_name: str, service_instance_id: str, dialog_id: str,
-                 response: Any) -> None:
+                 response: Any, trace_id: Optional[str] = None) -> None:
         super().__init__('service_response', agent_name)
         self.task_uuid = task_uuid
         self.service_name = service_name
         self.service_instance_id = service_instance_id
         self.dialog_id = dialog_id
         self.response = response
+        self.trace_id = trace_id
 
 
 class ToChannelMessage(MessageBase):
+    __slots__ = ('channel_id', 'user_id', 'response')
     agent_name: str
     channel_id: str
     user_id: str
@@ -63,6 +81,7 @@ class ToChannelMessage(MessageBase):
 
 
 class FromChannelMessage(MessageBase):
+    __slots__ = ('channel_id', 'user_id', 'utterance', 'reset_dialog')
     agent_name: str
     channel_id: str
     user_id: str
@@ -0,0 +1,188 @@
+import asyncio
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import datetime
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+
+def payload_key(dialog_id: str, turn_id: str, dialog_version: int) -> str:
+    # dialog versions are counted from zero on every turn, so the turn id keeps keys of the turns apart
+    return f'{dialog_id}:{turn_id}:{dialog_version}'
+
+
+def project_dialog(dialog: Dict, history_window: Optional[int] = None,
+                   dialog_fields: Optional[List[str]] = None) -> Dict:
+    if dialog_fields:
+        dialog = {field: dialog[field] for field in ['id', *dialog_fields] if field in dialog}
+    if history_window and len(dialog.get('utterances', [])) > history_window:
+        dialog = {**dialog, 'utterances': dialog['utterances'][-history_window:]}
+    return dialog
+
+
+class DialogReference:
+    """Payload of a service behind the payload store: the dialog state of the turn version.
+
+    All services called with the same dialog version share a single stored snapshot of the dialog, a task carries
+    its key and the part of the dialog the service needs: the history window and the dialog fields.
+    """
+
+    def __init__(self, dialog: Dict, turn_id: str, dialog_version: int, history_window: Optional[int] = None,
+                 dialog_fields: Optional[List[str]] = None) -> None:
+        self.dialog = dialog
+        self.turn_id = turn_id
+        self.dialog_version = dialog_version
+        self.history_window = history_window
+        self.dialog_fields = dialog_fields
+
+    @property
+    def key(self) -> str:
+        return payload_key(self.dialog['id'], self.turn_id, self.dialog_version)
+
+    def to_json(self) -> Dict:
+        return {'key': self.key, 'history_window': self.history_window, 'dialog_fields': self.dialog_fields}
+
+    def to_dialog(self) -> Dict:
+        return project_dialog(self.dialog, self.history_window, self.dialog_fields)
+
+
+def dialog_reference_workflow_formatter(workflow_record: Dict, history_window: Optional[int] = None,
+                                        dialog_fields: Optional[List[str]] = None) -> DialogReference:
+    return DialogReference(workflow_record['dialog'], workflow_record['turn_id'], workflow_record['dialog_version'],
+                           history_window, dialog_fields)
+
+
+def resolve_dialog_reference(snapshot: Dict, dialog_ref: Dict) -> Dict:
+    return project_dialog(snapshot, dialog_ref.get('history_window'), dialog_ref.get('dialog_fields'))
+
+
+class PayloadStoreStats:
+    def __init__(self):
+        self.stored = 0
+        self.deduplicated = 0
+        self.fetched = 0
+        self.missing = 0
+
+    def to_dict(self) -> Dict:
+        return {'stored': self.stored,
+                'deduplicated': self.deduplicated,
+                'fetched': self.fetched,
+                'missing': self.missing}
+
+
+class PayloadStore:
+    """Stores dialog snapshots for the fan-out of a turn version to services.
+
+    A snapshot is written once per key however many tasks refer to it, concurrent writes of the same key wait for
+    the first one. Subclasses implement ``_put`` and ``_get``, snapshots older than ``ttl_sec`` may be expired.
+    """
+
+    def __init__(self, ttl_sec: float, recent_keys_size: int = 10000) -> None:
+        self.ttl_sec = ttl_sec
+        self.recent_keys_size = recent_keys_size
+        self.stats = PayloadStoreStats()
+        self._puts: Dict[str, asyncio.Future] = OrderedDict()
+
+    async def ensure_indexes(self) -> None:
+        pass
+
+    async def put(self, key: str, payload: Dict) -> None:
+        put = self._puts.get(key)
+        if put is not None and not (put.done() and (put.cancelled() or put.exception() is not None)):
+            self.stats.deduplicated += 1
+            await asyncio.shield(put)
+            return
+        # the dialog keeps changing during the turn, so it is copied before the write is scheduled
+        put = asyncio.ensure_future(self._put(key, deepcopy(payload)))
+        self._puts[key] = put
+        while len(self._puts) > self.recent_keys_size:
+            self._puts.popitem(last=False)
+        await asyncio.shield(put)
+        self.stats.stored += 1
+
+    async def get(self, key: str, dialog_fields: Optional[List[str]] = None) -> Optional[Dict]:
+        payload = await self._get(key, dialog_fields)
+        if payload is None:
+            self.stats.missing += 1
+        else:
+            self.stats.fetched += 1
+        return payload
+
+    async def _put(self, key: str, payload: Dict) -> None:
+        raise NotImplementedError
+
+    async def _get(self, key: str, dialog_fields: Optional[List[str]] = None) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def get_stats(self) -> Dict:
+        return self.stats.to_dict()
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryPayloadStore(PayloadStore):
+    """Keeps snapshots in the process memory, for the agent and services running in one process."""
+
+    def __init__(self, ttl_sec: float, max_size: int = 10000) -> None:
+        super().__init__(ttl_sec, max_size)
+        self.max_size = max_size
+        self._payloads: Dict[str, Tuple[float, Dict]] = OrderedDict()
+
+    async def _put(self, key: str, payload: Dict) -> None:
+        self._payloads[key] = (monotonic(), payload)
+        self._payloads.move_to_end(key)
+        now = monotonic()
+        while self._payloads:
+            oldest_key, (put_time, _) = next(iter(self._payloads.items()))
+            if len(self._payloads) <= self.max_size and now - put_time <= self.ttl_sec:
+                break
+            del self._payloads[oldest_key]
+
+    async def _get(self, key: str, dialog_fields: Optional[List[str]] = None) -> Optional[Dict]:
+        stored = self._payloads.get(key)
+        if stored is None or monotonic() - stored[0] > self.ttl_sec:
+            return None
+        return project_dialog(stored[1], dialog_fields=dialog_fields)
+
+
+class MongoPayloadStore(PayloadStore):
+    """Keeps snapshots in a MongoDB collection expired by a TTL index, shared by the agent and services."""
+
+    def __init__(self, host: str, port: int, db_name: str, collection: str = 'transport_payloads',
+                 ttl_sec: float = 120) -> None:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        super().__init__(ttl_sec)
+        self.client = AsyncIOMotorClient(host=host, port=int(port))
+        self.collection = self.client[db_name][collection]
+
+    async def ensure_indexes(self) -> None:
+        await self.collection.create_index('created_at', expireAfterSeconds=int(self.ttl_sec), background=True)
+
+    async def _put(self, key: str, payload: Dict) -> None:
+        await self.collection.replace_one({'_id': key}, {'_id': key, 'payload': payload,
+                                                         'created_at': datetime.utcnow()}, upsert=True)
+
+    async def _get(self, key: str, dialog_fields: Optional[List[str]] = None) -> Optional[Dict]:
+        projection = {f'payload.{field}': 1 for field in dialog_fields + ['id']} if dialog_fields else None
+        document = await self.collection.find_one({'_id': key}, projection)
+        return document['payload'] if document else None
+
+    async def close(self) -> None:
+        self.client.close()
+
+
+def make_payload_store(config: Dict, ttl_sec: float) -> Optional[PayloadStore]:
+    if not config.get('enabled'):
+        return None
+    ttl_sec = config.get('ttl_sec') or ttl_sec
+    store_type = config.get('type', 'mongo')
+    if store_type == 'memory':
+        return MemoryPayloadStore(ttl_sec, config.get('max_size', 10000))
+    elif store_type == 'mongo':
+        from core.transform_config import DB_HOST, DB_PORT, DB_NAME
+        return MongoPayloadStore(config.get('host') or DB_HOST, config.get('port') or DB_PORT,
+                                 config.get('db_name') or DB_NAME, config.get('collection', 'transport_payloads'),
+                                 ttl_sec)
+    raise ValueError(f'unknown payload store type {store_type}')
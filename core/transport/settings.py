@@ -3,6 +3,36 @@ TRANSPORT_SETTINGS = {
     'agent_name': 'dp_agent',
     'utterance_lifetime_sec': 120,
     'channels': {},
+    # codec of transport messages: 'json', 'orjson' or 'msgpack' (the last two need orjson or msgpack packages).
+    # Messages are decoded by their content type, replies are encoded with a codec accepted by the sender
+    'codec': 'json',
+    # agent messages publishing: channel_pool_size channels are used for publishing, with publisher_confirms
+    # a task is sent when the broker confirmed it. delivery_mode is 'persistent' or 'transient' (not saved to disk
+    # by the broker, lower latency), it can be overridden for a service with "delivery_mode" key
+    'publisher': {
+        'channel_pool_size': 1,
+        'publisher_confirms': True,
+        'confirm_timeout': None,
+        'delivery_mode': 'persistent'
+    },
+    # dialog snapshots for services called with the same dialog state in a turn are stored once in the payload
+    # store ('mongo' collection or process 'memory'), tasks carry only the snapshot key, the service history window
+    # and the dialog fields from "dialog_fields" service config key. Snapshots expire in ttl_sec
+    # (utterance_lifetime_sec by default). The MongoDB of the agent is used if host, port and db_name are not set
+    'payload_store': {
+        'enabled': False,
+        'type': 'mongo',
+        'collection': 'transport_payloads',
+        'ttl_sec': None
+    },
+    # sent service tasks are tracked until they are answered: a task not answered in timeout_sec
+    # (utterance_lifetime_sec by default) is sent again up to retries times and then the service is skipped.
+    # Can be overridden for a service with "task_timeout" and "task_retries" keys
+    'tasks': {
+        'timeout_sec': None,
+        'retries': 1,
+        'finished_tasks_size': 10000
+    },
     'transport': {
         'type': 'AMQP',
         'AMQP': {
@@ -10,8 +10,10 @@ from random import choice
 from core.service import Service
 from core.connectors import HttpOutputConnector
 from core.config_parser import parse_old_config
+from core.memory_state_manager import MemoryStateManager
 from core.state_manager import StateManager
 from core.run import prepare_agent
+from state_formatters.output_formatters import http_api_output_formatter
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', '--port', help='port for http client, default 4242', default=4242)
@@ -26,7 +28,7 @@ class DummyConnector:
         self.sleeptime = sleeptime
         self.service_name = service_name
 
-    async def send(self, payload, callback):
+    async def send(self, payload, callback, **kwargs):
         service_send_time = time.time()
         await asyncio.sleep(self.sleeptime)
         await callback(
@@ -43,7 +45,7 @@ class DummySelectorConnector:
         self.sleeptime = sleeptime
         self.service_name = service_name
 
-    async def send(self, payload, callback):
+    async def send(self, payload, callback, **kwargs):
         service_send_time = time.time()
         await asyncio.sleep(self.sleeptime)
         await callback(
@@ -55,7 +57,8 @@ class DummySelectorConnector:
 
 
 async def on_shutdown(app):
-    await app['client_session'].close()
+    if app['client_session']:
+        await app['client_session'].close()
 
 
 async def init_app(register_msg, intermediate_storage, on_startup, on_shutdown_func=on_shutdown):
@@ -103,14 +106,15 @@ async def api_message_processor(register_msg, intermediate_storage):
 
             if bot_response is None:
                 raise RuntimeError('Got None instead of a bot response.')
+            response = http_api_output_formatter(bot_response)
 
-        return web.json_response({'user_id': user_id, 'response': bot_response})
+        return web.json_response(response)
 
     return api_handle
 
 
 def main():
-    services, workers, session = parse_old_config()
+    services, workers, session, gateway = parse_old_config()
 
     for s in services:
         if 'RESPONSE_SELECTORS' in s.tags:
@@ -121,10 +125,13 @@ def main():
             s.connector_func = DummyConnector(['we have a phrase', 'and another one', 'not so short one'], 0.01,
                                               s.name).send
     intermediate_storage = {}
+    # dialogs are kept in memory, so the agent runs without any external services
+    state_manager = MemoryStateManager()
     endpoint = Service('http_responder', HttpOutputConnector(intermediate_storage, 'http_responder').send,
-                       StateManager.save_dialog_dict, 1, ['responder'])
+                       state_manager.save_dialog_dict, 1, ['responder'])
     input_srv = Service('input', None, StateManager.add_human_utterance_simple_dict, 1, ['input'])
-    register_msg, process_callable = prepare_agent(services, endpoint, input_srv, args.response_logger)
+    agent = prepare_agent(services, endpoint, input_srv, args.response_logger, state_manager)
+    register_msg, process_callable = agent.register_msg, agent.process
     app = init_app(register_msg, intermediate_storage, prepare_startup(workers, process_callable, session),
                    on_shutdown)
 
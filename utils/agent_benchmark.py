@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import gc
+import json
+import tracemalloc
+from copy import deepcopy
+from time import perf_counter, process_time
+from typing import Dict, List
+
+from core.agent import Agent
+from core.connectors import ConfidenceResponseSelectorConnector, EventSetOutputConnector
+from core.memory_state_manager import MemoryStateManager
+from core.pipeline import Pipeline, simple_workflow_formatter
+from core.service import Service
+from core.state_manager import StateManager
+
+'''
+Measures the agent own overhead without network and database: Pipeline and Agent are built with in-memory fake
+service connectors and an in-memory state manager, N concurrent synthetic dialogs perform turns through
+"layers" of "width" annotators, "width" skills and the confidence response selector.
+
+Reports per-turn wall time and CPU time, event loop lag, garbage collections and, with -a, memory allocated per
+turn and top allocation sites in core/ (tracemalloc slows the run, so allocations are measured in a separate run).
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--dialogs', help='concurrent dialogs count', type=int, default=100)
+parser.add_argument('-t', '--turns', help='turns per dialog', type=int, default=10)
+parser.add_argument('-l', '--layers', help='annotator layers count', type=int, default=2)
+parser.add_argument('-w', '--width', help='services per pipeline layer', type=int, default=5)
+parser.add_argument('-hl', '--history', help='utterances in dialogs before the benchmark', type=int, default=0)
+parser.add_argument('-hw', '--history-window', help='agent dialog history window', type=int, default=20)
+parser.add_argument('-sl', '--service-latency', help='fake service latency in ms', type=float, default=0)
+parser.add_argument('--lag-interval', help='event loop lag probe interval in ms', type=float, default=5)
+parser.add_argument('-a', '--allocations', help='measure allocations in a separate run', action='store_true')
+parser.add_argument('-o', '--output', help='file to write results to as JSON', type=str)
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+class FakeConnector:
+    def __init__(self, service_name: str, response, latency: float):
+        self.service_name = service_name
+        self.response = response
+        self.latency = latency
+
+    async def send(self, payload: Dict, callback, turn_id=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        await callback(dialog_id=payload['id'], service_name=self.service_name,
+                       response={self.service_name: deepcopy(self.response)}, turn_id=turn_id)
+
+
+def make_agent(args) -> Agent:
+    latency = args.service_latency / 1000
+    services = []
+    previous_names = set()
+    for layer in range(args.layers):
+        annotators = [Service(f'annotator_{layer}_{i}',
+                              FakeConnector(f'annotator_{layer}_{i}', {'labels': ['benchmark']}, latency).send,
+                              StateManager.add_annotation_dict, 1, [f'ANNOTATORS_{layer + 1}'], previous_names,
+                              simple_workflow_formatter)
+                      for i in range(args.width)]
+        services.extend(annotators)
+        previous_names = {s.name for s in annotators}
+    skills = [Service(f'skill_{i}',
+                      FakeConnector(f'skill_{i}', [{'text': f'skill {i} response', 'confidence': i / args.width}],
+                                    latency).send,
+                      StateManager.add_hypothesis_dict, 1, ['SKILLS'], previous_names, simple_workflow_formatter)
+              for i in range(args.width)]
+    services.extend(skills)
+    services.append(Service('confidence_response_selector',
+                            ConfidenceResponseSelectorConnector('confidence_response_selector').send,
+                            StateManager.add_bot_utterance_simple_dict, 1, ['RESPONSE_SELECTORS'],
+                            {s.name for s in skills}, simple_workflow_formatter))
+
+    state_manager = MemoryStateManager()
+    pipeline = Pipeline(services)
+    pipeline.add_responder_service(Service('responder', EventSetOutputConnector('responder').send,
+                                           state_manager.save_dialog_dict, 1, ['responder']))
+    pipeline.add_input_service(Service('input', None, StateManager.add_human_utterance_simple_dict, 1, ['input']))
+    return Agent(pipeline, state_manager, history_window=args.history_window)
+
+
+async def prefill_history(agent: Agent, user_ids: List[str], history: int) -> None:
+    state_manager = agent.state_manager
+    for user_id in user_ids:
+        user = state_manager.get_or_create_user(user_id, 'benchmark')
+        dialog_object = state_manager.get_or_create_dialog(user, 'lab', 'benchmark')
+        dialog = dialog_object.to_dict()
+        for i in range(history // 2):
+            state_manager.add_human_utterance_simple_dict(dialog, dialog_object, f'phrase {i}')
+            state_manager.add_bot_utterance_simple_dict(dialog, dialog_object, {'benchmark': {
+                'text': f'response {i}', 'confidence': 0.5, 'skill_name': 'benchmark'}})
+        state_manager.save_dialog_dict(dialog, dialog_object)
+
+
+async def probe_loop_lag(interval: float, lags: List[float], stop: asyncio.Event) -> None:
+    loop = asyncio.get_event_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+async def run_dialog(agent: Agent, user_id: str, turns: int, turn_times: List[float]) -> None:
+    for i in range(turns):
+        start = perf_counter()
+        await agent.register_msg(utterance=f'phrase {i}', user_telegram_id=user_id, user_device_type='benchmark',
+                                 location='lab', channel_type='benchmark', require_response=True)
+        turn_times.append(perf_counter() - start)
+
+
+async def run_benchmark(args, trace_allocations: bool = False) -> Dict:
+    agent = make_agent(args)
+    user_ids = [f'user_{i}' for i in range(args.dialogs)]
+    await prefill_history(agent, user_ids, args.history)
+
+    turn_times, lags = [], []
+    stop = asyncio.Event()
+    lag_probe = asyncio.ensure_future(probe_loop_lag(args.lag_interval / 1000, lags, stop))
+    gc_before = sum(stats['collections'] for stats in gc.get_stats())
+    if trace_allocations:
+        tracemalloc.start()
+        snapshot_before = tracemalloc.take_snapshot()
+    start_wall, start_cpu = perf_counter(), process_time()
+
+    await asyncio.gather(*[run_dialog(agent, user_id, args.turns, turn_times) for user_id in user_ids])
+
+    wall_time, cpu_time = perf_counter() - start_wall, process_time() - start_cpu
+    stop.set()
+    await lag_probe
+    turns = len(turn_times)
+    if trace_allocations:
+        _, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().compare_to(snapshot_before, 'lineno')
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in statistics if stat.size_diff > 0)
+        core_statistics = [stat for stat in statistics if '/core/' in stat.traceback[0].filename]
+        return {'retained_kb_per_turn': round(allocated / turns / 1024, 3),
+                'peak_mb': round(peak / 2 ** 20, 3),
+                'top_core_sites': [{'site': f'{stat.traceback[0].filename.split("/core/")[-1]}:'
+                                            f'{stat.traceback[0].lineno}',
+                                    'kb': round(stat.size_diff / 1024, 3), 'blocks': stat.count_diff}
+                                   for stat in core_statistics[:5]]}
+
+    turn_times.sort()
+    lags.sort()
+    return {
+        'turns': turns,
+        'turns_per_sec': round(turns / wall_time, 2),
+        'cpu_ms_per_turn': round(cpu_time / turns * 1000, 4),
+        'turn_ms_p50': round(percentile(turn_times, 0.5) * 1000, 3),
+        'turn_ms_p99': round(percentile(turn_times, 0.99) * 1000, 3),
+        'loop_lag_ms_p50': round(percentile(lags, 0.5) * 1000, 3) if lags else None,
+        'loop_lag_ms_p99': round(percentile(lags, 0.99) * 1000, 3) if lags else None,
+        'loop_lag_ms_max': round(lags[-1] * 1000, 3) if lags else None,
+        'gc_collections_per_turn': round((sum(stats['collections'] for stats in gc.get_stats()) - gc_before) / turns,
+                                         4)
+    }
+
+
+def main():
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    result = {'config': vars(args), **loop.run_until_complete(run_benchmark(args))}
+    if args.allocations:
+        result['allocations'] = loop.run_until_complete(run_benchmark(args, trace_allocations=True))
+
+    for key, value in result.items():
+        if key not in ('config', 'allocations'):
+            print(f'{key}\t{value}')
+    if args.allocations:
+        allocations = result['allocations']
+        print(f'retained_kb_per_turn\t{allocations["retained_kb_per_turn"]}\npeak_mb\t{allocations["peak_mb"]}')
+        for site in allocations['top_core_sites']:
+            print(f'{site["site"]}\t{site["kb"]} kb\t{site["blocks"]} blocks')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
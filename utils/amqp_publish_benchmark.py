@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import json
+from time import perf_counter
+from typing import Dict, List
+
+import aio_pika
+from aio_pika import Message
+
+from core.transport.gateways.rabbitmq import RabbitMQPublisher, DELIVERY_MODES
+
+'''
+Measures tasks publishing throughput and per-turn publishing latency of the agent gateway against a local broker
+stand-in, so publishing settings can be compared without a RabbitMQ server.
+
+The stand-in models a broker channel: frames of a channel are written one after another (--write-cost), persistent
+messages are written to disk one after another per channel (--persist-cost) and a publisher confirm arrives one
+round trip (--rtt) after the message is handled. Every turn publishes --width tasks at once, like the agent
+dispatching all next services of a turn, --turns turns are run with --concurrency turns at a time.
+
+Compared variants:
+direct - every task is published on a single channel as soon as it is sent, the previous agent gateway behaviour;
+pool - tasks are queued to RabbitMQPublisher with --pool-size channels, persistent delivery with confirms;
+transient - the same with transient delivery mode;
+no_confirms - the same with transient delivery mode and without publisher confirms.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-t', '--turns', help='turns count', type=int, default=2000)
+parser.add_argument('-w', '--width', help='tasks published per turn', type=int, default=10)
+parser.add_argument('-c', '--concurrency', help='concurrent turns', type=int, default=50)
+parser.add_argument('-p', '--pool-size', help='publisher channels count', type=int, default=4)
+parser.add_argument('--rtt', help='broker round trip time in ms', type=float, default=1)
+parser.add_argument('--write-cost', help='channel frame write time per message in ms', type=float, default=0.01)
+parser.add_argument('--persist-cost', help='persistent message write time in ms', type=float, default=0.5)
+parser.add_argument('-o', '--output', help='file to write results to as JSON', type=str)
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+class StandInExchange:
+    def __init__(self, channel: 'StandInChannel'):
+        self.channel = channel
+
+    async def publish(self, message: Message, routing_key: str, timeout=None) -> None:
+        await self.channel.handle(message)
+
+
+class StandInChannel:
+    def __init__(self, args, publisher_confirms: bool):
+        self.loop = asyncio.get_event_loop()
+        self.rtt = args.rtt / 1000
+        self.write_cost = args.write_cost / 1000
+        self.persist_cost = args.persist_cost / 1000
+        self.publisher_confirms = publisher_confirms
+        self.write_free_at = 0.0
+        self.disk_free_at = 0.0
+
+    async def declare_exchange(self, name: str, type=None) -> StandInExchange:
+        return StandInExchange(self)
+
+    async def handle(self, message: Message) -> None:
+        now = self.loop.time()
+        self.write_free_at = max(now, self.write_free_at) + self.write_cost
+        if not self.publisher_confirms:
+            await asyncio.sleep(self.write_free_at - now)
+            return
+        handled_at = self.write_free_at
+        if message.delivery_mode == aio_pika.DeliveryMode.PERSISTENT:
+            self.disk_free_at = max(handled_at, self.disk_free_at) + self.persist_cost
+            handled_at = self.disk_free_at
+        await asyncio.sleep(handled_at + self.rtt - now)
+
+
+class StandInConnection:
+    def __init__(self, args):
+        self.args = args
+
+    async def channel(self, publisher_confirms: bool = True) -> StandInChannel:
+        return StandInChannel(self.args, publisher_confirms)
+
+
+async def run_turns(args, publish) -> Dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    turn_times: List[float] = []
+
+    async def run_turn(turn: int) -> None:
+        async with semaphore:
+            start = perf_counter()
+            await asyncio.gather(*[publish(f'task {turn} {i}'.encode(), f'service.skill_{i}.any')
+                                   for i in range(args.width)])
+            turn_times.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*[run_turn(turn) for turn in range(args.turns)])
+    wall_time = perf_counter() - start
+    turn_times.sort()
+    return {'msgs_per_sec': round(args.turns * args.width / wall_time, 1),
+            'turn_publish_ms_p50': round(percentile(turn_times, 0.5) * 1000, 3),
+            'turn_publish_ms_p99': round(percentile(turn_times, 0.99) * 1000, 3)}
+
+
+async def run_direct(args) -> Dict:
+    channel = await StandInConnection(args).channel()
+    exchange = await channel.declare_exchange('agent_out')
+
+    async def publish(body: bytes, routing_key: str) -> None:
+        message = Message(body=body, delivery_mode=aio_pika.DeliveryMode.PERSISTENT)
+        await exchange.publish(message=message, routing_key=routing_key)
+
+    return await run_turns(args, publish)
+
+
+async def run_publisher(args, delivery_mode: str, publisher_confirms: bool) -> Dict:
+    publisher = RabbitMQPublisher(StandInConnection(args), 'agent_out', pool_size=args.pool_size,
+                                  publisher_confirms=publisher_confirms)
+    await publisher.open()
+
+    async def publish(body: bytes, routing_key: str) -> None:
+        await publisher.publish(Message(body=body, delivery_mode=DELIVERY_MODES[delivery_mode]), routing_key)
+
+    result = await run_turns(args, publish)
+    result['mean_flush_size'] = publisher.get_stats()['mean_flush_size']
+    return result
+
+
+def main():
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    result = {'config': vars(args),
+              'direct': loop.run_until_complete(run_direct(args)),
+              'pool': loop.run_until_complete(run_publisher(args, 'persistent', True)),
+              'transient': loop.run_until_complete(run_publisher(args, 'transient', True)),
+              'no_confirms': loop.run_until_complete(run_publisher(args, 'transient', False))}
+
+    print('variant\tmsgs/sec\tturn publish ms p50\tturn publish ms p99')
+    for variant in ('direct', 'pool', 'transient', 'no_confirms'):
+        r = result[variant]
+        print(f'{variant}\t{r["msgs_per_sec"]}\t{r["turn_publish_ms_p50"]}\t{r["turn_publish_ms_p99"]}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
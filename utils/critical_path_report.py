@@ -0,0 +1,205 @@
+import argparse
+import json
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from core.pipeline import Pipeline
+from core.service import Service
+
+'''
+Finds which services bound the turn latency. Per-turn services timings are read from the traces file written by
+the agent with TRACING enabled (or from JSON lines with workflow records "services" dicts with agent_send_time and
+agent_done_time), the services graph is built from the agent config or read from a JSON file
+{"service name": ["previous service name", ...]}.
+
+For every turn a service is charged with the time from the moment its last previous service was done to its own
+response (agent dispatch delay plus the service call). The critical path goes back from the responder through the
+previous service which was done last, slack of a service is how much later it could have been done without delaying
+the turn. Services are ranked by their total time on critical paths.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--input', help='traces or workflow records file, JSON lines', type=str, required=True)
+parser.add_argument('-g', '--graph', help='services graph JSON file, the agent config is used by default', type=str)
+parser.add_argument('-t', '--tail', help='turn latency percentile of slow turns to report separately', type=float,
+                    default=0.95)
+parser.add_argument('-o', '--output', help='file to write the report to as JSON', type=str)
+
+INPUT_SERVICE = 'input'
+RESPONDER_SERVICE = 'responder'
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+def make_pipeline(previous_services: Dict[str, List[str]]) -> Pipeline:
+    services = [Service(name, None, names_previous_services=set(previous)) for name, previous in
+                previous_services.items()]
+    pipeline = Pipeline(services)
+    pipeline.add_responder_service(Service(RESPONDER_SERVICE, None, tags=['responder']))
+    pipeline.add_input_service(Service(INPUT_SERVICE, None, tags=['input']))
+    return pipeline
+
+
+def make_pipeline_from_config() -> Pipeline:
+    from core.config_parser import parse_old_config
+    services, _, _, _ = parse_old_config()
+    return make_pipeline({service.name: sorted(service.names_previous_services) for service in services})
+
+
+def read_turns(path: str) -> List[Dict[str, Dict]]:
+    """Reads services timings of turns, records with missing send or done time (cancelled services) are skipped."""
+    turns = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'spans' in record:
+                services = {span['name']: {'agent_send_time': span['start_time'],
+                                           'agent_done_time': span['end_time']}
+                            for span in record['spans'] if span['kind'] == 'service'}
+            else:
+                services = record['services']
+            turns.append({name: (data['agent_send_time'], data['agent_done_time']) for name, data in services.items()
+                          if data.get('agent_send_time') and data.get('agent_done_time')})
+    return turns
+
+
+def normalize_names(turn: Dict, pipeline: Pipeline) -> Dict:
+    # the responder name depends on the agent channel (cmd_responder, http_responder, ...)
+    return {name if name in pipeline.services or not name.endswith(RESPONDER_SERVICE) else RESPONDER_SERVICE: times
+            for name, times in turn.items()}
+
+
+def analyze_turn(turn: Dict, pipeline: Pipeline) -> Optional[Dict]:
+    if INPUT_SERVICE not in turn or RESPONDER_SERVICE not in turn:
+        return None
+    services = {name: pipeline.services[name] for name in turn if name in pipeline.services}
+
+    # cost of a service: from its last previous service done to its own done time
+    critical_previous, cost = {}, {}
+    for name, service in services.items():
+        previous = [s.name for s in service.previous_services if s.name in turn]
+        if previous:
+            critical_previous[name] = max(previous, key=lambda p: turn[p][1])
+            ready_time = turn[critical_previous[name]][1]
+        else:
+            critical_previous[name] = None
+            ready_time = turn[name][0]
+        cost[name] = {'dispatch': max(turn[name][0] - ready_time, 0.0),
+                      'service': turn[name][1] - turn[name][0]}
+
+    # latest done time of each service which does not delay the responder
+    latest_done = {RESPONDER_SERVICE: turn[RESPONDER_SERVICE][1]}
+    for name in sorted(services, key=lambda n: turn[n][1], reverse=True):
+        next_services = [s.name for s in services[name].next_services if s.name in latest_done]
+        if name != RESPONDER_SERVICE and next_services:
+            latest_done[name] = min(latest_done[s] - (turn[s][1] - turn[critical_previous[s]][1])
+                                    for s in next_services)
+
+    critical_path = [RESPONDER_SERVICE]
+    while critical_previous.get(critical_path[-1]):
+        critical_path.append(critical_previous[critical_path[-1]])
+
+    return {'latency': turn[RESPONDER_SERVICE][1] - turn[INPUT_SERVICE][0],
+            'critical_path': critical_path[::-1],
+            'cost': cost,
+            'slack': {name: max(latest_done[name] - turn[name][1], 0.0) for name in latest_done}}
+
+
+def make_report(turns: List[Dict], pipeline: Pipeline, tail_q: float) -> Dict:
+    analyzed = [result for result in (analyze_turn(normalize_names(turn, pipeline), pipeline) for turn in turns)
+                if result]
+    if not analyzed:
+        return {'turns': 0, 'services': []}
+    latencies = sorted(result['latency'] for result in analyzed)
+    tail_threshold = percentile(latencies, tail_q)
+
+    contributions = defaultdict(list)
+    durations = defaultdict(list)
+    slacks = defaultdict(list)
+    dispatch = defaultdict(float)
+    tail_time = defaultdict(float)
+    paths = defaultdict(int)
+    for result in analyzed:
+        critical = set(result['critical_path'])
+        paths[' -> '.join(result['critical_path'])] += 1
+        for name, cost in result['cost'].items():
+            contribution = cost['dispatch'] + cost['service'] if name in critical else 0.0
+            contributions[name].append(contribution)
+            durations[name].append(cost['service'])
+            if name in critical:
+                dispatch[name] += cost['dispatch']
+                if result['latency'] >= tail_threshold:
+                    tail_time[name] += contribution
+            if name in result['slack']:
+                slacks[name].append(result['slack'][name])
+
+    total_critical = sum(sum(values) for values in contributions.values())
+    total_tail = sum(tail_time.values())
+    services = []
+    for name, values in contributions.items():
+        values = sorted(values)
+        service_durations = sorted(durations[name])
+        critical_time = sum(values)
+        services.append({
+            'service': name,
+            'turns': len(values),
+            'critical_ratio': round(sum(1 for v in values if v > 0) / len(values), 5),
+            'critical_time_share': round(critical_time / total_critical, 5) if total_critical else 0.0,
+            'tail_time_share': round(tail_time[name] / total_tail, 5) if total_tail else 0.0,
+            'dispatch_share': round(dispatch[name] / critical_time, 5) if critical_time else 0.0,
+            'contribution_p50': round(percentile(values, 0.5), 5),
+            'contribution_p95': round(percentile(values, 0.95), 5),
+            'contribution_p99': round(percentile(values, 0.99), 5),
+            'duration_p50': round(percentile(service_durations, 0.5), 5),
+            'duration_p99': round(percentile(service_durations, 0.99), 5),
+            'slack_mean': round(sum(slacks[name]) / len(slacks[name]), 5) if slacks[name] else None
+        })
+    services.sort(key=lambda s: (s['critical_time_share'], s['tail_time_share']), reverse=True)
+    return {'turns': len(analyzed),
+            'latency_p50': round(percentile(latencies, 0.5), 5),
+            'latency_p95': round(percentile(latencies, 0.95), 5),
+            'latency_p99': round(percentile(latencies, 0.99), 5),
+            'tail_threshold': round(tail_threshold, 5),
+            'critical_paths': sorted(({'path': path, 'turns': count} for path, count in paths.items()),
+                                     key=lambda p: p['turns'], reverse=True),
+            'services': services}
+
+
+def print_report(report: Dict) -> None:
+    print(f'turns: {report["turns"]}')
+    if not report['turns']:
+        return
+    print(f'turn latency p50/p95/p99: {report["latency_p50"]}/{report["latency_p95"]}/{report["latency_p99"]} sec, '
+          f'tail turns from {report["tail_threshold"]} sec')
+    print('\nmost frequent critical paths:')
+    for path in report['critical_paths'][:5]:
+        print(f'{path["turns"]}\t{path["path"]}')
+    print('\nrank\tservice\tcritical ratio\tcritical time share\ttail time share\tdispatch share\t'
+          'contribution p50/p95/p99\tduration p50/p99\tmean slack')
+    for rank, s in enumerate(report['services'], 1):
+        print(f'{rank}\t{s["service"]}\t{s["critical_ratio"]}\t{s["critical_time_share"]}\t{s["tail_time_share"]}\t'
+              f'{s["dispatch_share"]}\t{s["contribution_p50"]}/{s["contribution_p95"]}/{s["contribution_p99"]}\t'
+              f'{s["duration_p50"]}/{s["duration_p99"]}\t{s["slack_mean"]}')
+
+
+def main():
+    args = parser.parse_args()
+    if args.graph:
+        with open(args.graph, 'r', encoding='utf-8') as f:
+            pipeline = make_pipeline(json.load(f))
+    else:
+        pipeline = make_pipeline_from_config()
+
+    report = make_report(read_turns(args.input), pipeline, args.tail)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import argparse
+from datetime import datetime
+from time import perf_counter
+from uuid import uuid4
+
+from core.state_manager import StateManager, connect_state_storage
+from core.state_schema import Dialog, HumanUtterance, BotUtterance
+
+'''
+Measures per-turn cost of loading a dialog state (get_or_create_dialog + Dialog.to_dict) depending on the
+dialog length, for the whole history and for a bounded history window. Requires a running MongoDB from the agent
+config, test dialogs are removed after the run.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-l', '--lengths', help='dialog lengths (utterances count)', type=int, nargs='+',
+                    default=[10, 100, 500, 1000])
+parser.add_argument('-w', '--window', help='history window size', type=int, default=20)
+parser.add_argument('-t', '--turns', help='measured turns per dialog length', type=int, default=20)
+
+
+def make_dialog(length):
+    human = StateManager.create_new_human(f'benchmark_{uuid4().hex}', 'benchmark')
+    bot = StateManager.create_new_bot()
+    dialog = StateManager.create_new_dialog(human, bot, channel_type='cmd_client')
+    utterances = []
+    for i in range(length):
+        if i % 2:
+            utt = BotUtterance(text=f'bot utterance {i}', orig_text=f'bot utterance {i}', user=bot.to_dict(),
+                               date_time=datetime.now(), active_skill='benchmark', confidence=0.5)
+        else:
+            utt = HumanUtterance(text=f'human utterance {i}', user=human.to_dict(), date_time=datetime.now())
+        utt.save()
+        utterances.append(utt)
+    dialog.update(push_all__utterances=utterances)
+    return human, bot, dialog, utterances
+
+
+def measure_turn(human, history_window, turns):
+    start = perf_counter()
+    for _ in range(turns):
+        dialog = StateManager.get_or_create_dialog(human, '', 'cmd_client', history_window=history_window)
+        dialog.to_dict()
+    return (perf_counter() - start) / turns
+
+
+def main():
+    args = parser.parse_args()
+    connect_state_storage()
+    print(f'utterances\twhole history, ms/turn\twindow {args.window}, ms/turn')
+    for length in args.lengths:
+        human, bot, dialog, utterances = make_dialog(length)
+        try:
+            full = measure_turn(human, None, args.turns)
+            windowed = measure_turn(human, args.window, args.turns)
+            print(f'{length}\t{round(full * 1000, 3)}\t{round(windowed * 1000, 3)}')
+        finally:
+            for utt in utterances:
+                utt.delete()
+            Dialog.objects(id__exact=dialog.id).delete()
+            human.delete()
+            bot.delete()
+
+
+if __name__ == '__main__':
+    main()
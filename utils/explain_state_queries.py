@@ -0,0 +1,76 @@
+import argparse
+import json
+
+from bson import ObjectId
+
+from core.state_manager import StateManager, connect_state_storage
+from core.state_schema import Human, Dialog, Utterance
+from core.transform_config import DIALOG_HISTORY_WINDOW
+
+'''
+Reports MongoDB query plans of all queries made by StateManager, so collection scans can be caught before
+production. Queries are explained with the values of the last dialog in the database (or random ids for an empty
+database). Indexes are ensured before the report with -e option.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-e', '--ensure-indexes', help='ensure indexes before explaining queries', action='store_true')
+parser.add_argument('-v', '--verbose', help='print whole explain output', action='store_true')
+
+
+def get_sample_values():
+    dialog = Dialog.objects.order_by('-id').fields(slice__utterances=-1).no_dereference().first()
+    if dialog is None:
+        return '', ObjectId(), ObjectId(), [ObjectId()]
+    human = Human.objects(id__exact=dialog.human.id).first()
+    utterance_ids = [getattr(utt, 'id', utt) for utt in dialog.utterances] or [ObjectId()]
+    return human.user_telegram_id, human.id, dialog.id, utterance_ids
+
+
+def get_queries():
+    user_telegram_id, human_id, dialog_id, utterance_ids = get_sample_values()
+    dialog_query = Dialog.objects(human__exact=human_id).order_by('-id')
+    if DIALOG_HISTORY_WINDOW is not None:
+        dialog_query = dialog_query.fields(slice__utterances=-DIALOG_HISTORY_WINDOW)
+    return {
+        'get_or_create_user': Human.objects(user_telegram_id__exact=user_telegram_id),
+        'get_or_create_dialog': dialog_query,
+        'get_last_utterances': Dialog.objects(id__exact=dialog_id),
+        'dialog utterances': Utterance.objects(id__in=utterance_ids)
+    }
+
+
+def get_stages(plan):
+    stages = [plan['stage']]
+    if 'inputStage' in plan:
+        stages.extend(get_stages(plan['inputStage']))
+    for input_plan in plan.get('inputStages', []):
+        stages.extend(get_stages(input_plan))
+    return stages
+
+
+def main():
+    args = parser.parse_args()
+    connect_state_storage()
+    if args.ensure_indexes:
+        StateManager.ensure_indexes()
+
+    collection_scans = []
+    for query_name, query in get_queries().items():
+        explain = query.explain()
+        if args.verbose:
+            print(json.dumps(explain, indent=2, default=str))
+        stages = get_stages(explain['queryPlanner']['winningPlan'])
+        stats = explain.get('executionStats', {})
+        print(f'{query_name}\t{" <- ".join(stages)}\tkeys examined: {stats.get("totalKeysExamined")}\t'
+              f'docs examined: {stats.get("totalDocsExamined")}')
+        if 'COLLSCAN' in stages:
+            collection_scans.append(query_name)
+
+    if collection_scans:
+        print(f'collection scans: {", ".join(collection_scans)}')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from collections import defaultdict
+from time import time
+from typing import Dict, List, Optional
+
+import aiohttp
+
+'''
+Load generator for the agent HTTP API.
+
+Open-loop mode (-m open) sends requests at a given arrival rate (constant or poisson intervals) regardless of
+responses, latency is measured from the scheduled send time, so a stalled agent is not hidden by a slowed down
+client (coordinated omission). Requests which would exceed --max-in-flight are not sent and counted as dropped.
+Closed-loop mode (-m closed) runs --users concurrent users, each sends the next phrase when the previous one is
+answered. With --ramp-to the rate (open loop) or the number of users (closed loop) grows linearly during the test.
+
+Latencies are recorded into HDR-style histograms (~0.1% precision), the report with p50/p90/p99/p99.9, error
+and timeout counts is printed and written to --outputfile as JSON. With --baseline the run is compared with a
+previous report and the script exits with an error if any of the percentiles regressed more than --max-regression.
+
+The agent with dummy services and no external dependencies for load testing is started with
+python -m tests.dummy_connectors_test_setup
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-u', '--url', type=str, default='http://127.0.0.1:4242')
+parser.add_argument('-m', '--mode', help='open or closed loop load', choices=['open', 'closed'], default='open')
+parser.add_argument('-a', '--arrival', help='open loop requests intervals', choices=['constant', 'poisson'],
+                    default='poisson')
+parser.add_argument('-r', '--rate', help='open loop requests per second', type=float, default=10)
+parser.add_argument('-uc', '--users', help='closed loop concurrent users, open loop user ids pool size', type=int,
+                    default=10)
+parser.add_argument('--ramp-to', help='final rate (open loop) or users count (closed loop) of linear ramp',
+                    type=float)
+parser.add_argument('-d', '--duration', help='test duration in seconds', type=float, default=60)
+parser.add_argument('-w', '--warmup', help='seconds from the test start excluded from the report', type=float,
+                    default=0)
+parser.add_argument('-t', '--timeout', help='request timeout in seconds', type=float, default=10)
+parser.add_argument('--think-time', help='closed loop pause between user requests in seconds', type=float,
+                    default=0)
+parser.add_argument('--max-in-flight', help='open loop limit of unanswered requests', type=int, default=10000)
+parser.add_argument('-pf', '--phrasesfile', help='name of the file with phrases, one phrase per line', type=str,
+                    default='')
+parser.add_argument('-of', '--outputfile', help='name of the JSON report file', type=str, default='load_test.json')
+parser.add_argument('--baseline', help='JSON report of a previous run to compare with', type=str)
+parser.add_argument('--max-regression', help='allowed relative growth of percentiles over the baseline',
+                    type=float, default=0.1)
+
+PERCENTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class LatencyHistogram:
+    """Log-linear histogram of latencies in microseconds, relative error is 2 ** -sub_bucket_bits."""
+
+    def __init__(self, sub_bucket_bits: int = 10):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts: Dict[int, int] = defaultdict(int)
+        self.total_count = 0
+        self.total = 0
+        self.min_value = None
+        self.max_value = 0
+
+    def _bucket_shift(self, value: int) -> int:
+        return max(value.bit_length() - self.sub_bucket_bits - 1, 0)
+
+    def record(self, seconds: float) -> None:
+        value = max(int(seconds * 1e6), 0)
+        shift = self._bucket_shift(value)
+        self.counts[(value >> shift) << shift] += 1
+        self.total_count += 1
+        self.total += value
+        self.min_value = value if self.min_value is None else min(self.min_value, value)
+        self.max_value = max(self.max_value, value)
+
+    def value_at(self, q: float) -> float:
+        """Highest value of the bucket holding the q-th quantile, in seconds."""
+        if not self.total_count:
+            return 0.0
+        rank = max(int(q * self.total_count + 0.5), 1)
+        accumulated = 0
+        for bucket in sorted(self.counts):
+            accumulated += self.counts[bucket]
+            if accumulated >= rank:
+                return min(bucket + (1 << self._bucket_shift(bucket)) - 1, self.max_value) / 1e6
+        return self.max_value / 1e6
+
+    def to_dict(self) -> Dict:
+        result = {'count': self.total_count,
+                  'min': (self.min_value or 0) / 1e6,
+                  'mean': round(self.total / self.total_count / 1e6, 6) if self.total_count else 0.0,
+                  'max': self.max_value / 1e6}
+        result.update({f'p{round(q * 100, 1):g}': self.value_at(q) for q in PERCENTILES})
+        result['buckets'] = [[bucket / 1e6, self.counts[bucket]] for bucket in sorted(self.counts)]
+        return result
+
+
+class LoadStats:
+    def __init__(self, measure_from: float):
+        self.measure_from = measure_from
+        self.latency = LatencyHistogram()
+        self.service_time = LatencyHistogram()
+        self.sent = 0
+        self.completed = 0
+        self.dropped = 0
+        self.timeouts = 0
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def register(self, intended_time: float, send_time: float, end_time: float, error: Optional[str] = None):
+        if intended_time < self.measure_from:
+            return
+        self.sent += 1
+        if error == 'timeout':
+            self.timeouts += 1
+        elif error:
+            self.errors[error] += 1
+        else:
+            self.completed += 1
+            self.latency.record(end_time - intended_time)
+            self.service_time.record(end_time - send_time)
+
+    def to_dict(self, duration: float) -> Dict:
+        return {'sent': self.sent,
+                'completed': self.completed,
+                'timeouts': self.timeouts,
+                'errors': dict(self.errors),
+                'dropped': self.dropped,
+                'max_in_flight': self.max_in_flight,
+                'throughput_rps': round(self.completed / duration, 3) if duration > 0 else 0.0,
+                'latency': self.latency.to_dict(),
+                'service_time': self.service_time.to_dict()}
+
+
+class LoadGenerator:
+    def __init__(self, session: aiohttp.ClientSession, args, phrases: List[str]):
+        self.session = session
+        self.args = args
+        self.phrases = phrases
+        self.user_ids = [uuid.uuid4().hex for _ in range(args.users)]
+        self.start_time = time()
+        self.stats = LoadStats(self.start_time + args.warmup)
+        self.requests = set()
+
+    def progress(self, now: float) -> float:
+        return min((now - self.start_time) / self.args.duration, 1.0)
+
+    def ramp(self, start_value: float, now: float) -> float:
+        if self.args.ramp_to is None:
+            return start_value
+        return start_value + (self.args.ramp_to - start_value) * self.progress(now)
+
+    async def send(self, user_id: str, intended_time: float) -> None:
+        self.stats.in_flight += 1
+        self.stats.max_in_flight = max(self.stats.max_in_flight, self.stats.in_flight)
+        send_time = time()
+        error = None
+        try:
+            request_body = {'user_id': user_id, 'payload': random.choice(self.phrases)}
+            async with self.session.post(self.args.url, json=request_body,
+                                         timeout=aiohttp.ClientTimeout(total=self.args.timeout)) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    error = f'http_{resp.status}'
+        except asyncio.TimeoutError:
+            error = 'timeout'
+        except aiohttp.ClientError as e:
+            error = type(e).__name__
+        finally:
+            self.stats.in_flight -= 1
+        self.stats.register(intended_time, send_time, time(), error)
+
+    def _on_request_done(self, task: asyncio.Task) -> None:
+        self.requests.discard(task)
+
+    async def run_open_loop(self) -> None:
+        end_time = self.start_time + self.args.duration
+        intended_time = self.start_time
+        while intended_time < end_time:
+            delay = intended_time - time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.stats.in_flight >= self.args.max_in_flight:
+                if intended_time >= self.stats.measure_from:
+                    self.stats.dropped += 1
+            else:
+                task = asyncio.ensure_future(self.send(random.choice(self.user_ids), intended_time))
+                self.requests.add(task)
+                task.add_done_callback(self._on_request_done)
+            rate = max(self.ramp(self.args.rate, intended_time), 1e-3)
+            intended_time += random.expovariate(rate) if self.args.arrival == 'poisson' else 1 / rate
+        if self.requests:
+            await asyncio.wait(self.requests)
+
+    async def run_user(self, user_id: str, start_delay: float) -> None:
+        await asyncio.sleep(start_delay)
+        end_time = self.start_time + self.args.duration
+        while time() < end_time:
+            await self.send(user_id, time())
+            if self.args.think_time:
+                await asyncio.sleep(self.args.think_time)
+
+    async def run_closed_loop(self) -> None:
+        users_count = max(self.args.users, int(self.args.ramp_to or 0))
+        user_ids = self.user_ids + [uuid.uuid4().hex for _ in range(users_count - len(self.user_ids))]
+        start_delays = []
+        for i in range(users_count):
+            if i < self.args.users:
+                start_delays.append(0.0)
+            else:
+                # i-th user joins when the linear ramp reaches i users
+                ramp_share = (i - self.args.users + 1) / (users_count - self.args.users + 1)
+                start_delays.append(self.args.duration * ramp_share)
+        await asyncio.gather(*[self.run_user(user_id, delay) for user_id, delay in zip(user_ids, start_delays)])
+
+    async def run(self) -> Dict:
+        if self.args.mode == 'open':
+            await self.run_open_loop()
+        else:
+            await self.run_closed_loop()
+        duration = time() - self.stats.measure_from
+        return {'config': vars(self.args), 'duration': round(duration, 3), **self.stats.to_dict(duration)}
+
+
+def compare_with_baseline(report: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    regressions = []
+    for key in [f'p{round(q * 100, 1):g}' for q in PERCENTILES]:
+        current, previous = report['latency'][key], baseline['latency'][key]
+        change = (current - previous) / previous if previous else 0.0
+        print(f'{key}\t{previous}\t{current}\t{round(change * 100, 2)}%')
+        if change > max_regression:
+            regressions.append(key)
+    return regressions
+
+
+def print_report(report: Dict) -> None:
+    latency = report['latency']
+    print(f'sent: {report["sent"]}, completed: {report["completed"]}, timeouts: {report["timeouts"]}, '
+          f'errors: {sum(report["errors"].values())}, dropped: {report["dropped"]}, '
+          f'throughput: {report["throughput_rps"]} rps')
+    keys = ('min', 'mean', 'p50', 'p90', 'p99', 'p99.9', 'max')
+    print('latency, sec: ' + ', '.join(f'{key} {latency[key]}' for key in keys))
+
+
+async def main(args):
+    if args.phrasesfile:
+        with open(args.phrasesfile, 'r') as file:
+            phrases = [line.rstrip('\n') for line in file if line.strip()]
+    else:
+        phrases = ['hello']
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        report = await LoadGenerator(session, args, phrases).run()
+
+    print_report(report)
+    with open(args.outputfile, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print('percentile\tbaseline\tcurrent\tchange')
+        regressions = compare_with_baseline(report, baseline, args.max_regression)
+        if regressions:
+            print(f'latency regressions: {", ".join(regressions)}')
+            exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -38,22 +38,32 @@ async def perform_test_dialogue(session, url, uuid, payloads):
     return times
 
 
-async def run_users(url, payload, mnu, mxu):
-    async with aiohttp.ClientSession() as session:
-        for i in range(mnu, mxu + 1):
-            tasks = []
-            for j in range(0, i):
-                user_id = uuid.uuid4().hex
-                tasks.append(asyncio.ensure_future(perform_test_dialogue(session, url, user_id, payload)))
-            responses = await asyncio.gather(*tasks)
-            times = []
-            for resp in responses:
-                times.extend(resp)
+def percentile(sorted_times, q):
+    return sorted_times[min(int(len(sorted_times) * q), len(sorted_times) - 1)]
 
-            print(f'test No {i} finished: {max(times)} {min(times)} {mean(times)} {median(times)}')
+
+async def run_users(url, payload, mnu, mxu, output_file):
+    with open(output_file, 'w') as out:
+        out.write('users,max,min,mean,median,p90,p95,p99\n')
+        async with aiohttp.ClientSession() as session:
+            for i in range(mnu, mxu + 1):
+                tasks = []
+                for j in range(0, i):
+                    user_id = uuid.uuid4().hex
+                    tasks.append(asyncio.ensure_future(perform_test_dialogue(session, url, user_id, payload)))
+                responses = await asyncio.gather(*tasks)
+                times = []
+                for resp in responses:
+                    times.extend(resp)
+                times.sort()
+
+                stats = [max(times), min(times), mean(times), median(times),
+                         percentile(times, 0.9), percentile(times, 0.95), percentile(times, 0.99)]
+                print(f'test No {i} finished: {" ".join(str(round(t, 5)) for t in stats)}')
+                out.write(','.join([str(i)] + [str(round(t, 5)) for t in stats]) + '\n')
 
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    future = asyncio.ensure_future(run_users(args.url, payloads, args.minusers, args.maxusers))
+    future = asyncio.ensure_future(run_users(args.url, payloads, args.minusers, args.maxusers, args.outputfile))
     loop.run_until_complete(future)
@@ -0,0 +1,76 @@
+import argparse
+from collections import defaultdict
+from time import perf_counter
+
+from core.pipeline import Pipeline
+from core.service import Service
+
+'''
+Compares per-turn scheduling cost of the compiled pipeline DAG (Pipeline.mark_done) with the
+full rescan of services done by Pipeline.get_next_services. Pipeline is generated as a sequence of layers,
+every service of a layer depends on all services of the previous one, like annotators -> skills -> selectors.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', '--sizes', help='pipeline sizes (services count)', type=int, nargs='+',
+                    default=[10, 50, 200])
+parser.add_argument('-w', '--width', help='services per pipeline layer', type=int, default=5)
+parser.add_argument('-t', '--turns', help='simulated turns per pipeline size', type=int, default=200)
+
+
+def make_pipeline(size, width):
+    services = []
+    previous_names = set()
+    for layer_start in range(0, size, width):
+        layer = [Service(f'service_{i}', None, names_previous_services=previous_names)
+                 for i in range(layer_start, min(layer_start + width, size))]
+        services.extend(layer)
+        previous_names = {s.name for s in layer}
+    pipeline = Pipeline(services)
+    pipeline.add_responder_service(Service('responder', None, tags=['responder']))
+    pipeline.add_input_service(Service('input', None, tags=['input']))
+    return pipeline
+
+
+def run_turn_rescan(pipeline):
+    services_status = defaultdict(dict)
+    services_status['input'] = {'done': False}
+    queue = ['input']
+    while queue:
+        service_name = queue.pop()
+        services_status[service_name]['done'] = True
+        done = {k for k, v in services_status.items() if v['done']}
+        waiting = {k for k, v in services_status.items() if not v['done']}
+        for service in pipeline.get_next_services(done, waiting):
+            services_status[service.name] = {'done': False}
+            queue.append(service.name)
+
+
+def run_turn_compiled(pipeline):
+    pending_counts = pipeline.init_pending_counts()
+    queue = ['input']
+    while queue:
+        service_name = queue.pop()
+        for service in pipeline.mark_done(pending_counts, service_name):
+            queue.append(service.name)
+
+
+def measure(turn_func, pipeline, turns):
+    start = perf_counter()
+    for _ in range(turns):
+        turn_func(pipeline)
+    return (perf_counter() - start) / turns
+
+
+def main():
+    args = parser.parse_args()
+    print('services\trescan, ms/turn\tcompiled, ms/turn\tspeedup')
+    for size in args.sizes:
+        pipeline = make_pipeline(size, args.width)
+        rescan = measure(run_turn_rescan, pipeline, args.turns)
+        compiled = measure(run_turn_compiled, pipeline, args.turns)
+        print(f'{size}\t{round(rescan * 1000, 4)}\t{round(compiled * 1000, 4)}\t{round(rescan / compiled, 1)}')
+
+
+if __name__ == '__main__':
+    main()
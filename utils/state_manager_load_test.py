@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+from inspect import isawaitable
+from statistics import mean, median
+from time import perf_counter
+from uuid import uuid4
+
+from core.async_state_manager import AsyncStateManager
+from core.state_manager import StateManager
+
+'''
+Load test of the agent state managers: many concurrent users perform turns (get user, get dialog,
+add human and bot utterances, save dialog) against MongoDB from the agent config. Blocking StateManager serializes
+all users on the event loop, AsyncStateManager lets their DB round-trips overlap.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-u', '--users', help='concurrent users count', type=int, default=100)
+parser.add_argument('-t', '--turns', help='turns per user', type=int, default=10)
+parser.add_argument('-w', '--window', help='dialog history window', type=int, default=20)
+parser.add_argument('-m', '--managers', help='state managers to test', nargs='+', default=['mongoengine', 'motor'],
+                    choices=['mongoengine', 'motor'])
+
+
+async def await_if_needed(result):
+    if isawaitable(result):
+        return await result
+    return result
+
+
+async def perform_turn(state_manager, user_telegram_id, text, window):
+    user = await await_if_needed(state_manager.get_or_create_user(user_telegram_id, 'load_test'))
+    dialog_object = await await_if_needed(state_manager.get_or_create_dialog(user, 'lab', 'cmd_client',
+                                                                             history_window=window))
+    dialog = dialog_object.to_dict()
+    state_manager.add_human_utterance_simple_dict(dialog, dialog_object, text)
+    state_manager.add_bot_utterance_simple_dict(dialog, dialog_object, {'load_test': {'text': text,
+                                                                                      'confidence': 0.5,
+                                                                                      'skill_name': 'load_test'}})
+    await await_if_needed(state_manager.save_dialog_dict(dialog, dialog_object))
+
+
+async def perform_user_dialog(state_manager, turns, window):
+    user_telegram_id = f'load_test_{uuid4().hex}'
+    times = []
+    for i in range(turns):
+        start_time = perf_counter()
+        await perform_turn(state_manager, user_telegram_id, f'phrase {i}', window)
+        times.append(perf_counter() - start_time)
+    return times
+
+
+async def run_load_test(state_manager, users, turns, window):
+    start_time = perf_counter()
+    results = await asyncio.gather(*[perform_user_dialog(state_manager, turns, window) for _ in range(users)])
+    total_time = perf_counter() - start_time
+    times = sorted(t for user_times in results for t in user_times)
+    return {'turns_per_sec': round(len(times) / total_time, 2),
+            'mean_ms': round(mean(times) * 1000, 3),
+            'median_ms': round(median(times) * 1000, 3),
+            'p95_ms': round(times[int(len(times) * 0.95) - 1] * 1000, 3)}
+
+
+def main():
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    for manager_name in args.managers:
+        state_manager = AsyncStateManager() if manager_name == 'motor' else StateManager()
+        result = loop.run_until_complete(run_load_test(state_manager, args.users, args.turns, args.window))
+        print(f'{manager_name}: {result}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import json
+from time import perf_counter
+from typing import Dict, List
+
+from core.transport.codecs import CODECS
+from core.transport.messages import ServiceTaskMessage, get_transport_message
+
+'''
+Measures encoding and decoding cost and encoded size of agent service tasks with every available transport codec
+(json is always available, orjson and msgpack if their packages are installed). Tasks carry synthetic dialog states
+shaped like the agent state: human utterances with annotations, bot utterances with hypotheses of skills.
+Note that the gateways decode received JSON messages with orjson when it is installed, whatever codec the sender used.
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-u', '--utterances', help='dialog sizes in utterances', type=int, nargs='+',
+                    default=[10, 100, 500])
+parser.add_argument('-r', '--repeats', help='encode/decode repeats per dialog size', type=int, default=200)
+parser.add_argument('-o', '--output', help='file to write results to as JSON', type=str)
+
+
+def make_user(user_type: str) -> Dict:
+    return {'id': '5d9b3a4e6f1c2b0001a2b3c4', 'user_type': user_type, 'persona': ['i like music'],
+            'attributes': {}, 'user_telegram_id': 'benchmark', 'device_type': 'cmd',
+            'profile': {'name': None, 'gender': None, 'birthdate': None, 'location': None, 'home_coordinates': None,
+                        'work_coordinates': None, 'occupation': None, 'income_per_year': None}}
+
+
+def make_dialog(utterances_count: int) -> Dict:
+    human, bot = make_user('human'), make_user('bot')
+    utterances = []
+    for i in range(utterances_count):
+        utterance = {'id': f'5d9b3a4e6f1c2b{i:010d}', 'text': f'what do you think about the movie number {i}?',
+                     'date_time': '2026-10-16 12:00:00.000000',
+                     'annotations': {'ner': [[{'start_pos': 8, 'end_pos': 13, 'type': 'WORK_OF_ART',
+                                               'text': 'movie', 'confidence': 0.87}]],
+                                     'sentiment_classification': {'text': ['neutral', 0.76]},
+                                     'toxic_classification': {'identity_hate': 0.01, 'insult': 0.02,
+                                                              'obscene': 0.0, 'severe_toxic': 0.0,
+                                                              'sexual_explicit': 0.0, 'threat': 0.0,
+                                                              'toxic': 0.03}}}
+        if i % 2 == 0:
+            utterance.update({'user': human, 'hypotheses': [
+                {'skill_name': f'skill_{k}', 'text': f'skill {k} answer to phrase {i}', 'confidence': k / 10}
+                for k in range(5)]})
+        else:
+            utterance.update({'user': bot, 'active_skill': 'skill_1', 'confidence': 0.1, 'orig_text': None})
+        utterances.append(utterance)
+    return {'id': '5d9b3a4e6f1c2b0001a2b3c5', 'location': 'lab', 'channel_type': 'cmd_client',
+            'utterances': utterances, 'human': human, 'bot': bot}
+
+
+def measure(codec, task: ServiceTaskMessage, repeats: int) -> Dict:
+    start = perf_counter()
+    for _ in range(repeats):
+        body = codec.encode(task.to_json())
+    encode_time = (perf_counter() - start) / repeats
+
+    start = perf_counter()
+    for _ in range(repeats):
+        get_transport_message(codec.decode(body))
+    decode_time = (perf_counter() - start) / repeats
+
+    return {'encode_us': round(encode_time * 1e6, 1),
+            'decode_us': round(decode_time * 1e6, 1),
+            'bytes': len(body)}
+
+
+def run_benchmark(sizes: List[int], repeats: int) -> Dict:
+    results = {}
+    for size in sizes:
+        task = ServiceTaskMessage(agent_name='dp_agent', service_name='benchmark', task_uuid='task', trace_id=None,
+                                  dialog=make_dialog(size))
+        results[size] = {name: measure(codec, task, repeats) for name, codec in CODECS.items()}
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    results = run_benchmark(args.utterances, args.repeats)
+    print('utterances\tcodec\tencode us\tdecode us\tbytes')
+    for size, codecs_results in results.items():
+        for name, result in codecs_results.items():
+            print(f'{size}\t{name}\t{result["encode_us"]}\t{result["decode_us"]}\t{result["bytes"]}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()